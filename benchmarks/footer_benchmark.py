@@ -0,0 +1,207 @@
+"""Microbenchmarks of reading a schema from a footer and translating it into Hive DDL.
+
+Footers are generated in memory for a matrix of widths, nesting depths, list and map encodings and numbers of
+row groups, and each stage is timed on its own:
+
+    python -m benchmarks.footer_benchmark
+    python -m benchmarks.footer_benchmark --widths 1000 --depths 0 --json > after.json
+
+For every case and stage this reports the operations per second and the objects the result keeps alive, plus
+the peak bytes allocated when `tracemalloc` is available.
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import sys
+import time
+
+from thrift.protocol import TCompactProtocol
+from thrift.transport import TTransport
+
+from parquet2hive_modules import parquet2hivelib as lib
+from parquet2hive_modules.parquet_format.ttypes import (ColumnChunk, ColumnMetaData, CompressionCodec, ConvertedType,
+                                                        Encoding, FieldRepetitionType, FileMetaData, RowGroup,
+                                                        SchemaElement, Statistics, Type)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+WIDTHS = (10, 100, 1000)
+DEPTHS = (0, 2)
+LIST_ENCODINGS = ('three_level', 'two_level', 'unannotated')
+MAP_ENCODINGS = ('map', 'map_key_value')
+ROW_GROUPS = (1, 16)
+
+# the kinds of the top-level columns, in turn
+COLUMN_KINDS = ('int64', 'string', 'decimal', 'list', 'map', 'double')
+
+REQUIRED, OPTIONAL, REPEATED = FieldRepetitionType.REQUIRED, FieldRepetitionType.OPTIONAL, FieldRepetitionType.REPEATED
+
+
+def generate_schema(width, depth=0, list_encoding='three_level', map_encoding='map'):
+    """Get the `SchemaElement`s of a schema of `width` columns, each nested in `depth` structs, and the paths of its leaves."""
+    elements = [SchemaElement(name='schema', num_children=width)]
+    leaves = []
+    for i in range(width):
+        _add_field(elements, leaves, [], 'c{}'.format(i), COLUMN_KINDS[i % len(COLUMN_KINDS)], depth, list_encoding,
+                   map_encoding)
+    return elements, leaves
+
+
+def _add_field(elements, leaves, parent, name, kind, depth, list_encoding, map_encoding):
+    path = parent + [name]
+
+    def leaf(leaf_parent, leaf_name, parquet_type, repetition_type=OPTIONAL, **kwargs):
+        elements.append(SchemaElement(name=leaf_name, type=parquet_type, repetition_type=repetition_type, **kwargs))
+        leaves.append((leaf_parent + [leaf_name], parquet_type))
+
+    if depth > 0:
+        elements.append(SchemaElement(name=name, repetition_type=OPTIONAL, num_children=2))
+        _add_field(elements, leaves, path, 'nested', kind, depth - 1, list_encoding, map_encoding)
+        leaf(path, 'id', Type.INT64, REQUIRED)
+    elif kind == 'list' and list_encoding == 'three_level':
+        elements.append(SchemaElement(name=name, repetition_type=OPTIONAL, converted_type=ConvertedType.LIST, num_children=1))
+        elements.append(SchemaElement(name='list', repetition_type=REPEATED, num_children=1))
+        leaf(path + ['list'], 'element', Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8)
+    elif kind == 'list' and list_encoding == 'two_level':
+        elements.append(SchemaElement(name=name, repetition_type=OPTIONAL, converted_type=ConvertedType.LIST, num_children=1))
+        leaf(path, 'array', Type.BYTE_ARRAY, REPEATED, converted_type=ConvertedType.UTF8)
+    elif kind == 'list':
+        leaf(parent, name, Type.BYTE_ARRAY, REPEATED, converted_type=ConvertedType.UTF8)
+    elif kind == 'map':
+        converted_type = ConvertedType.MAP if map_encoding == 'map' else ConvertedType.MAP_KEY_VALUE
+        elements.append(SchemaElement(name=name, repetition_type=OPTIONAL, converted_type=converted_type, num_children=1))
+        elements.append(SchemaElement(name='key_value', repetition_type=REPEATED, num_children=2))
+        leaf(path + ['key_value'], 'key', Type.BYTE_ARRAY, REQUIRED, converted_type=ConvertedType.UTF8)
+        leaf(path + ['key_value'], 'value', Type.INT64)
+    elif kind == 'string':
+        leaf(parent, name, Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8)
+    elif kind == 'decimal':
+        leaf(parent, name, Type.FIXED_LEN_BYTE_ARRAY, type_length=16, converted_type=ConvertedType.DECIMAL, precision=38, scale=9)
+    else:
+        leaf(parent, name, {'int64': Type.INT64, 'double': Type.DOUBLE}[kind])
+
+
+def generate_footer(width, depth=0, list_encoding='three_level', map_encoding='map', row_groups=1):
+    """Serialize the `FileMetaData` of a file with the schema of `generate_schema` and `row_groups` row groups."""
+    schema, leaves = generate_schema(width, depth, list_encoding, map_encoding)
+
+    groups = []
+    for i in range(row_groups):
+        columns = []
+        for path, parquet_type in leaves:
+            statistics = Statistics(null_count=0, min=b'\x00' * 8, max=b'\xff' * 8)
+            meta_data = ColumnMetaData(type=parquet_type, encodings=[Encoding.PLAIN, Encoding.RLE], path_in_schema=path,
+                                       codec=CompressionCodec.SNAPPY, num_values=1000, total_uncompressed_size=8000,
+                                       total_compressed_size=4000, data_page_offset=4 + i * 4000, statistics=statistics)
+            columns.append(ColumnChunk(file_offset=4 + i * 4000, meta_data=meta_data))
+        groups.append(RowGroup(columns=columns, total_byte_size=4000 * len(leaves), num_rows=1000))
+
+    metadata = FileMetaData(version=1, schema=schema, num_rows=1000 * row_groups, row_groups=groups,
+                            created_by='parquet2hive benchmarks')
+    transport = TTransport.TMemoryBuffer()
+    metadata.write(TCompactProtocol.TCompactProtocol(transport))
+    return transport.getvalue()
+
+
+def _thrift_decode(footer):
+    metadata = FileMetaData()
+    metadata.read(TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(footer)))
+    return metadata
+
+
+def stages(footer):
+    """Get the `(name, function)` of each stage, given the footer or the output of the stage before it.
+
+    `footer_to_ddl` is the whole of what `get_bash_cmd` does with a footer, from its bytes to a create statement.
+    """
+    schema = _thrift_decode(footer).schema
+    elements = lib.parse_schema(footer)
+    tree = lib.SchemaTree(elements)
+    return [
+        ('thrift_decode', lambda: _thrift_decode(footer)),
+        ('parse_schema', lambda: lib.parse_schema(footer)),
+        ('schema_tree', lambda: lib.SchemaTree(elements)),
+        ('build_tree', lambda: lib.build_tree(list(schema[1:]), schema[0].num_children)),
+        ('sql_type', lambda: [lib.sql_type(field) for field in tree.fields()]),
+        ('parquet2sql', lambda: lib.parquet2sql(schema, 'bench', 's3://bench/bench', [])),
+        ('footer_to_ddl', lambda: lib.parquet2sql(lib.parse_schema(footer), 'bench', 's3://bench/bench', [])),
+    ]
+
+
+def measure(fn, min_time=0.2):
+    """Time `fn`, returning its operations per second, the objects its result keeps alive and its peak bytes."""
+    runs, start = 0, time.time()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+
+    gc.collect()
+    before = len(gc.get_objects())
+    result = fn()
+    objects = len(gc.get_objects()) - before
+    del result
+
+    peak_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        fn()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'ops_per_sec': round(runs / elapsed, 2), 'objects': objects, 'peak_bytes': peak_bytes}
+
+
+def run(widths=WIDTHS, depths=DEPTHS, list_encodings=LIST_ENCODINGS, map_encodings=MAP_ENCODINGS, row_groups=ROW_GROUPS,
+        min_time=0.2, only=None):
+    results = []
+    for width, depth, list_encoding, map_encoding, groups in itertools.product(widths, depths, list_encodings,
+                                                                                map_encodings, row_groups):
+        footer = generate_footer(width, depth, list_encoding, map_encoding, groups)
+        case = {'width': width, 'depth': depth, 'list_encoding': list_encoding, 'map_encoding': map_encoding,
+                'row_groups': groups, 'footer_bytes': len(footer)}
+        for stage, fn in stages(footer):
+            if only is not None and stage not in only:
+                continue
+            result = dict(case, stage=stage)
+            result.update(measure(fn, min_time))
+            results.append(result)
+    return results
+
+
+def _format(results):
+    lines = ['{:>6} {:>5} {:>12} {:>14} {:>4} {:>10}  {:<14} {:>12} {:>9} {:>12}'.format(
+        'width', 'depth', 'lists', 'maps', 'rgs', 'bytes', 'stage', 'ops/s', 'objects', 'peak bytes')]
+    for r in results:
+        lines.append('{width:>6} {depth:>5} {list_encoding:>12} {map_encoding:>14} {row_groups:>4} {footer_bytes:>10}  '
+                     '{stage:<14} {ops_per_sec:>12} {objects:>9} {peak:>12}'.format(
+                         peak='-' if r['peak_bytes'] is None else r['peak_bytes'], **r))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark footer decoding and DDL translation')
+    parser.add_argument('--widths', type=int, nargs='+', default=WIDTHS)
+    parser.add_argument('--depths', type=int, nargs='+', default=DEPTHS)
+    parser.add_argument('--list-encodings', choices=LIST_ENCODINGS, nargs='+', default=LIST_ENCODINGS)
+    parser.add_argument('--map-encodings', choices=MAP_ENCODINGS, nargs='+', default=MAP_ENCODINGS)
+    parser.add_argument('--row-groups', type=int, nargs='+', default=ROW_GROUPS)
+    parser.add_argument('--stages', nargs='+', default=None, help='Only run these stages')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Run each stage for at least this many seconds')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON, for comparing runs')
+    args = parser.parse_args(argv)
+
+    results = run(args.widths, args.depths, args.list_encodings, args.map_encodings, args.row_groups, args.min_time,
+                  args.stages)
+    sys.stdout.write((json.dumps(results, indent=2, sort_keys=True) if args.json else _format(results)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
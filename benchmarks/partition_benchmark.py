@@ -0,0 +1,102 @@
+"""Compares the memory and time of indexing the partitions of a large listing.
+
+    python -m benchmarks.partition_benchmark --keys 10000000
+
+Synthetic keys like `submission_date=20170101/sample_id=42/part-00003.parquet` are streamed, as from
+`list_objects_v2` pages, into each of:
+
+- `keys`: the list of the keys
+- `dirs`: a dict of each partition directory to its `[number of files, size]`, with `get_partitioning_fields` run
+  on each key, which is what `VersionScan` kept before `partitions.PartitionTrie`
+- `trie`: a `partitions.PartitionTrie`
+
+Memory is the size of the objects each structure keeps alive, counting objects shared between entries once.
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import sys
+import time
+
+from parquet2hive_modules import parquet2hivelib as lib
+from parquet2hive_modules.partitions import PartitionTrie
+
+STRUCTURES = ('keys', 'dirs', 'trie')
+
+
+def generate_keys(keys, days=365, samples=100):
+    """Generate `(key, size, last modified)` of `keys` files spread over `days` dates and `samples` sample ids."""
+    start = datetime.datetime(2017, 1, 1)
+    partitions = days * samples
+    for i in range(keys):
+        day, sample_id, part = i % days, i // days % samples, i // partitions
+        date = start + datetime.timedelta(days=day)
+        key = 'submission_date={}/sample_id={}/part-{:05d}.parquet'.format(date.strftime('%Y%m%d'), sample_id, part)
+        yield key, 1024 * (1 + i % 7), date
+
+
+def build(structure, keys):
+    if structure == 'keys':
+        return [key for key, _, _ in keys]
+
+    if structure == 'dirs':
+        dirs = {}
+        for key, size, _ in keys:
+            partition_dir = os.path.dirname(key)
+            if lib.get_partitioning_fields(partition_dir):
+                totals = dirs.setdefault(partition_dir, [0, 0])
+                totals[0] += 1
+                totals[1] += size
+        return dirs
+
+    trie = PartitionTrie()
+    for key, size, last_modified in keys:
+        trie.add(os.path.dirname(key), size, last_modified)
+    return trie
+
+
+def deep_size(obj):
+    """The bytes of `obj` and of every object it refers to, following `gc.get_referents`."""
+    seen, pending, size = set(), [obj], 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def run(structure, keys, days, samples):
+    start = time.time()
+    result = build(structure, generate_keys(keys, days, samples))
+    elapsed = time.time() - start
+    return {'structure': structure, 'keys': keys, 'seconds': round(elapsed, 2), 'bytes': deep_size(result)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark indexing the partitions of a listing')
+    parser.add_argument('--keys', type=int, default=10000000)
+    parser.add_argument('--days', type=int, default=365, help='Distinct submission dates')
+    parser.add_argument('--samples', type=int, default=100, help='Distinct sample ids')
+    parser.add_argument('--structures', nargs='+', choices=STRUCTURES, default=STRUCTURES)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON, for comparing runs')
+    args = parser.parse_args(argv)
+
+    results = [run(structure, args.keys, args.days, args.samples) for structure in args.structures]
+    if args.json:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        return
+
+    sys.stdout.write('{:<10} {:>10} {:>8} {:>14} {:>14}\n'.format('structure', 'keys', 'seconds', 'bytes', 'bytes/key'))
+    for r in results:
+        sys.stdout.write('{structure:<10} {keys:>10} {seconds:>8} {bytes:>14} {per_key:>14.1f}\n'.format(
+            per_key=float(r['bytes']) / r['keys'], **r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Compares the wall time of `load_prefix` under different settings, against the simulated S3 of `s3sim`.
+
+    python -m benchmarks.s3_benchmark --datasets 20 --versions 3 --files 50 --table-stats sampled
+
+Every setting loads the same datasets, stored in moto, with fresh caches and S3 clients, so that the times show
+how much concurrency, rate limiting and hedging help with S3's latencies, throttling and slow outliers.
+"""
+
+import argparse
+import sys
+import time
+
+import boto3
+from moto import mock_s3
+
+from benchmarks.s3sim import S3Simulator
+from parquet2hive_modules import parquet2hivelib as lib
+from parquet2hive_modules.hedge import Hedger
+from parquet2hive_modules.ratelimit import RateLimiter
+
+BUCKET = 'parquet2hive-benchmark'
+
+# name, dataset workers, io workers, whether to rate limit, whether to hedge
+SETTINGS = [
+    ('serial', 1, 1, False, False),
+    ('concurrent', 8, 32, False, False),
+    ('rate_limited', 8, 32, True, False),
+    ('hedged', 8, 32, False, True),
+    ('rate_limited_hedged', 8, 32, True, True),
+]
+
+
+def setup_datasets(datasets, versions, files, body):
+    client = boto3.client('s3')
+    client.create_bucket(Bucket=BUCKET)
+    for d in range(datasets):
+        for v in range(1, versions + 1):
+            for f in range(files):
+                key = 'dataset_{}/v{}/submission_date=201701{:02d}/part-{}.parquet'.format(d, v, f % 28 + 1, f)
+                client.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+
+def run_setting(setting, simulator_options, request_rate, load_options):
+    name, workers, io_workers, rate_limited, hedged = setting
+    limiter = RateLimiter(rate=request_rate) if rate_limited else None
+    hedger = Hedger() if hedged else None
+
+    lib.clear_caches()
+    lib.set_max_workers(workers, io_workers)
+    lib.set_rate_limiter(limiter)
+    lib.set_hedger(hedger)
+    try:
+        with S3Simulator(**simulator_options) as simulator:
+            start = time.time()
+            lib.load_prefix('s3://' + BUCKET, **load_options)
+            elapsed = time.time() - start
+    finally:
+        lib.set_rate_limiter(None)
+        lib.set_hedger(None)
+
+    stats = simulator.stats()
+    return {'setting': name,
+            'seconds': round(elapsed, 2),
+            'requests': sum(stats['requests'].values()),
+            'throttles': stats['throttles'],
+            'outliers': stats['outliers'],
+            'retries': limiter.stats()['retries'] if limiter is not None else None,
+            'hedges': hedger.stats()['hedges'] if hedger is not None else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark load_prefix against a simulated S3')
+    parser.add_argument('--datasets', type=int, default=10)
+    parser.add_argument('--versions', type=int, default=2)
+    parser.add_argument('--files', type=int, default=20, help='Files in each version')
+    parser.add_argument('--file', type=str, default='tests/dataset.parquet', help='The Parquet file every object is a copy of')
+    parser.add_argument('--settings', nargs='+', default=None, choices=[s[0] for s in SETTINGS])
+    parser.add_argument('--table-stats', choices=['exact', 'sampled'], default=None)
+    parser.add_argument('--use-last-versions', type=int, default=None)
+    parser.add_argument('--s3-request-rate', type=float, default=300,
+                        help='Requests per second the simulated S3 allows before answering SlowDown')
+    parser.add_argument('--bandwidth', type=float, default=100, help='Simulated bandwidth in MB/s')
+    parser.add_argument('--outlier-probability', type=float, default=0.02)
+    parser.add_argument('--outlier-latency', type=float, default=1.0)
+    parser.add_argument('--request-rate', type=int, default=250, help='Request rate of the rate limited settings')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    simulator_options = {'max_request_rate': args.s3_request_rate, 'bandwidth': args.bandwidth * 1024 * 1024,
+                         'outlier_probability': args.outlier_probability, 'outlier_latency': args.outlier_latency,
+                         'seed': args.seed}
+    load_options = {'table_stats': args.table_stats, 'recent_versions': args.use_last_versions}
+
+    mock = mock_s3()
+    mock.start()
+    try:
+        with open(args.file, 'rb') as f:
+            setup_datasets(args.datasets, args.versions, args.files, f.read())
+
+        sys.stdout.write('{:<20} {:>8} {:>9} {:>9} {:>9} {:>8} {:>7}\n'.format(
+            'setting', 'seconds', 'requests', 'throttles', 'outliers', 'retries', 'hedges'))
+        for setting in SETTINGS:
+            if args.settings is not None and setting[0] not in args.settings:
+                continue
+            result = run_setting(setting, simulator_options, args.request_rate, load_options)
+            sys.stdout.write('{setting:<20} {seconds:>8} {requests:>9} {throttles:>9} {outliers:>9} {retries!s:>8} '
+                             '{hedges!s:>7}\n'.format(**result))
+    finally:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""A slower, throttling S3 for moto, to see whether concurrency, hedging and batching help.
+
+moto answers every request immediately. While an `S3Simulator` is started, the requests of the boto3 clients
+created afterwards first wait for a latency drawn for their operation, sometimes with a slow outlier added, are
+answered with a 503 SlowDown beyond a request rate, and their responses are read no faster than a bandwidth
+shared by all of them. moto still answers the requests themselves, so anything which works under `mock_s3` works
+under the simulator, e.g. `get_bash_cmd` and `load_prefix`:
+
+    with mock_s3(), S3Simulator(max_request_rate=100, bandwidth=50 * 1024 * 1024):
+        lib.clear_caches()  # so that the S3 clients are created again
+        lib.load_prefix('s3://bucket/prefix')
+
+The simulator hooks into botocore's event system, like moto does, and so only sees clients created after `start`.
+"""
+
+import io
+import math
+import random
+import threading
+import time
+
+import boto3
+import botocore.awsrequest
+import botocore.handlers
+
+
+def constant(seconds):
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma=0.5):
+    """Latencies with a long tail, as S3's are, `median` seconds half of the time."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+# latencies of the operations parquet2hive makes, roughly as seen from EC2 in the same region; other operations,
+# e.g. the puts setting up a test, aren't slowed down
+DEFAULT_LATENCIES = {
+    'ListObjectsV2': lognormal(0.06),
+    'ListObjects': lognormal(0.06),
+    'HeadObject': lognormal(0.015),
+    'GetObject': lognormal(0.025),
+    'HeadBucket': lognormal(0.015),
+    'GetBucketLocation': lognormal(0.015),
+}
+
+SLOW_DOWN_BODY = (b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>SlowDown</Code>'
+                  b'<Message>Please reduce your request rate.</Message><RequestId>S3SIMULATOR</RequestId></Error>')
+
+
+class S3Simulator(object):
+    """Slows down and throttles the S3 requests answered by moto.
+
+    `latencies` maps operation names to functions of a `random.Random` returning a latency in seconds, see
+    `lognormal`. A request is an outlier with probability `outlier_probability`, taking `outlier_latency` more
+    seconds. Beyond `max_request_rate` requests per second, with bursts of up to `burst`, requests are answered with
+    a 503 SlowDown, and responses share `bandwidth` bytes per second. Rates and bandwidth are unlimited when None.
+    """
+
+    def __init__(self, latencies=None, outlier_probability=0.0, outlier_latency=1.0, max_request_rate=None, burst=None,
+                 bandwidth=None, seed=None, clock=time.time, sleep=time.sleep):
+        self.latencies = DEFAULT_LATENCIES if latencies is None else latencies
+        self.outlier_probability = outlier_probability
+        self.outlier_latency = outlier_latency
+        self.max_request_rate = max_request_rate
+        self.burst = max_request_rate if burst is None else burst
+        self.bandwidth = bandwidth
+        self.clock = clock
+        self.sleep = sleep
+
+        self.requests = {}
+        self.throttles = 0
+        self.outliers = 0
+        self.bytes = 0
+        self.delay = 0.0
+
+        self._random = random.Random(seed)
+        self._tokens = self.burst
+        self._tokens_updated = None
+        self._link_free_at = 0.0
+        self._lock = threading.Lock()
+        self._handlers = [('before-send.s3', self._before_send, botocore.handlers.REGISTER_FIRST),
+                          ('after-call.s3', self._after_call, botocore.handlers.REGISTER_FIRST)]
+        self._default_session = None
+
+    def start(self):
+        botocore.handlers.BUILTIN_HANDLERS.extend(self._handlers)
+        # clients made by boto3.client() come from the default session, which only picks up new handlers when created
+        self._default_session, boto3.DEFAULT_SESSION = boto3.DEFAULT_SESSION, None
+
+    def stop(self):
+        for handler in self._handlers:
+            botocore.handlers.BUILTIN_HANDLERS.remove(handler)
+        boto3.DEFAULT_SESSION = self._default_session
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _before_send(self, request, event_name, **kwargs):
+        operation = event_name.split('.')[-1]
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            throttled = not self._take_token()
+            if throttled:
+                self.throttles += 1
+
+            latency = self.latencies[operation](self._random) if operation in self.latencies else 0.0
+            if latency and self._random.random() < self.outlier_probability:
+                self.outliers += 1
+                latency += self.outlier_latency
+            self.delay += latency
+
+        if latency > 0:
+            self.sleep(latency)
+
+        if throttled:
+            return botocore.awsrequest.AWSResponse(request.url, 503, {'Content-Type': 'application/xml'},
+                                                   _RawResponse(b'' if request.method == 'HEAD' else SLOW_DOWN_BODY))
+        return None
+
+    def _take_token(self):
+        if self.max_request_rate is None:
+            return True
+
+        now = self.clock()
+        if self._tokens_updated is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._tokens_updated) * self.max_request_rate)
+        self._tokens_updated = now
+
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _after_call(self, http_response, parsed, **kwargs):
+        body = parsed.get('Body') if isinstance(parsed, dict) else None
+        if body is not None:
+            parsed['Body'] = _SlowBody(body, self)
+        elif http_response is not None:
+            self.transfer(len(http_response.content or b''))
+
+    def transfer(self, size):
+        """Wait for `size` bytes to go through the link the responses share."""
+        with self._lock:
+            self.bytes += size
+            if self.bandwidth is None or size == 0:
+                return
+            now = self.clock()
+            self._link_free_at = max(now, self._link_free_at) + float(size) / self.bandwidth
+            wait = self._link_free_at - now
+            self.delay += wait
+        self.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'throttles': self.throttles, 'outliers': self.outliers,
+                    'bytes': self.bytes, 'delay': round(self.delay, 3)}
+
+
+class _RawResponse(io.BytesIO):
+
+    def stream(self, **kwargs):
+        contents = self.read()
+        while contents:
+            yield contents
+            contents = self.read()
+
+
+class _SlowBody(object):
+    """A response body read at the bandwidth of the simulator."""
+
+    def __init__(self, body, simulator):
+        self._body = body
+        self._simulator = simulator
+
+    def read(self, amt=None):
+        data = self._body.read(amt)
+        self._simulator.transfer(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
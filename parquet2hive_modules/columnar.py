@@ -0,0 +1,152 @@
+"""Version listings gathered into NumPy columns, to select the latest file and sum up partitions in bulk.
+
+NumPy is optional: `available()` tells whether it is installed.
+"""
+
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def available():
+    return np is not None
+
+
+class ListingTable(object):
+    """The objects of a listing of `prefix`, page by page, as columns.
+
+    The keys are UTF-8 bytes in a single buffer, key `i` being `keys[offsets[i]:offsets[i + 1]]`, next to the int64
+    `sizes`, the int64 `mtimes` in microseconds since the epoch and the `partition_ids` of the directories of the
+    keys relative to `prefix`, which are listed in `partitions`. `success` is the set of the ids of the directories
+    where a _SUCCESS file was listed. The objects for which `ignore(key)` is true are left out.
+    """
+
+    def __init__(self, prefix, ignore=None):
+        if np is None:
+            raise ImportError('the columnar listing needs numpy')
+        self.prefix = prefix
+        self.ignore = ignore
+        self.partitions = []
+        self.success = set()
+        self._partition_ids = {}
+        self._tzinfo = None
+        self._pages = []
+        self._columns = None
+
+    def add_page(self, contents):
+        """Add the `Contents` of a `list_objects_v2` response."""
+        start = len(self.prefix)
+        keys = [summary['Key'] for summary in contents]
+        for key in keys:
+            if key.endswith('/_SUCCESS'):
+                self.success.add(self._partition_id(key[start:].rpartition('/')[0]))
+
+        if self.ignore is not None:
+            contents = [summary for summary in contents if not self.ignore(summary['Key'])]
+            keys = [summary['Key'] for summary in contents]
+        if not contents:
+            return
+
+        if self._tzinfo is None:
+            self._tzinfo = contents[0]['LastModified'].tzinfo
+        epoch = EPOCH.replace(tzinfo=self._tzinfo)
+
+        encoded = [key.encode('utf-8') for key in keys]
+        directories, inverse = np.unique(np.array([key[start:].rpartition('/')[0] for key in keys]), return_inverse=True)
+        page_ids = np.array([self._partition_id(d) for d in directories.tolist()], dtype=np.int32)
+
+        self._pages.append((b''.join(encoded),
+                            np.array([len(key) for key in encoded], dtype=np.int64),
+                            np.array([summary['Size'] for summary in contents], dtype=np.int64),
+                            np.array([summary['LastModified'] - epoch for summary in contents],
+                                     dtype='timedelta64[us]').view(np.int64),
+                            page_ids[inverse]))
+        self._columns = None
+
+    def _partition_id(self, partition_dir):
+        partition_id = self._partition_ids.get(partition_dir)
+        if partition_id is None:
+            partition_id = self._partition_ids[partition_dir] = len(self.partitions)
+            self.partitions.append(partition_dir)
+        return partition_id
+
+    def _concatenate(self):
+        if self._columns is None:
+            if len(self._pages) > 1:
+                keys, lengths, sizes, mtimes, partition_ids = zip(*self._pages)
+                self._pages = [(b''.join(keys), np.concatenate(lengths), np.concatenate(sizes), np.concatenate(mtimes),
+                                np.concatenate(partition_ids))]
+            if self._pages:
+                keys, lengths, sizes, mtimes, partition_ids = self._pages[0]
+            else:
+                keys, lengths, sizes, mtimes, partition_ids = (b'', np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                                                               np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+            offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+            self._columns = (keys, offsets, sizes, mtimes, partition_ids)
+        return self._columns
+
+    @property
+    def keys(self):
+        return self._concatenate()[0]
+
+    @property
+    def offsets(self):
+        return self._concatenate()[1]
+
+    @property
+    def sizes(self):
+        return self._concatenate()[2]
+
+    @property
+    def mtimes(self):
+        return self._concatenate()[3]
+
+    @property
+    def partition_ids(self):
+        return self._concatenate()[4]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def key(self, i):
+        return self.keys[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def last_modified(self, mtime):
+        return EPOCH.replace(tzinfo=self._tzinfo) + datetime.timedelta(microseconds=int(mtime))
+
+    def summary(self, i):
+        """The `Key`, `Size` and `LastModified` of object `i`, like in a listing."""
+        return {'Key': self.key(i), 'Size': int(self.sizes[i]), 'LastModified': self.last_modified(self.mtimes[i])}
+
+    def success_mask(self, has_success):
+        """Get which objects are in a directory with a _SUCCESS file, calling `has_success(partition_dir)` once for
+        each directory where the listing found none."""
+        success = np.zeros(len(self.partitions), dtype=bool)
+        for partition_id in np.unique(self.partition_ids).tolist():
+            success[partition_id] = partition_id in self.success or bool(has_success(self.partitions[partition_id]))
+        return success[self.partition_ids]
+
+    def latest(self, mask=None):
+        """The index of the object modified last, the first of them on ties, or None if there is none."""
+        indices = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        if len(indices) == 0:
+            return None
+        return int(indices[np.argmax(self.mtimes[indices])])
+
+    def aggregate(self, mask=None):
+        """Get the number of files, total size and newest mtime of the objects of each directory, indexed by id."""
+        partition_ids, sizes, mtimes = self.partition_ids, self.sizes, self.mtimes
+        if mask is not None:
+            partition_ids, sizes, mtimes = partition_ids[mask], sizes[mask], mtimes[mask]
+
+        files = np.bincount(partition_ids, minlength=len(self.partitions))
+        total_sizes = np.zeros(len(self.partitions), dtype=np.int64)
+        np.add.at(total_sizes, partition_ids, sizes)
+        newest = np.full(len(self.partitions), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(newest, partition_ids, mtimes)
+        return files, total_sizes, newest
@@ -0,0 +1,96 @@
+"""Hedging of slow requests: sending a duplicate when the first one takes unusually long."""
+
+import collections
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Hedger(object):
+    """Calls functions, calling them a second time if the first call is slower than most recent calls.
+
+    A duplicate call is made once a call has taken longer than the `percentile` of the latencies of the last `window`
+    calls, and whichever call finishes first wins. The other is told to stop through the `threading.Event` every
+    call is given, which it should check before doing more work such as reading a response body. Hedging starts
+    after `min_samples` calls, and at most `max_ratio` of the calls are duplicated.
+    """
+
+    def __init__(self, percentile=0.95, window=1000, min_samples=20, min_delay=0.005, max_ratio=0.05, max_workers=64,
+                 clock=time.time):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.clock = clock
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_time = 0.0
+
+        self._latencies = collections.deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """How long a call can take before it is hedged, or None if it can't be."""
+        with self._lock:
+            if len(self._latencies) < max(1, self.min_samples) or self.hedges >= self.max_ratio * self.requests:
+                return None
+            latencies = sorted(self._latencies)
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))])
+
+    def call(self, fn):
+        """Call `fn(cancelled)` and return its result, possibly calling it twice."""
+        with self._lock:
+            self.requests += 1
+
+        start = self.clock()
+        cancelled = threading.Event()
+        first = self._executor.submit(fn, cancelled)
+
+        delay = self.delay()
+        if delay is None or wait([first], timeout=delay).done:
+            result = first.result()
+            self._observe(self.clock() - start)
+            return result
+
+        with self._lock:
+            self.hedges += 1
+        second = self._executor.submit(fn, cancelled)
+
+        pending = set([first, second])
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # both calls can finish by the same wait, and a success wins over a failure
+            succeeded = [future for future in done if future.exception() is None]
+            winner = succeeded[0] if succeeded else done.pop()
+            if succeeded or not pending:
+                break
+
+        cancelled.set()
+        for future in pending:
+            future.cancel()
+
+        elapsed = self.clock() - start
+        with self._lock:
+            self.hedge_time += elapsed - delay
+            if winner is second:
+                self.hedge_wins += 1
+        self._observe(elapsed)
+        return winner.result()
+
+    def _observe(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {'requests': self.requests,
+                    'hedges': self.hedges,
+                    'hedge_wins': self.hedge_wins,
+                    'extra_requests_ratio': round(float(self.hedges) / self.requests, 4) if self.requests else 0,
+                    'hedged_seconds': round(self.hedge_time, 3),
+                    'delay': None if delay is None else round(delay, 4)}
@@ -0,0 +1,98 @@
+"""File size distributions of datasets, gathered while listing them."""
+
+import threading
+
+# files smaller than this are worth compacting
+SMALL_FILE_SIZE = 64 * 1024 * 1024
+
+# size of the files a partition would ideally be compacted into
+TARGET_FILE_SIZE = 256 * 1024 * 1024
+
+# number of partitions reported as compaction candidates for each version
+COMPACTION_CANDIDATES = 10
+
+
+class SizeHistogram(object):
+    """Counts file sizes in power of two buckets, so that a distribution takes constant memory however many files it has.
+
+    Bucket `i` counts the sizes in `[2 ** (i - 1), 2 ** i)`, and bucket 0 empty files. Percentiles are the upper
+    bound of the bucket they fall in, capped to the largest size seen, so are within a factor of two.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total_size = 0
+        self.small_files = 0
+        self.max_size = 0
+
+    def add(self, size):
+        bucket = size.bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total_size += size
+        self.max_size = max(self.max_size, size)
+        if size < SMALL_FILE_SIZE:
+            self.small_files += 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total_size += other.total_size
+        self.small_files += other.small_files
+        self.max_size = max(self.max_size, other.max_size)
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max_size, 2 ** bucket - 1)
+        return self.max_size
+
+    def excess_files(self):
+        """The number of files compaction would remove."""
+        return max(0, self.count - max(1, -(-self.total_size // TARGET_FILE_SIZE)))
+
+    def to_dict(self):
+        return {'files': self.count,
+                'total_size': self.total_size,
+                'small_files': self.small_files,
+                'p50_size': self.percentile(0.5),
+                'p99_size': self.percentile(0.99),
+                'histogram': [[2 ** bucket - 1, self.buckets[bucket]] for bucket in sorted(self.buckets)]}
+
+
+class LayoutReport(object):
+    """Collects the file size distributions of the versions listed by `get_bash_cmd`, for `--layout-report`."""
+
+    def __init__(self):
+        self.versions = []
+        self._lock = threading.Lock()
+
+    def add(self, location, version, histograms):
+        """Add a version, given the `SizeHistogram` of each of its partition directories ('' for its root)."""
+        total = SizeHistogram()
+        partitions = []
+        for partition_dir, histogram in sorted(histograms.items()):
+            total.merge(histogram)
+            entry = histogram.to_dict()
+            entry['partition'] = partition_dir
+            entry['excess_files'] = histogram.excess_files()
+            partitions.append(entry)
+
+        candidates = sorted([p for p in partitions if p['excess_files'] > 0], key=lambda p: (-p['excess_files'], p['partition']))
+
+        entry = total.to_dict()
+        entry.update({'location': location,
+                      'version': version,
+                      'partitions': partitions,
+                      'compaction_candidates': [p['partition'] for p in candidates[:COMPACTION_CANDIDATES]]})
+        with self._lock:
+            self.versions.append(entry)
+
+    def to_dict(self):
+        with self._lock:
+            return {'versions': sorted(self.versions, key=lambda v: (v['location'], v['version']))}
@@ -0,0 +1,81 @@
+"""A cache of S3 listings in a local directory, shared by the runs on a host."""
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# seconds for which the listings of each level are kept: the datasets under a prefix, the versions of a dataset
+# and the summary of the files of a version
+DEFAULT_TTLS = {'datasets': 3600, 'versions': 900, 'version': 300}
+
+
+class ListingCache(object):
+    """Keeps listings as JSON files in the directory `path`, each for the TTL of its level but at most `max_staleness`.
+
+    An entry is written to a temporary file which is then renamed over it, so that concurrent runs read either the
+    previous or the new listing and never a partial one. Entries which can't be read count as missing.
+    """
+
+    def __init__(self, path, max_staleness=None, ttls=None, clock=time.time):
+        self.path = path
+        self.max_staleness = max_staleness
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def ttl(self, level):
+        if self.max_staleness is None:
+            return self.ttls[level]
+        return min(self.ttls[level], self.max_staleness)
+
+    def get(self, level, key):
+        """Get the listing of `key` at `level`, or None if there is none fresh enough."""
+        try:
+            with open(self._entry_path(level, key)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None
+
+        fresh = (entry is not None and entry.get('key') == [level, key] and
+                 0 <= self.clock() - entry['time'] <= self.ttl(level))
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry['value'] if fresh else None
+
+    def put(self, level, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': [level, key], 'time': self.clock(), 'value': value}, f)
+        os.rename(tmp_path, self._entry_path(level, key))
+
+    def cached(self, level, key, fn):
+        """Get the listing of `key` at `level`, calling `fn` for it and caching the result unless it is fresh enough."""
+        value = self.get(level, key)
+        if value is None:
+            value = fn()
+            self.put(level, key, value)
+        return value
+
+    def _entry_path(self, level, key):
+        digest = hashlib.sha1(json.dumps([level, key], sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}-{}.json'.format(level, digest))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
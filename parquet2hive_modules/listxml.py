@@ -0,0 +1,140 @@
+"""A fast path for listing objects: the raw ListObjectsV2 XML, parsed incrementally into `(key, size, last modified)`.
+
+botocore parses every `<Contents>` of a listing into a dict, with its ETag, StorageClass and Owner and a datetime of
+its LastModified. `list_objects` fetches presigned ListObjectsV2 URLs instead and only keeps the key, the size and
+the last modified time as the ISO 8601 string S3 sends, which sorts like the time since S3 always formats it the
+same way.
+"""
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+import io
+import random
+import threading
+import time
+
+import botocore.awsrequest
+import botocore.compat
+import botocore.exceptions
+import botocore.httpsession
+
+from .ratelimit import is_transient
+
+NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+CONTENTS = NAMESPACE + 'Contents'
+KEY = NAMESPACE + 'Key'
+SIZE = NAMESPACE + 'Size'
+LAST_MODIFIED = NAMESPACE + 'LastModified'
+NEXT_CONTINUATION_TOKEN = NAMESPACE + 'NextContinuationToken'
+ENCODING_TYPE = NAMESPACE + 'EncodingType'
+
+# seconds to wait for a connection or a response, like botocore's default
+TIMEOUT = 60
+MAX_POOL_CONNECTIONS = 50
+
+# attempts at reading a page and the backoff between them, when no `call` retries them, like botocore's standard mode
+MAX_ATTEMPTS = 3
+BASE_DELAY = 0.05
+MAX_DELAY = 20.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = botocore.httpsession.URLLib3Session(timeout=TIMEOUT, max_pool_connections=MAX_POOL_CONNECTIONS)
+        return _session
+
+
+def fetch(url):
+    """Get the HTTP status and a file-like body of `url`, over a pool of connections shared by all threads.
+
+    Failed connections and timeouts raise the `botocore.exceptions.HTTPClientError` or `ConnectionError` botocore
+    would have raised.
+    """
+    response = _get_session().send(botocore.awsrequest.AWSRequest(method='GET', url=url).prepare())
+    return response.status_code, io.BytesIO(response.content)
+
+
+def retry(fn, *args, **kwargs):
+    """Call `fn`, retrying throttles, server errors and failed connections up to `MAX_ATTEMPTS` times in all with
+    "full jitter" backoff."""
+    sleep = kwargs.pop('sleep', time.sleep)
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except Exception as e:
+            attempt += 1
+            if not is_transient(e) or attempt >= MAX_ATTEMPTS:
+                raise
+            sleep(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)))
+
+
+def list_objects(client, bucket, prefix, fetch=fetch, call=retry):
+    """Generate the `(key, size, last modified)` of the objects under `prefix` in `bucket`, following continuation
+    tokens.
+
+    The URLs are presigned by `client` and fetched with `fetch(url)`, which returns the status and a file-like body.
+    Pages are read with `call(read_page, fetch, url)`, by default `retry`, or e.g. through a rate limiter which
+    retries them itself.
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix, 'EncodingType': 'url'}
+    while True:
+        url = client.generate_presigned_url('list_objects_v2', Params=params)
+        objects, token = read_page(fetch, url) if call is None else call(read_page, fetch, url)
+        for obj in objects:
+            yield obj
+
+        if token is None:
+            break
+        params['ContinuationToken'] = token
+
+
+def read_page(fetch, url):
+    """Get the `(key, size, last modified)` of the objects of a page and its continuation token, None on the last page.
+
+    Error responses are raised as the `botocore.exceptions.ClientError` botocore would have raised.
+    """
+    status, body = fetch(url)
+    try:
+        if status != 200:
+            _raise_error(status, body.read())
+        return parse_page(body)
+    finally:
+        body.close()
+
+
+def parse_page(body):
+    """Parse a ListObjectsV2 response from the file-like `body`, keeping only the elements needed as it goes."""
+    objects, token, encoding_type = [], None, None
+    for _, element in ElementTree.iterparse(body):
+        tag = element.tag
+        if tag == CONTENTS:
+            objects.append((element.findtext(KEY), int(element.findtext(SIZE)), element.findtext(LAST_MODIFIED)))
+            element.clear()
+        elif tag == NEXT_CONTINUATION_TOKEN:
+            token = element.text
+        elif tag == ENCODING_TYPE:
+            encoding_type = element.text
+
+    if encoding_type == 'url':
+        objects = [(botocore.compat.unquote_str(key), size, last_modified) for key, size, last_modified in objects]
+    return objects, token
+
+
+def _raise_error(status, content):
+    code, message = str(status), None
+    try:
+        error = ElementTree.fromstring(content)
+        code, message = error.findtext('Code') or code, error.findtext('Message')
+    except ElementTree.ParseError:
+        pass
+    raise botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message},
+                                           'ResponseMetadata': {'HTTPStatusCode': status}}, 'ListObjectsV2')
@@ -1,17 +1,37 @@
+import os
 import re
+import array
+import collections
 import sys
+import json
+import math
+import time
+import random
+import hashlib
+import shlex
 import struct
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
+import botocore.config
+import botocore.utils
 
 from functools32 import lru_cache
 
 from six.moves import shlex_quote
+from six.moves.urllib.parse import unquote
 
 from thrift.protocol import TCompactProtocol
 from thrift.transport import TTransport
-from .parquet_format.ttypes import FileMetaData, Type, ConvertedType, FieldRepetitionType
+from .parquet_format.ttypes import FileMetaData, SchemaElement, Type, ConvertedType, FieldRepetitionType
+from . import columnar
+from . import listxml
+from .layout import SizeHistogram
+from .partitions import PartitionTrie
 
 CONVERSIONS = {
     'boolean': 'boolean',
@@ -24,6 +44,8 @@ CONVERSIONS = {
     'fixed_len_byte_array': 'binary',
 }
 
+_TYPE_CONVERSIONS = dict((getattr(Type, name.upper()), hive_type) for name, hive_type in CONVERSIONS.items())
+
 ignore_patterns = [
     r'.*/$',  # dirs
     r'.*/_[^=/]*/',  # temp dirs
@@ -33,128 +55,1020 @@ ignore_patterns = [
 
 udf = {}
 
+# shared by all S3 requests when set, see `set_rate_limiter`
+_rate_limiter = None
+
+# hedges the footer reads when set, see `set_hedger`
+_hedger = None
+
+# caches the listings of datasets, versions and version summaries when set, see `set_listing_cache`
+_listing_cache = None
+
+# gathers version listings into NumPy columns when set, see `set_columnar_listing`
+_columnar_listing = False
+
+# fetches the raw XML of version listings when set, see `set_listing_fetch`
+_listing_fetch = None
+
+# S3 clients and the worker pools are shared by every dataset processed in this process; datasets are processed
+# by the 'datasets' pool, and requests they make concurrently by the 'io' pool. There is a client for each region
+# of the buckets seen, the region of each bucket being looked up once, and None is the default region. Lookups
+# of different buckets don't wait for each other, each bucket having its own lock
+_clients = {}
+_clients_lock = threading.Lock()
+_bucket_regions = {}
+_bucket_region_locks = {}
+_bucket_regions_lock = threading.Lock()
+_max_workers = {'datasets': 8, 'io': 32}
+_executors = {}
+_executors_lock = threading.Lock()
+
+DEFAULT_TABLE_MODES = ('table', 'view', 'location')
+
+# statistics can be computed from every footer of a version, or extrapolated from a sample of them
+TABLE_STATS_MODES = (None, 'exact', 'sampled')
+
+# struct formats of the PLAIN encoded min and max statistics of the physical types Hive has numeric statistics for
+STATISTICS_FORMATS = {Type.INT32: '<i', Type.INT64: '<q', Type.FLOAT: '<f', Type.DOUBLE: '<d'}
+
+# converted types whose statistics are ordered like the signed values Hive reads; unsigned and decimal ones aren't
+SIGNED_CONVERTED_TYPES = (None, ConvertedType.INT_8, ConvertedType.INT_16, ConvertedType.INT_32, ConvertedType.INT_64,
+                          ConvertedType.DATE, ConvertedType.TIME_MILLIS, ConvertedType.TIME_MICROS,
+                          ConvertedType.TIMESTAMP_MILLIS, ConvertedType.TIMESTAMP_MICROS)
+
+# table property recording the order declared by the `sorting_columns` of the footers
+SORTED_BY_PROPERTY = 'parquet2hive.sorted_by'
+
+# summary files written by parquet-mr, in order of preference; _metadata also contains every row group
+SUMMARY_FILES = ('_common_metadata', '_metadata')
+
+# number of keys listed to find the summary files, _SUCCESS and the partitioning of a version; the summary files
+# and _SUCCESS are among them unless many keys sort before `_`, such as ones starting with digits or capitals
+SUMMARY_SAMPLE_KEYS = 100
+
+# bytes first read from the start of the footer of a summary file for its schema, then 4 times as many until it
+# is complete, so that the row groups after it in a _metadata file aren't read
+SUMMARY_SCHEMA_READ_SIZE = 64 * 1024
+
+# what `estimate_dataset` assumes of S3: prices in USD per 1000 requests, latencies in seconds and sizes in bytes
+S3_REQUEST_PRICES = {'list': 0.005, 'head': 0.0004, 'get': 0.0004}
+S3_REQUEST_LATENCIES = {'list': 0.1, 'head': 0.02, 'get': 0.03}
+LIST_PAGE_SIZE = 1000
+LIST_BYTES_PER_KEY = 350
+ASSUMED_FOOTER_SIZE = 16 * 1024
+
+# number of partitions registered by a single `alter table ... add partition` statement
+PARTITION_BATCH_SIZE = 100
+
+# SQL longer than this is passed to `hive -f` through a here-document instead of as the argument of `hive -e`,
+# which Linux limits to 128 KiB
+MAX_HIVE_ARG_SIZE = 64 * 1024
+HEREDOC_DELIMITER = 'PARQUET2HIVE_SQL'
+
 class UnknownParquetTypeError(Exception):
     pass
 
 class ParquetFormatError(Exception):
     pass
 
-def load_prefix(s3_loc, success_only=None, recent_versions=None, exclude_regex=None, just_sql=False):
+def load_prefix(s3_loc, success_only=None, recent_versions=None, exclude_regex=None, just_sql=False, max_depth=1,
+                shard=None, costs=None, run_stats=None, checkpoint=None, deadline=None, **kwargs):
     """Get a bash command which will load every dataset in a bucket at a prefix.
 
-    For this to work, all datasets must be of the form `s3://$BUCKET_NAME/$PREFIX/$DATASET_NAME/v$VERSION/$PARTITIONS`.
-    Any other formats will be ignored.
+    For this to work, all datasets must be of the form `s3://$BUCKET_NAME/$PREFIX/$DATASET_NAME/v$VERSION/$PARTITIONS`,
+    where `$DATASET_NAME` can be up to `max_depth` levels deep. Any other formats will be ignored.
+    When `shard` is an `(index, count)` pair, only the datasets `shard_datasets` assigns to that shard are loaded.
+    How long each dataset took is recorded in `run_stats`, a `RunStats`, if given.
+    Datasets already loaded according to `checkpoint`, a `Checkpoint`, are skipped and the new ones recorded in
+    it. Datasets not started by `deadline`, a `time.time()` value, are left for a run resumed from `checkpoint`.
+    Additional keyword arguments are passed on to `get_bash_cmd`.
 
     :param bucket_name
     :param prefix
     """
     bucket_name, prefix = _get_bucket_and_prefix(s3_loc)
-    datasets = _get_common_prefixes(bucket_name, prefix)
-    bash_cmd = ''
+    listings = {}
+    datasets = find_datasets(bucket_name, prefix, max_depth, listings)
+
+    locations = ['s3://{}/{}'.format(bucket_name, _remove_trailing_backslash(dataset)) for dataset in datasets]
+    version_prefixes = _listed_versions(locations, datasets, listings)
+    if shard is not None:
+        locations = shard_datasets(locations, shard[0], shard[1], costs)
+
+    entries = [{'location': location, 'version_prefixes': version_prefixes[location]} for location in locations]
+    bash_cmd, errors = _load_datasets(entries, run_stats=run_stats, checkpoint=checkpoint, deadline=deadline,
+                                      success_only=success_only, recent_versions=recent_versions,
+                                      exclude_regex=exclude_regex, just_sql=just_sql, **kwargs)
+
+    for location, error in errors:
+        dataset = _get_bucket_and_prefix(location)[1]
+        sys.stderr.write('Failed to process {}, {}\n'.format(dataset, error))
+    return bash_cmd
+
+
+def load_batch(entries, success_only=None, recent_versions=None, exclude_regex=None, just_sql=False,
+               shard=None, costs=None, run_stats=None, checkpoint=None, deadline=None, **kwargs):
+    """Get a bash command which will load many datasets, possibly from different buckets.
+
+    `entries` are dicts as returned by `parse_batch`. The datasets share the S3 clients, the footer cache and
+    the worker pool. `shard`, `costs`, `run_stats`, `checkpoint` and `deadline` are as for `load_prefix`, and
+    additional keyword arguments are passed on to `get_bash_cmd`.
+
+    Returns the bash command of the datasets which could be processed and a list of `(location, error)` pairs
+    for the others.
+    """
+    if shard is not None:
+        locations = set(shard_datasets([entry['location'] for entry in entries], shard[0], shard[1], costs))
+        entries = [entry for entry in entries if entry['location'] in locations]
+
+    return _load_datasets(entries, run_stats=run_stats, checkpoint=checkpoint, deadline=deadline,
+                          success_only=success_only, recent_versions=recent_versions,
+                          exclude_regex=exclude_regex, just_sql=just_sql, **kwargs)
+
+
+def parse_batch(lines):
+    """Parse dataset locations, one per line, in the form `s3://BUCKET/DATASET [alias=ALIAS] [version=VERSION] [exclude=REGEX ...]`.
+
+    Values can be quoted like in a shell. Empty lines and lines starting with `#` are skipped.
+    """
+    entries = []
+    for line_number, line in enumerate(lines, 1):
+        tokens = shlex.split(line.strip())
+        if not tokens or tokens[0].startswith('#'):
+            continue
+
+        if not tokens[0].startswith('s3://'):
+            raise ValueError('Line {}: expected an s3:// location, got {}'.format(line_number, tokens[0]))
+
+        entry = {'location': tokens[0], 'alias': None, 'version': None, 'exclude_regex': None}
+        for token in tokens[1:]:
+            key, sep, value = token.partition('=')
+            if not sep or key not in ('alias', 'version', 'exclude'):
+                raise ValueError('Line {}: unknown setting {}'.format(line_number, token))
+
+            if key == 'exclude':
+                entry['exclude_regex'] = (entry['exclude_regex'] or []) + [value]
+            else:
+                entry[key] = value
+        entries.append(entry)
+
+    return entries
+
+
+def parse_shard(spec):
+    """Parse a shard given as `INDEX/COUNT`, with `INDEX` from 0 to `COUNT - 1`."""
+    match = re.match(r"^([0-9]+)/([0-9]+)$", spec)
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise ValueError('Invalid shard {}, expected INDEX/COUNT with 0 <= INDEX < COUNT'.format(spec))
+    return int(match.group(1)), int(match.group(2))
+
 
-    for dataset in datasets:
-        dataset = _remove_trailing_backslash(dataset)
+def shard_datasets(locations, shard, num_shards, costs=None):
+    """Get the locations assigned to shard `shard` of `num_shards`, the same on every host given the same arguments.
+
+    Without `costs`, locations are assigned by a hash of their name, so that the shard of a location doesn't depend
+    on the others. With `costs`, the seconds locations took before as recorded by `RunStats`, the most costly
+    locations are assigned first, each to the least loaded shard. That balances shards better, but only if every
+    host sees the same locations. Locations without a cost are assumed to take the average.
+    """
+    if not costs:
+        return [location for location in locations
+                if int(hashlib.md5(location.encode('utf-8')).hexdigest(), 16) % num_shards == shard]
+
+    default_cost = float(sum(costs.values())) / len(costs)
+    loads = [0.0] * num_shards
+    assigned = set()
+    for location in sorted(set(locations), key=lambda location: (-costs.get(location, default_cost), location)):
+        least_loaded = loads.index(min(loads))
+        loads[least_loaded] += costs.get(location, default_cost)
+        if least_loaded == shard:
+            assigned.add(location)
+    return [location for location in locations if location in assigned]
+
+
+def find_datasets(bucket_name, prefix='', max_depth=1, listings=None):
+    """Find the datasets at most `max_depth` levels below a prefix, i.e. the prefixes which contain `vVERSION/` prefixes.
+
+    The prefixes are walked breadth first, listing every level in parallel, without descending into versions.
+    If `listings` is a dict, the prefixes found under each prefix listed are stored in it, so that those of the
+    datasets can be passed on to `get_bash_cmd` instead of listing them again.
+    """
+    datasets = []
+    level = [_remove_trailing_backslash(prefix) + '/' if prefix else '']
+
+    for depth in range(max_depth + 1):
+        level_listings = list(_get_executor('io').map(lambda p: _get_common_prefixes(bucket_name, p), level))
+
+        next_level = []
+        for parent, children in zip(level, level_listings):
+            versions = [child for child in children if re.match("^v[0-9]+$", child[len(parent):-1])]
+            if listings is not None:
+                listings[parent] = children
+            if versions and depth > 0:
+                datasets.append(parent)
+            if depth < max_depth:
+                next_level.extend([child for child in children if child not in versions])
+        level = next_level
+
+    return sorted(datasets)
+
+
+def _listed_versions(locations, datasets, listings):
+    """Map the locations of `datasets` to the prefixes `find_datasets` listed below them, for `get_bash_cmd`.
+
+    With a listing cache they are listed again instead, since the cache keeps the prefixes `find_datasets` lists
+    longer than the versions of a dataset.
+    """
+    if _listing_cache is not None:
+        return dict.fromkeys(locations)
+    return dict(zip(locations, [listings[dataset] for dataset in datasets]))
+
+
+def _load_datasets(entries, exclude_regex=None, run_stats=None, checkpoint=None, deadline=None, schema_state=None,
+                   **kwargs):
+    def load(entry):
+        completed = checkpoint.get(entry['location']) if checkpoint is not None else None
+        if completed is not None:
+            return "" if completed['delivered'] else completed['bash_cmd']
+
+        # datasets not started by the deadline are left for the next run
+        if deadline is not None and time.time() >= deadline:
+            return None
+
+        entry_exclude_regex = (exclude_regex or []) + (entry.get('exclude_regex') or []) or None
+        staged_state = schema_state.stage() if schema_state is not None else None
+        start = time.time()
+        try:
+            entry_bash_cmd = get_bash_cmd(entry['location'], version=entry.get('version'), alias=entry.get('alias'),
+                                          exclude_regex=entry_exclude_regex, schema_state=staged_state,
+                                          version_prefixes=entry.get('version_prefixes'), **kwargs)
+        finally:
+            if run_stats is not None:
+                run_stats.record(entry['location'], time.time() - start)
+
+        if checkpoint is not None:
+            checkpoint.complete(entry['location'], entry_bash_cmd, staged_state)
+        elif staged_state is not None:
+            staged_state.commit()
+        return entry_bash_cmd
+
+    futures = [_get_executor('datasets').submit(load, entry) for entry in entries]
+
+    bash_cmd, errors, delivered, remaining = '', [], [], []
+    for entry, future in zip(entries, futures):
         try:
-            bash_cmd += get_bash_cmd('s3://{}/{}'.format(bucket_name, dataset),
-                                     success_only=success_only, recent_versions=recent_versions,
-                                     exclude_regex=exclude_regex, just_sql=just_sql)
+            entry_bash_cmd = future.result()
         except Exception as e:
-            sys.stderr.write('Failed to process {}, {}\n'.format(dataset, str(e)))
-    return bash_cmd
+            errors.append((entry['location'], str(e)))
+            if run_stats is not None:
+                run_stats.record_error(entry['location'])
+            continue
+
+        if entry_bash_cmd is None:
+            remaining.append(entry['location'])
+        else:
+            bash_cmd += entry_bash_cmd
+            delivered.append(entry['location'])
+
+    if checkpoint is not None:
+        checkpoint.deliver(delivered)
+        # failed datasets are retried by the next run, which starts over
+        if not remaining:
+            checkpoint.finish()
+    if remaining:
+        sys.stderr.write('Out of time, {} datasets are left for the next run\n'.format(len(remaining)))
+        if run_stats is not None:
+            run_stats.record_remaining(remaining)
+    return bash_cmd, errors
+
+
+def get_bash_cmd(location, success_only=False, recent_versions=None, version=None, alias=None, exclude_regex=None, just_sql=False,
+                 schema_state=None, default_table='table', use_summary_files=False, table_stats=None, stats_sample_size=16,
+                 partition_stats=False, sort_hints=False, column_stats=False, layout_report=None, version_prefixes=None):
+    """Get the bash command, or the SQL if `just_sql` is set, which creates the tables of the dataset at `location`.
+
+    `version_prefixes` are the prefixes below `location` if they were already listed, e.g. by `find_datasets`.
+    The definitions of the tables are only recorded in `schema_state` once all of the dataset was processed.
+    """
+    if default_table not in DEFAULT_TABLE_MODES:
+        raise ValueError('Unknown default table mode {}'.format(default_table))
+    if table_stats not in TABLE_STATS_MODES:
+        raise ValueError('Unknown table statistics mode {}'.format(table_stats))
 
+    # changes are staged, so that a dataset failing halfway leaves the state as it was
+    staged_state = schema_state.stage() if schema_state is not None else None
 
-def get_bash_cmd(location, success_only=False, recent_versions=None, version=None, alias=None, exclude_regex=None, just_sql=False):
     bucket_name, prefix = _get_bucket_and_prefix(location)
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    versions = get_versions(bucket, prefix)
-
-    client = botocore.session.get_session().create_client('s3')
-    paginator = client.get_paginator('list_objects_v2')
+    client = _get_client(bucket_name)
+    versions = _get_versions(client, bucket_name, prefix, version_prefixes)
 
     if version is not None:
         versions = [v for v in versions if v == version]
         if not versions:
             sys.stderr.write("No schemas available with that version")
 
-    output, versions_loaded = "", 0
-    for version in versions:
-        success_exists = False
+    dataset_name = prefix.split('/')[-1] if alias is None else alias
+
+    def list_version(version, first, cancelled=None):
+        # the schema and a data key when a summary file has them, otherwise the listing of the version
         version_prefix = prefix + '/' + version + '/'
-        version_location = location + '/' + version
-        dataset_name = prefix.split('/')[-1] if alias is None else alias
+        if (use_summary_files and table_stats is None and not partition_stats and not sort_hints and not column_stats and
+                layout_report is None and not (default_table == 'location' and first)):
+            schema, data_key = _read_version_summary(client, bucket_name, version_prefix, success_only, exclude_regex)
+            if schema is not None:
+                return schema, data_key, None
+
+        scan = _scan_version(client, bucket_name, version_prefix, success_only, exclude_regex,
+                             collect_partitions=partition_stats or (default_table == 'location' and first),
+                             sample_size={None: stats_sample_size if sort_hints or column_stats else None, 'exact': 0,
+                                          'sampled': stats_sample_size}[table_stats],
+                             collect_layout=layout_report is not None, cancelled=cancelled)
+        return None, None, scan
 
-        latest_summary = None
+    output, versions_loaded = "", 0
+    next_listing, cancelled = None, threading.Event()
+    try:
+        for i, version in enumerate(versions):
+            version_location = location + '/' + version
+
+            if next_listing is not None:
+                schema, data_key, scan = next_listing.result()
+                next_listing = None
+            else:
+                schema, data_key, scan = list_version(version, versions_loaded == 0)
+
+            if schema is None:
+                if success_only and not scan.success_exists:
+                    sys.stderr.write("Ignoring dataset missing _SUCCESS file\n")
+                    continue
 
-        iterator = paginator.paginate(Bucket=bucket_name, Prefix=version_prefix)
+                if scan.latest is None:
+                    sys.stderr.write("Ignoring empty dataset\n")
+                    continue
 
-        for summary in iterator.search('Contents[]'):
-            if summary is None:
-                continue
+                data_key = scan.latest['Key']
+                if layout_report is not None:
+                    layout_report.add(location, version, scan.histograms)
+
+            # list the next version while the footers of this one are read, if it is going to be needed
+            if i + 1 < len(versions) and (recent_versions is None or versions_loaded + 1 < recent_versions):
+                next_listing = _get_executor('io').submit(list_version, versions[i + 1], False, cancelled)
+
+            sys.stderr.write("Analyzing dataset {}, {}\n".format(dataset_name, version))
+
+            if schema is None:
+                schema = _read_cached_schema(client, bucket_name, data_key, scan.latest['Size'], scan.latest['LastModified'])
+
+            partitions = get_partitioning_fields(data_key[len(prefix):])
+            columns = get_columns(schema, partitions)
+
+            footers = _map_footers(client, bucket_name, scan.footer_files, _summarize_footer) if scan is not None else []
+            properties = read_table_stats(client, bucket_name, scan, footers) if table_stats is not None else {}
+            if sort_hints:
+                sorted_by = read_sort_order(client, bucket_name, scan, footers)
+                if sorted_by:
+                    properties[SORTED_BY_PROPERTY] = sorted_by
+            partition_totals = scan.matching_partitions(partitions) if scan is not None else {}
+            column_properties = read_column_stats(client, bucket_name, scan, footers) if column_stats and not partitions else {}
+
+            version_table_name = _normalize_table_name(dataset_name + "_" + version)
+            version_sql = _table_sql(columns, version_table_name, version_location, partitions, staged_state)
+            version_sql = _join_sql(version_sql, _table_properties_sql(version_table_name, properties),
+                                    _column_stats_sql(version_table_name, column_properties))
+            if partition_stats and _registers_partitions(version_sql, version_table_name):
+                version_sql = _join_sql(version_sql, _partition_properties_sql(version_table_name, partition_totals))
+            output += _format_sql(version_sql, just_sql)
+
+            if versions_loaded == 0:  # Most recent version
+                default_table_name = _normalize_table_name(dataset_name)
+                default_sql = _default_table_sql(columns, default_table_name, version_table_name, version_location, partitions,
+                                                 partition_totals.keys(), default_table, staged_state)
+                if default_table != 'view':
+                    default_sql = _join_sql(default_sql, _table_properties_sql(default_table_name, properties),
+                                            _column_stats_sql(default_table_name, column_properties))
+                if partition_stats and _registers_partitions(default_sql, default_table_name):
+                    default_sql = _join_sql(default_sql, _partition_properties_sql(default_table_name, partition_totals))
+                output += _format_sql(default_sql, just_sql)
+
+            versions_loaded += 1
+            if recent_versions is not None and versions_loaded >= recent_versions:
+                break
+    finally:
+        if next_listing is not None:
+            cancelled.set()
+            next_listing.cancel()
+
+    if staged_state is not None:
+        staged_state.commit()
+    return output
 
-            if ignore_key(summary['Key'], exclude_regex=exclude_regex):
-                continue
 
-            if success_only:
-                success_prefix = '/'.join(summary['Key'].split('/')[:-1])
+class VersionScan(object):
+    """What a listing of all the objects of a version found.
 
-                if check_success_exists(s3, bucket_name, success_prefix):
-                    success_exists = True
-                else:
-                    continue
+    When `sample_size` is not None, the `(key, size)` of the data files whose footers are read for statistics are
+    kept in `footer_files`: all of them if `sample_size` is 0, otherwise a uniform sample of `sample_size`.
+    When `collect_partitions` is set, `partitions` is the `partitions.PartitionTrie` of the directories of the
+    files, and when `collect_layout` is set, `histograms` maps each directory to the `layout.SizeHistogram` of its
+    files. The directories where the listing found a _SUCCESS file are marked in `partitions` either way.
+    """
 
-            if latest_summary is None or summary['LastModified'] > latest_summary['LastModified']:
-                latest_summary = summary
+    def __init__(self, sample_size=None, seed=None, collect_partitions=False, collect_layout=False):
+        self.latest = None
+        self.success_exists = False
+        self.collect_partitions = collect_partitions
+        self.partitions = PartitionTrie()
+        self.collect_layout = collect_layout
+        self.histograms = {}
+        self.num_files = 0
+        self.total_size = 0
+        self.sample_size = sample_size
+        self.footer_files = []
+        self._random = random.Random(seed)
+
+    def add(self, summary, partition_dir=None):
+        self.add_object(summary['Key'], summary['Size'], summary.get('LastModified'), partition_dir)
+
+    def add_object(self, key, size, last_modified, partition_dir=None):
+        self.num_files += 1
+        self.total_size += size
+
+        if self.collect_partitions:
+            self.partitions.add(partition_dir, size, last_modified)
+
+        if self.collect_layout:
+            self.histograms.setdefault(partition_dir, SizeHistogram()).add(size)
+
+        if self.sample_size is None:
+            return
+
+        entry = (key, size)
+        if self.sample_size == 0 or len(self.footer_files) < self.sample_size:
+            self.footer_files.append(entry)
+        else:
+            # reservoir sampling
+            i = self._random.randint(0, self.num_files - 1)
+            if i < self.sample_size:
+                self.footer_files[i] = entry
+
+    def summary(self):
+        """The latest file, whether a _SUCCESS file was found and the totals, as JSON for the listing cache."""
+        latest = None
+        if self.latest is not None:
+            latest = {'Key': self.latest['Key'], 'Size': self.latest['Size'],
+                      'LastModified': self.latest['LastModified'].isoformat()}
+        return {'latest': latest, 'success_exists': self.success_exists, 'num_files': self.num_files,
+                'total_size': self.total_size}
+
+    @classmethod
+    def from_summary(cls, summary):
+        scan = cls()
+        if summary['latest'] is not None:
+            scan.latest = dict(summary['latest'], LastModified=botocore.utils.parse_timestamp(summary['latest']['LastModified']))
+        scan.success_exists = summary['success_exists']
+        scan.num_files = summary['num_files']
+        scan.total_size = summary['total_size']
+        return scan
+
+    def matching_partitions(self, partitions):
+        """Get the `[number of files, size]` of the directories partitioned by exactly the `partitions` columns."""
+        return self.partitions.matching(partitions)
+
+
+def _scan_version(client, bucket_name, version_prefix, success_only=False, exclude_regex=None, collect_partitions=False,
+                  sample_size=None, collect_layout=False, cancelled=None):
+    """List a version into a `VersionScan`, or return None if the `cancelled` event is set while listing it.
+
+    When only the latest file and totals are needed, they come from the listing cache if it has them.
+    """
+    cache_key = None
+    if _listing_cache is not None and sample_size is None and not collect_partitions and not collect_layout:
+        cache_key = [bucket_name, version_prefix, bool(success_only), exclude_regex or []]
+        cached = _listing_cache.get('version', cache_key)
+        if cached is not None:
+            return VersionScan.from_summary(cached)
+
+    scan = _list_version(client, bucket_name, version_prefix, success_only, exclude_regex, collect_partitions, sample_size,
+                         collect_layout, cancelled)
+    if cache_key is not None and scan is not None:
+        _listing_cache.put('version', cache_key, scan.summary())
+    return scan
+
+
+def _list_version(client, bucket_name, version_prefix, success_only, exclude_regex, collect_partitions, sample_size,
+                  collect_layout, cancelled):
+    if _columnar_listing and sample_size is None and not collect_layout:
+        return _list_version_columnar(client, bucket_name, version_prefix, success_only, exclude_regex, collect_partitions,
+                                      cancelled)
+
+    scan = VersionScan(sample_size, seed=version_prefix, collect_partitions=collect_partitions, collect_layout=collect_layout)
+
+    fetch = _listing_fetch
+    if fetch is not None:
+        # last modified times are ISO 8601 strings until the end of the listing
+        call = listxml.retry
+        if _rate_limiter is not None:
+            call = lambda fn, *args: _rate_limiter.call(bucket_name, version_prefix, fn, *args)
+        objects = listxml.list_objects(client, bucket_name, version_prefix, fetch, call)
+    else:
+        objects = ((s['Key'], s['Size'], s['LastModified']) for s in _list_objects(client, bucket_name, version_prefix))
+
+    latest = None
+    for key, size, last_modified in objects:
+        if cancelled is not None and cancelled.is_set():
+            return None
 
-        if success_only and not success_exists:
-            sys.stderr.write("Ignoring dataset missing _SUCCESS file\n")
+        partition_dir = os.path.dirname(key[len(version_prefix):])
+        if success_only and key.endswith('/_SUCCESS'):
+            scan.partitions.mark_success(partition_dir)
+
+        if ignore_key(key, exclude_regex=exclude_regex):
             continue
 
-        if latest_summary is None:
-            sys.stderr.write("Ignoring empty dataset\n")
+        if success_only:
+            success_prefix = '/'.join(key.split('/')[:-1])
+
+            # _SUCCESS sorts before the data files, so the listing has usually found it already
+            if scan.partitions.success(partition_dir) or check_success_exists(client, bucket_name, success_prefix):
+                scan.success_exists = True
+            else:
+                continue
+
+        if latest is None or last_modified > latest[2]:
+            latest = (key, size, last_modified)
+
+        scan.add_object(key, size, last_modified, partition_dir)
+
+    if fetch is not None:
+        for _, node in scan.partitions.items():
+            node.last_modified = botocore.utils.parse_timestamp(node.last_modified)
+
+    if latest is not None:
+        key, size, last_modified = latest
+        if fetch is not None:
+            last_modified = botocore.utils.parse_timestamp(last_modified)
+        scan.latest = {'Key': key, 'Size': size, 'LastModified': last_modified}
+    return scan
+
+
+def _list_version_columnar(client, bucket_name, version_prefix, success_only, exclude_regex, collect_partitions, cancelled):
+    """Like `_list_version`, selecting the latest file and summing up the files of the version and of its partitions
+    over the columns of a `columnar.ListingTable` rather than object by object."""
+    ignore = re.compile('|'.join('(?:{})'.format(pattern) for pattern in ignore_patterns + (exclude_regex or [])))
+    table = columnar.ListingTable(version_prefix, ignore.match)
+    for response in _list_pages(client, bucket_name, version_prefix):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        table.add_page(response.get('Contents', []))
+
+    scan = VersionScan(collect_partitions=collect_partitions)
+    mask = None
+    if success_only:
+        for partition_id in table.success:
+            scan.partitions.mark_success(table.partitions[partition_id])
+        mask = table.success_mask(
+            lambda partition_dir: check_success_exists(client, bucket_name, (version_prefix + partition_dir).rstrip('/')))
+        scan.success_exists = bool(mask.any())
+
+    latest = table.latest(mask)
+    if latest is None:
+        return scan
+    scan.latest = table.summary(latest)
+
+    files, sizes, newest = table.aggregate(mask)
+    scan.num_files = int(files.sum())
+    scan.total_size = int(sizes.sum())
+    if collect_partitions:
+        for partition_id in files.nonzero()[0].tolist():
+            scan.partitions.add(table.partitions[partition_id], int(sizes[partition_id]),
+                                table.last_modified(newest[partition_id]), files=int(files[partition_id]))
+    return scan
+
+
+def read_table_stats(client, bucket_name, scan, footers=None):
+    """Get the Hive statistics of a version from the footers of the files sampled by `_scan_version`.
+
+    The number of rows is exact when every footer was read, and otherwise extrapolated from the sampled rows per
+    byte. The number of files and total size always come from the listing.
+    """
+    if footers is None:
+        footers = _map_footers(client, bucket_name, scan.footer_files, _summarize_footer)
+    num_rows = _extrapolate(scan, sum([footer['num_rows'] for footer in footers]))
+    return {'numFiles': scan.num_files, 'numRows': num_rows, 'totalSize': scan.total_size}
+
+
+def read_column_stats(client, bucket_name, scan, footers=None):
+    """Get the Hive statistics of the top-level primitive columns of a version from the footers of the files sampled
+    by `_scan_version`.
+
+    Null counts are extrapolated like the number of rows, while the lowest and highest values are those of the
+    sample. Columns missing statistics in any sampled row group are left out.
+    """
+    if footers is None:
+        footers = _map_footers(client, bucket_name, scan.footer_files, _summarize_footer)
+    if not footers:
+        return {}
+
+    merged = dict(footers[0]['columns'])
+    for footer in footers[1:]:
+        for name in merged:
+            merged[name] = _merge_column_stats(merged[name], footer['columns'].get(name))
+
+    properties = {}
+    for name, stats in merged.items():
+        if stats is None:
             continue
+        properties[name] = {'numNulls': _extrapolate(scan, stats['num_nulls'])}
+        if stats['min'] is not None:
+            properties[name].update({'lowValue': stats['min'], 'highValue': stats['max']})
+    return properties
 
-        sys.stderr.write("Analyzing dataset {}, {}\n".format(dataset_name, version))
 
-        schema = read_schema(s3.Object(bucket_name, latest_summary['Key']))
+def _extrapolate(scan, sampled):
+    """Scale a count over the files sampled by `_scan_version` up to the whole version, by size."""
+    sampled_size = sum([size for _, size in scan.footer_files])
 
-        partitions = get_partitioning_fields(latest_summary['Key'][len(prefix):])
+    if len(scan.footer_files) == scan.num_files:
+        return sampled
+    elif sampled_size:
+        return int(round(float(sampled) * scan.total_size / sampled_size))
+    else:
+        return 0
 
-        version_table_name = _normalize_table_name(dataset_name + "_" + version)
-        version_sql = parquet2sql(schema, version_table_name, version_location, partitions)
-        output += _format_sql(version_sql, just_sql)
 
-        if versions_loaded == 0:  # Most recent version
-            default_table_name = _normalize_table_name(dataset_name)
-            default_sql = parquet2sql(schema, default_table_name, version_location, partitions)
-            output += _format_sql(default_sql, just_sql)
+def read_sort_order(client, bucket_name, scan, footers=None):
+    """Get the order in which the rows of a version are sorted, from the footers of the files sampled by `_scan_version`.
 
-        versions_loaded += 1
-        if recent_versions is not None and versions_loaded >= recent_versions:
-            break
+    Returns the sorting columns as a string like "client_id asc, timestamp desc", or None unless every row group
+    of every sampled file declares the same non-empty order.
+    """
+    if footers is None:
+        footers = _map_footers(client, bucket_name, scan.footer_files, _summarize_footer)
 
-    return output
+    orders = set()
+    for footer in footers:
+        orders.update(footer['sort_orders'])
+
+    if len(orders) != 1 or not list(orders)[0]:
+        return None
+    return ", ".join(["{} {}".format(path, 'desc' if descending else 'asc') for path, descending in list(orders)[0]])
+
+
+def _summarize_footer(metadata):
+    sort_orders = set()
+    for row_group in metadata.row_groups or []:
+        sort_orders.add(tuple([('.'.join(row_group.columns[c.column_idx].meta_data.path_in_schema), bool(c.descending))
+                               for c in row_group.sorting_columns or []]))
+    return {'num_rows': metadata.num_rows, 'sort_orders': sort_orders, 'columns': _summarize_columns(metadata)}
+
+
+def _summarize_columns(metadata):
+    """Merge the statistics of the column chunks of each top-level primitive column of a file."""
+    fields = dict((node.element.name, node.element) for node in SchemaTree(metadata.schema).fields()
+                  if node.element.type is not None and node.element.repetition_type != FieldRepetitionType.REPEATED)
+
+    summaries = dict((name, {'num_nulls': 0, 'min': None, 'max': None, 'bounded': True}) for name in fields)
+    for row_group in metadata.row_groups or []:
+        for chunk in row_group.columns:
+            path = chunk.meta_data.path_in_schema
+            if len(path) == 1 and path[0] in fields:
+                chunk_stats = _decode_statistics(fields[path[0]], chunk.meta_data.statistics, chunk.meta_data.num_values)
+                summaries[path[0]] = _merge_column_stats(summaries[path[0]], chunk_stats)
+    return summaries
+
+
+def _decode_statistics(field, statistics, num_values=None):
+    """Decode the statistics of a column chunk, or return None if they are missing.
+
+    `bounded` is False when the chunk has values but no bounds Hive can use, e.g. infinite ones, so that the
+    bounds of the column aren't known. A chunk of `num_values` nulls has neither values nor bounds.
+    """
+    if statistics is None or statistics.null_count is None:
+        return None
+    if statistics.null_count == num_values:
+        return {'num_nulls': statistics.null_count, 'min': None, 'max': None, 'bounded': True}
+
+    fmt = STATISTICS_FORMATS.get(field.type)
+    if (fmt is None or field.converted_type not in SIGNED_CONVERTED_TYPES or statistics.min is None or
+            statistics.max is None):
+        return {'num_nulls': statistics.null_count, 'min': None, 'max': None, 'bounded': False}
+
+    low, high = struct.unpack(fmt, statistics.min)[0], struct.unpack(fmt, statistics.max)[0]
+    if low != low or high != high:  # NaN
+        return None
+    if math.isinf(low) or math.isinf(high):
+        return {'num_nulls': statistics.null_count, 'min': None, 'max': None, 'bounded': False}
+    return {'num_nulls': statistics.null_count, 'min': low, 'max': high, 'bounded': True}
+
+
+def _merge_column_stats(a, b):
+    if a is None or b is None:
+        return None
+    bounded = a['bounded'] and b['bounded']
+    bounds = [stats for stats in (a, b) if stats['min'] is not None]
+    return {'num_nulls': a['num_nulls'] + b['num_nulls'], 'bounded': bounded,
+            'min': min([stats['min'] for stats in bounds]) if bounded and bounds else None,
+            'max': max([stats['max'] for stats in bounds]) if bounded and bounds else None}
+
+
+def _map_footers(client, bucket_name, files, fn):
+    """Apply `fn` to the `FileMetaData` of each `(key, size)` in `files`, reading the footers concurrently.
+
+    Only the results of `fn` are kept, so that whole footers don't stay in memory.
+    """
+    def read(entry):
+        key, size = entry
+        return fn(read_metadata(client, bucket_name, key, size))
+
+    return list(_get_executor('io').map(read, files))
+
+
+def _table_properties_sql(table_name, properties):
+    if not properties:
+        return ""
+    props = ", ".join(["'{}'='{}'".format(k, v) for k, v in sorted(properties.items())])
+    return "alter table `{}` set tblproperties ({});".format(table_name, props)
+
+
+def _column_stats_sql(table_name, column_properties):
+    return _join_sql(*["alter table `{}` update statistics for column `{}` set ({});".format(
+        table_name, name, ", ".join(["'{}'='{}'".format(k, v) for k, v in sorted(props.items())]))
+        for name, props in sorted(column_properties.items())])
+
+
+def _partition_properties_sql(table_name, partition_totals):
+    return _join_sql(*["alter table `{}` partition ({}) set tblproperties ('numFiles'='{}', 'totalSize'='{}');".format(
+        table_name, _partition_spec(d), num_files, total_size) for d, (num_files, total_size) in sorted(partition_totals.items())])
+
+
+def _registers_partitions(sql, table_name):
+    """Whether `sql` registers the partitions of a table, so that their properties can be set afterwards."""
+    return ("msck repair table `{}`;".format(table_name) in sql or
+            "alter table `{}` add if not exists partition".format(table_name) in sql)
+
+
+def _read_version_summary(client, bucket_name, version_prefix, success_only=False, exclude_regex=None):
+    """Read the schema of a version from a Parquet summary file, without listing the whole version.
+
+    Returns the `SchemaTree` of the summary file and the key of a data file, which gives the partitioning,
+    or `(None, None)` if the version has to be listed instead. A single page of the version is listed, which
+    has the summary files and _SUCCESS along with the first data files.
+    """
+    response = _s3_call(bucket_name, version_prefix, client.list_objects_v2, Bucket=bucket_name, Prefix=version_prefix,
+                        MaxKeys=SUMMARY_SAMPLE_KEYS)
+    contents = dict((summary['Key'], summary) for summary in response.get('Contents', []))
+
+    summaries = [contents[version_prefix + name] for name in SUMMARY_FILES if version_prefix + name in contents]
+    if not summaries:
+        return None, None
+
+    if success_only and version_prefix + '_SUCCESS' not in contents:
+        return None, None
+
+    data_keys = sorted(key for key in contents if not ignore_key(key, exclude_regex))
+    if not data_keys:
+        return None, None
+
+    summary = summaries[0]
+    schema = _read_cached_summary_schema(client, bucket_name, summary['Key'], summary['Size'], summary['LastModified'])
+    return schema, data_keys[0]
+
+
+@lru_cache(maxsize=64)
+def _read_cached_summary_schema(client, bucket, key, object_size, last_modified):
+    return SchemaTree(_read_footer_schema(client, bucket, key, object_size))
+
+
+def _read_footer_schema(client, bucket, key, object_size):
+    """Read the schema of a Parquet object from the start of its footer, reading only as much of it as the schema
+    takes, since it comes before the row groups."""
+    footer_size, footer_start = _read_footer_bounds(client, bucket, key, object_size)
+    if footer_size <= 0:
+        raise ParquetFormatError('footer is truncated')
+
+    read_size = SUMMARY_SCHEMA_READ_SIZE
+    while True:
+        read_size = min(read_size, footer_size)
+        footer = _get_range(client, bucket, key, footer_start, footer_start + read_size - 1)
+        try:
+            return _parse_schema(_CompactReader(footer))
+        except IndexError:
+            if read_size == footer_size:
+                raise ParquetFormatError('footer is truncated')
+        read_size *= 4
+
+
+def estimate_prefix(s3_loc, max_depth=1, shard=None, costs=None, **kwargs):
+    """Estimate the requests `load_prefix` would make for the datasets at a prefix; see `estimate_datasets`.
+
+    The total includes the listings of the prefixes `find_datasets` walks, other than those of the datasets which
+    are counted as their versions listings.
+    """
+    bucket_name, prefix = _get_bucket_and_prefix(s3_loc)
+    listings = {}
+    datasets = find_datasets(bucket_name, prefix, max_depth, listings)
+
+    locations = ['s3://{}/{}'.format(bucket_name, _remove_trailing_backslash(dataset)) for dataset in datasets]
+    version_prefixes = _listed_versions(locations, datasets, listings)
+    if shard is not None:
+        locations = shard_datasets(locations, shard[0], shard[1], costs)
+
+    entries = [{'location': location, 'version_prefixes': version_prefixes[location]} for location in locations]
+    return _estimate_entries(entries, [bucket_name], len(listings) - len(entries), **kwargs)
+
+
+def estimate_datasets(entries, shard=None, costs=None, **kwargs):
+    """Estimate the requests, bytes, time and cost of loading datasets, given as entries like those of `parse_batch`.
+
+    Returns the `estimate_dataset` of each dataset and their totals, which include looking up the region of each
+    bucket. The time of the total assumes that datasets are processed by as many workers as set by
+    `set_max_workers`. `shard` and `costs` are as for `load_batch`, and other keyword arguments are as for
+    `estimate_dataset`, `exclude_regex` applying to every dataset on top of its own.
+    """
+    if shard is not None:
+        locations = set(shard_datasets([entry['location'] for entry in entries], shard[0], shard[1], costs))
+        entries = [entry for entry in entries if entry['location'] in locations]
+
+    buckets = set([_get_bucket_and_prefix(entry['location'])[0] for entry in entries])
+    return _estimate_entries(entries, buckets, 0, **kwargs)
+
+
+def _estimate_entries(entries, buckets, walk_requests, exclude_regex=None, **kwargs):
+    futures = [_get_executor('datasets').submit(estimate_dataset, entry['location'], version=entry.get('version'),
+                                                exclude_regex=(exclude_regex or []) + (entry.get('exclude_regex') or []) or None,
+                                                version_prefixes=entry.get('version_prefixes'), **kwargs)
+               for entry in entries]
+    estimates = [future.result() for future in futures]
+
+    # the region of each bucket is looked up once with a HEAD request, see `_look_up_bucket_region`
+    run_requests = {'list': walk_requests, 'head': len(buckets), 'get': 0}
+    total = {'keys': 0, 'requests': dict(run_requests), 'bytes': 0, 'sampling_requests': 0,
+             'cost': sum([run_requests[kind] * S3_REQUEST_PRICES[kind] / 1000 for kind in run_requests])}
+    for estimate in estimates:
+        total['keys'] += estimate['keys']
+        total['bytes'] += estimate['bytes']
+        total['cost'] += estimate['cost']
+        total['sampling_requests'] += estimate['sampling_requests']
+        for kind in total['requests']:
+            total['requests'][kind] += estimate['requests'][kind]
+    total['cost'] = round(total['cost'], 6)
+    total['seconds'] = round(sum([estimate['seconds'] for estimate in estimates]) / _max_workers['datasets'] +
+                             sum([run_requests[kind] * S3_REQUEST_LATENCIES[kind] for kind in run_requests]), 1)
+
+    return {'datasets': estimates, 'total': total}
+
+
+def estimate_dataset(location, success_only=False, recent_versions=None, version=None, exclude_regex=None, table_stats=None,
+                     stats_sample_size=16, sort_hints=False, column_stats=False, sample_partitions=3, version_prefixes=None,
+                     **kwargs):
+    """Estimate the requests, bytes, time and cost of `get_bash_cmd`, without reading any footer.
+
+    The number of keys of a version is extrapolated from the listing of a few of its top-level partitions, so
+    only the versions and top-level partitions are listed in full. A _SUCCESS check is counted for each directory
+    of data files where the listing doesn't find a _SUCCESS file first. Sizes of listings and footers, latencies
+    and prices are those assumed by `S3_REQUEST_PRICES` and the other constants above. Other keyword arguments of
+    `get_bash_cmd` are accepted and ignored.
+    """
+    bucket_name, prefix = _get_bucket_and_prefix(location)
+    client = _get_client(bucket_name)
+
+    versions = _get_versions(client, bucket_name, prefix, version_prefixes)
+    versions_list_requests = 1 + len(versions) // LIST_PAGE_SIZE
+    if version is not None:
+        versions = [v for v in versions if v == version]
+    versions = versions[:recent_versions]
+
+    sampling_requests = versions_list_requests if version_prefixes is None else 0
+    requests = {'list': versions_list_requests, 'head': 0, 'get': 0}
+    seconds = requests['list'] * S3_REQUEST_LATENCIES['list']
+    listed_keys, data_keys = 0, 0
+    for v in versions:
+        version_prefix = prefix + '/' + v + '/'
+        sampler = random.Random(version_prefix)
+
+        success_dirs = set()
+        partition_prefixes, root_listed, root_keys, root_checked = [], 0, 0, set()
+        for response in _list_pages(client, bucket_name, version_prefix, delimiter='/'):
+            sampling_requests += 1
+            partition_prefixes.extend([p['Prefix'] for p in response.get('CommonPrefixes', [])])
+            listed, keys = _count_listed_keys(response.get('Contents', []), exclude_regex, success_dirs, root_checked)
+            root_listed += listed
+            root_keys += keys
+
+        sample = sampler.sample(partition_prefixes, min(sample_partitions, len(partition_prefixes)))
+        sampled_listed, sampled_keys, sampled_checked = 0, 0, set()
+        for partition_prefix in sample:
+            for response in _list_pages(client, bucket_name, partition_prefix):
+                sampling_requests += 1
+                listed, keys = _count_listed_keys(response.get('Contents', []), exclude_regex, success_dirs,
+                                                  sampled_checked)
+                sampled_listed += listed
+                sampled_keys += keys
+
+        scale = float(len(partition_prefixes)) / len(sample) if sample else 0
+        version_listed = root_listed + int(round(sampled_listed * scale))
+        version_keys = root_keys + int(round(sampled_keys * scale))
+        listed_keys += version_listed
+        data_keys += version_keys
+        if not version_keys:
+            continue
+
+        list_requests = max(1, -(-version_listed // LIST_PAGE_SIZE))
+        head_requests = int(round(len(sampled_checked) * scale)) + len(root_checked) if success_only else 0
+        footers = 1 + ({None: min(version_keys, stats_sample_size) if sort_hints or column_stats else 0,
+                        'exact': version_keys,
+                        'sampled': min(version_keys, stats_sample_size)}[table_stats])
+
+        requests['list'] += list_requests
+        requests['head'] += head_requests
+        requests['get'] += 2 * footers
+        # the listing and the _SUCCESS checks are sequential, and the footers are read by the 'io' pool
+        seconds += (list_requests * S3_REQUEST_LATENCIES['list'] + head_requests * S3_REQUEST_LATENCIES['head'] +
+                    2 * S3_REQUEST_LATENCIES['get'] * (1 + -(-(footers - 1) // _max_workers['io'])))
+
+    num_bytes = listed_keys * LIST_BYTES_PER_KEY + requests['get'] // 2 * (ASSUMED_FOOTER_SIZE + 8)
+    cost = sum([requests[kind] * S3_REQUEST_PRICES[kind] / 1000 for kind in requests])
+    return {'location': location,
+            'versions': len(versions),
+            'keys': data_keys,
+            'requests': requests,
+            'bytes': num_bytes,
+            'seconds': round(seconds, 1),
+            'cost': round(cost, 6),
+            'sampling_requests': sampling_requests}
+
+
+def _count_listed_keys(contents, exclude_regex, success_dirs, checked_dirs):
+    """Count the keys of a page of a listing and those of data files, adding the directories of data files to
+    `checked_dirs` unless a _SUCCESS file was listed in them before, i.e. those `_list_version` makes a request for.
+    The directories of the _SUCCESS files listed are added to `success_dirs`."""
+    listed, keys = 0, 0
+    for summary in contents:
+        listed += 1
+        directory = os.path.dirname(summary['Key'])
+        if summary['Key'].endswith('/_SUCCESS'):
+            success_dirs.add(directory)
+        if ignore_key(summary['Key'], exclude_regex):
+            continue
+        keys += 1
+        if directory not in success_dirs:
+            checked_dirs.add(directory)
+    return listed, keys
+
+
+def _join_sql(*stmts):
+    return " ".join([stmt for stmt in stmts if stmt])
 
 
 def _format_sql(sql, just_sql=False):
-    if just_sql:
+    if not sql:
+        return ""
+    elif just_sql:
         return sql + "\n"
+    elif len(sql) > MAX_HIVE_ARG_SIZE:
+        return "hive -f /dev/stdin --hiveconf hive.msck.path.validation=skip <<'{0}'\n{1}\n{0}\n".format(HEREDOC_DELIMITER, sql)
     else:
         return "hive -e {} --hiveconf hive.msck.path.validation=skip\n".format(shlex_quote(sql))
 
 
 def read_schema(s3obj):
+    return read_metadata(s3obj.meta.client, s3obj.bucket_name, s3obj.key).schema
+
+
+def read_metadata(client, bucket, key, object_size=None):
+    """Read the `FileMetaData` from the footer of a Parquet object, looking up its size unless given."""
+    footer = _read_footer(client, bucket, key, object_size)
+
+    # read metadata from footer
+    transport = TTransport.TMemoryBuffer(footer)
+    protocol = TCompactProtocol.TCompactProtocol(transport)
+    metadata = FileMetaData()
+    metadata.read(protocol)
+
+    return metadata
+
+
+def _read_footer(client, bucket, key, object_size=None):
+    """Read the serialized `FileMetaData` at the end of a Parquet object."""
     # get object size
-    object_size = s3obj.content_length
+    if object_size is None:
+        object_size = _s3_call(bucket, key, client.head_object, Bucket=bucket, Key=key)['ContentLength']
+
+    # read footer
+    _, footer_start = _read_footer_bounds(client, bucket, key, object_size)
+    return _get_range(client, bucket, key, footer_start)
 
+
+def _read_footer_bounds(client, bucket, key, object_size):
+    """Read the size of the footer of a Parquet object and the offset where it starts."""
     # raise error if object is too small
     if object_size < 8:
         raise ParquetFormatError('file is too small')
 
     # get footer size
-    response = s3obj.get(Range='bytes={}-'.format(object_size - 8))
-    footer_size = struct.unpack('<i', response['Body'].read(4))[0]
-    magic_number = response['Body'].read(4)
+    tail = _get_range(client, bucket, key, object_size - 8)
+    footer_size = struct.unpack('<i', tail[:4])[0]
+    magic_number = tail[4:8]
 
     # raise error if object is too small
     if object_size < (8 + footer_size):
@@ -164,25 +1078,174 @@ def read_schema(s3obj):
     if magic_number != 'PAR1':
         raise ParquetFormatError('magic number is invalid')
 
-    # read footer
-    response = s3obj.get(Range='bytes={}-'.format(object_size - 8 - footer_size))
-    footer = response['Body']
+    return footer_size, object_size - 8 - footer_size
 
-    # read metadata from footer
-    transport = TTransport.TFileObjectTransport(footer)
-    protocol = TCompactProtocol.TCompactProtocol(transport)
-    metadata = FileMetaData()
-    metadata.read(protocol)
 
-    # return schema
-    return metadata.schema
+def _get_range(client, bucket, key, start, end=None):
+    """Get the bytes of an object from `start` to `end` included, or to its end, hedging the request when a hedger
+    is set."""
+    byte_range = 'bytes={}-{}'.format(start, '' if end is None else end)
+
+    def get(cancelled):
+        response = _s3_call(bucket, key, client.get_object, Bucket=bucket, Key=key, Range=byte_range)
+        if cancelled.is_set():
+            response['Body'].close()
+            return None
+        return response['Body'].read()
+
+    if _hedger is None:
+        return get(threading.Event())
+    return _hedger.call(get)
+
+
+@lru_cache(maxsize=256)
+def _read_cached_schema(client, bucket, key, object_size, last_modified):
+    # the size and modification time are part of the cache key so that rewritten objects are read again
+    return SchemaTree(parse_schema(_read_footer(client, bucket, key, object_size)))
+
+
+# the fields of a `SchemaElement` that `parse_schema` reads, by field id
+FooterElement = collections.namedtuple('FooterElement', ['type', 'repetition_type', 'name', 'num_children',
+                                                         'converted_type', 'scale', 'precision'])
+_FOOTER_ELEMENT_FIELDS = {1: 0, 3: 1, 4: 2, 5: 3, 6: 4, 7: 5, 8: 6}
+
+# types of the Thrift compact protocol
+_COMPACT_TRUE, _COMPACT_FALSE, _COMPACT_BYTE, _COMPACT_I16, _COMPACT_I32, _COMPACT_I64 = 1, 2, 3, 4, 5, 6
+_COMPACT_DOUBLE, _COMPACT_BINARY, _COMPACT_LIST, _COMPACT_SET, _COMPACT_MAP, _COMPACT_STRUCT = 7, 8, 9, 10, 11, 12
+
+
+def parse_schema(footer):
+    """Read the schema of a serialized `FileMetaData` as a list of `FooterElement`s.
+
+    This is a faster equivalent of `FileMetaData.read(...).schema` for when only the columns are needed: the
+    compact protocol is decoded directly, only the fields `sql_type` looks at are kept and reading stops at the
+    end of the schema, so the row groups, which are most of a footer, are never decoded.
+    """
+    try:
+        return _parse_schema(_CompactReader(footer))
+    except IndexError:
+        raise ParquetFormatError('footer is truncated')
+
+
+def _parse_schema(reader):
+    # raises IndexError when the buffer ends before the schema does
+    field_id = 0
+    while True:
+        field_id, field_type = reader.field_header(field_id)
+        if field_id is None:
+            raise ParquetFormatError('footer has no schema')
+        if field_id == 2 and field_type == _COMPACT_LIST:
+            size, _ = reader.list_header()
+            return [_read_footer_element(reader) for _ in range(size)]
+        reader.skip(field_type)
+
+
+def _read_footer_element(reader):
+    values = [None] * len(FooterElement._fields)
+    field_id = 0
+    while True:
+        field_id, field_type = reader.field_header(field_id)
+        if field_id is None:
+            return FooterElement(*values)
+
+        index = _FOOTER_ELEMENT_FIELDS.get(field_id)
+        if index is not None and field_type == _COMPACT_I32:
+            values[index] = reader.zigzag()
+        elif index is not None and field_type == _COMPACT_BINARY:
+            values[index] = reader.binary().decode('utf-8')
+        else:
+            reader.skip(field_type)
+
+
+class _CompactReader(object):
+    """Reads values of the Thrift compact protocol from a buffer, for `parse_schema`."""
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def byte(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def varint(self):
+        result, shift = 0, 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def zigzag(self):
+        n = self.varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def binary(self):
+        size = self.varint()
+        if self.pos + size > len(self.data):
+            raise IndexError('binary past the end of the buffer')
+        self.pos += size
+        return bytes(self.data[self.pos - size:self.pos])
+
+    def field_header(self, last_id):
+        """Read the header of a struct field, returning its id and type, or `(None, None)` at the end of the struct."""
+        byte = self.byte()
+        if byte == 0:
+            return None, None
+        delta = byte >> 4
+        return (last_id + delta if delta else self.zigzag()), byte & 0x0f
+
+    def list_header(self):
+        byte = self.byte()
+        size = byte >> 4
+        return (self.varint() if size == 15 else size), byte & 0x0f
+
+    def skip(self, value_type, in_collection=False):
+        # booleans are in the header of struct fields, but take a byte in collections
+        if value_type in (_COMPACT_TRUE, _COMPACT_FALSE):
+            if in_collection:
+                self.byte()
+        elif value_type == _COMPACT_BYTE:
+            self.byte()
+        elif value_type in (_COMPACT_I16, _COMPACT_I32, _COMPACT_I64):
+            self.varint()
+        elif value_type == _COMPACT_DOUBLE:
+            self.pos += 8
+        elif value_type == _COMPACT_BINARY:
+            self.binary()
+        elif value_type in (_COMPACT_LIST, _COMPACT_SET):
+            size, element_type = self.list_header()
+            for _ in range(size):
+                self.skip(element_type, True)
+        elif value_type == _COMPACT_MAP:
+            size = self.varint()
+            types = self.byte() if size else 0
+            for _ in range(size):
+                self.skip(types >> 4, True)
+                self.skip(types & 0x0f, True)
+        elif value_type == _COMPACT_STRUCT:
+            field_id = 0
+            while True:
+                field_id, field_type = self.field_header(field_id)
+                if field_id is None:
+                    break
+                self.skip(field_type)
+        else:
+            raise ParquetFormatError('invalid compact protocol type {}'.format(value_type))
 
 
 def get_versions(bucket, prefix):
+    return _get_versions(bucket.meta.client, bucket.name, prefix)
+
+
+def _get_versions(client, bucket_name, prefix, tentative=None):
     prefix = _remove_trailing_backslash(prefix) + '/'
 
-    xs = bucket.meta.client.list_objects(Bucket=bucket.name, Delimiter='/', Prefix=prefix)
-    tentative = [o.get('Prefix') for o in xs.get('CommonPrefixes', [])]
+    if tentative is None:
+        tentative = _cached_listing('versions', [bucket_name, prefix],
+                                    lambda: list(_list_common_prefixes(client, bucket_name, prefix)))
 
     versions = []
     for version_prefix in tentative:
@@ -209,6 +1272,8 @@ def get_versions(bucket, prefix):
 
 @lru_cache(maxsize=64)
 def check_success_exists(s3, bucket, prefix):
+    """Whether there is a _SUCCESS object at a prefix, using `s3`, an S3 resource or client."""
+    client = s3 if hasattr(s3, 'head_object') else s3.meta.client
     if not prefix.endswith('/'):
         prefix = prefix + '/'
 
@@ -216,7 +1281,7 @@ def check_success_exists(s3, bucket, prefix):
     exists = False
 
     try:
-        s3.Object(bucket, success_obj_loc).load()
+        _s3_call(bucket, success_obj_loc, client.head_object, Bucket=bucket, Key=success_obj_loc)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             exists = False
@@ -239,24 +1304,449 @@ def get_partitioning_fields(prefix):
 
 
 def parquet2sql(schema, table_name, location, partitions):
-    fields = build_tree(schema[1:], schema[0].num_children)
-    stmts = ["`{}` {}".format(field['name'], sql_type(field)) for field in fields]
-    fields_decl = ", ".join(stmts)
+    columns = get_columns(schema, partitions)
+    return _create_table_sql(table_name, columns, location, partitions)
 
-    if partitions:
-        columns = ", ".join(["`{}` string".format(p) for p in partitions])
-        partition_decl = " partitioned by ({})".format(columns)
-    else:
-        partition_decl = ""
+
+def get_columns(schema, partitions=()):
+    """Get the `(name, hive type)` pairs of the top-level columns of a Parquet schema, or of its `SchemaTree`."""
+    tree = schema if isinstance(schema, SchemaTree) else SchemaTree(schema)
+    columns = [(field.element.name, sql_type(field)) for field in tree.fields()]
 
     # check for duplicated fields
-    field_names = [field['name'] for field in fields]
+    field_names = [name for name, _ in columns]
     duplicate_columns = set(field_names) & set(partitions)
     assert not duplicate_columns, "Columns {} are in both the table columns and the partitioning columns; they should only be in one or another".format(", ".join(duplicate_columns))
-    return "drop table if exists `{0}`; create external table `{0}`({1}){2} stored as parquet location '{3}'; msck repair table `{0}`;".format(table_name, fields_decl, partition_decl, location)
+    return columns
+
+
+def schema_diff_sql(columns, table_name, location, partitions, previous=None):
+    """Get the SQL which brings a table defined as `previous` up to date with `columns`.
+
+    `previous` is an entry of a `SchemaState`. Appended columns become `add columns` and other column changes that
+    keep the type of every surviving column become `replace columns`, so the registered partitions are kept. Anything
+    else, i.e. a new table, a different location or partitioning, or a column changing type, falls back to
+    recreating the table. Partitioned tables are always repaired, so that the partitions written since the last run
+    are registered; otherwise the result is empty when the table is unchanged.
+    """
+    if previous is None or previous['location'] != location or list(previous['partitions']) != list(partitions):
+        return _create_table_sql(table_name, columns, location, partitions)
+
+    sql = _alter_columns_sql(table_name, columns, partitions, previous['columns'])
+    if sql is None:
+        return _create_table_sql(table_name, columns, location, partitions)
+    if partitions:
+        sql = _join_sql(sql, "msck repair table `{}`;".format(table_name))
+    return sql
+
+
+def swap_location_sql(columns, table_name, location, partitions, partition_dirs=(), previous=None):
+    """Get the SQL which points a table at a new location without dropping it.
+
+    Instead of running `msck repair table`, partitions are registered from `partition_dirs`, the partition
+    directories relative to `location`. Partitions of the `previous` entry of a `SchemaState` are pointed at
+    `location` when they're in `partition_dirs`, and dropped otherwise. Partitioned tables are recreated when the
+    previous partitions aren't known, as they would otherwise be left in place. Without a `previous` entry the
+    columns are always replaced.
+    """
+    if previous is not None and list(previous['partitions']) != list(partitions):
+        return _create_table_sql(table_name, columns, location, partitions)
+    if partitions and (previous is None or previous.get('partition_dirs') is None):
+        return _create_table_sql(table_name, columns, location, partitions)
+
+    if previous is None:
+        alter_columns = "alter table `{}` replace columns ({}){};".format(table_name, _fields_decl(columns), " cascade" if partitions else "")
+    else:
+        alter_columns = _alter_columns_sql(table_name, columns, partitions, previous['columns'])
+        if alter_columns is None:
+            return _create_table_sql(table_name, columns, location, partitions)
+
+    stmts = [_create_external_table_sql(table_name, columns, location, partitions, if_not_exists=True) + ";",
+             alter_columns,
+             "alter table `{}` set location '{}';".format(table_name, location)]
+
+    partition_locations = [(_partition_spec(d), location + '/' + d) for d in sorted(partition_dirs)]
+    for i in range(0, len(partition_locations), PARTITION_BATCH_SIZE):
+        batch = partition_locations[i:i + PARTITION_BATCH_SIZE]
+        adds = " ".join(["partition ({}) location '{}'".format(spec, loc) for spec, loc in batch])
+        stmts.append("alter table `{}` add if not exists {};".format(table_name, adds))
+    # new partitions get their location when added, only the existing ones have to be moved
+    previous_dirs = set(previous['partition_dirs']) if partitions else set()
+    for spec, loc in [(_partition_spec(d), location + '/' + d) for d in sorted(previous_dirs & set(partition_dirs))]:
+        stmts.append("alter table `{}` partition ({}) set location '{}';".format(table_name, spec, loc))
+
+    stale_dirs = previous_dirs - set(partition_dirs)
+    stale_specs = [_partition_spec(d) for d in sorted(stale_dirs)]
+    for i in range(0, len(stale_specs), PARTITION_BATCH_SIZE):
+        drops = ", ".join(["partition ({})".format(spec) for spec in stale_specs[i:i + PARTITION_BATCH_SIZE]])
+        stmts.append("alter table `{}` drop if exists {};".format(table_name, drops))
+
+    return _join_sql(*stmts)
+
+
+def view_sql(table_name, version_table_name):
+    """Get the SQL which makes a table a view over a versioned table, without a window where it doesn't exist.
+
+    A base table of the same name, as created by the other modes, is dropped first to migrate it to a view. Hive
+    ignores `drop table if exists` when the table is already a view, so that only happens once.
+    """
+    return ("drop table if exists `{0}`; create view if not exists `{0}` as select * from `{1}`; "
+            "alter view `{0}` as select * from `{1}`;").format(table_name, version_table_name)
+
+
+def _alter_columns_sql(table_name, columns, partitions, previous_columns):
+    """Get the SQL which changes the columns of a table, or None if the table has to be recreated instead."""
+    previous_columns = [tuple(column) for column in previous_columns]
+    columns = [tuple(column) for column in columns]
+    if previous_columns == columns:
+        return ""
+
+    previous_types = dict(previous_columns)
+    if any(name in previous_types and previous_types[name] != col_type for name, col_type in columns):
+        return None
+
+    # for partitioned tables the columns of the existing partitions have to change as well
+    cascade = " cascade" if partitions else ""
+    if columns[:len(previous_columns)] == previous_columns:
+        fields_decl = _fields_decl(columns[len(previous_columns):])
+        return "alter table `{}` add columns ({}){};".format(table_name, fields_decl, cascade)
+
+    return "alter table `{}` replace columns ({}){};".format(table_name, _fields_decl(columns), cascade)
+
+
+def _create_table_sql(table_name, columns, location, partitions):
+    create_decl = _create_external_table_sql(table_name, columns, location, partitions)
+    return "drop table if exists `{0}`; {1}; msck repair table `{0}`;".format(table_name, create_decl)
+
+
+def _create_external_table_sql(table_name, columns, location, partitions, if_not_exists=False):
+    fields_decl = _fields_decl(columns)
+
+    if partitions:
+        partition_columns = ", ".join(["`{}` string".format(p) for p in partitions])
+        partition_decl = " partitioned by ({})".format(partition_columns)
+    else:
+        partition_decl = ""
+
+    return "create external table {0}`{1}`({2}){3} stored as parquet location '{4}'".format(
+        "if not exists " if if_not_exists else "", table_name, fields_decl, partition_decl, location)
+
+
+def _fields_decl(columns):
+    return ", ".join(["`{}` {}".format(name, col_type) for name, col_type in columns])
+
+
+def _partition_spec(partition_dir):
+    values = re.findall("([^=/]+)=([^=/]+)", partition_dir)
+    return ", ".join(["`{}`='{}'".format(name, unquote(value).replace("'", "\\'")) for name, value in values])
+
+
+def _default_table_sql(columns, table_name, version_table_name, location, partitions, partition_dirs,
+                       default_table='table', schema_state=None):
+    if default_table == 'view':
+        return view_sql(table_name, version_table_name)
+
+    if default_table == 'location':
+        if schema_state is None and partitions:
+            sys.stderr.write("Recreating partitioned table {} instead of changing its location, which requires a "
+                             "schema state\n".format(table_name))
+        previous = schema_state.get(table_name) if schema_state is not None else None
+        sql = swap_location_sql(columns, table_name, location, partitions, partition_dirs, previous)
+        if schema_state is not None:
+            schema_state.set(table_name, columns, location, partitions, partition_dirs)
+        return sql
+
+    return _table_sql(columns, table_name, location, partitions, schema_state)
+
+
+def _table_sql(columns, table_name, location, partitions, schema_state=None):
+    if schema_state is None:
+        return _create_table_sql(table_name, columns, location, partitions)
+
+    sql = schema_diff_sql(columns, table_name, location, partitions, schema_state.get(table_name))
+    schema_state.set(table_name, columns, location, partitions)
+    return sql
+
+
+def _schema_entry(columns, location, partitions, partition_dirs=None):
+    return {
+        'columns': [list(column) for column in columns],
+        'location': location,
+        'partitions': list(partitions),
+        'partition_dirs': sorted(partition_dirs) if partition_dirs is not None else None,
+    }
+
+
+class SchemaState(object):
+    """Definitions of the tables created by previous runs, keyed by table name.
+
+    This stands in for the metastore when deciding how to update a table. When `path` is given the state is
+    loaded from that JSON file, and `save` writes it back. `stage` gives a `StagedSchemaState` to record the
+    changes of a dataset, which only reach this state when committed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = {}
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.tables = json.load(f)
+
+    def get(self, table_name):
+        with self._lock:
+            return self.tables.get(table_name)
+
+    def set(self, table_name, columns, location, partitions, partition_dirs=None):
+        """Record the definition of a table, and the partition directories registered for it if `partition_dirs`
+        isn't None."""
+        with self._lock:
+            self.tables[table_name] = _schema_entry(columns, location, partitions, partition_dirs)
+
+    def stage(self):
+        return StagedSchemaState(self)
+
+    def update(self, tables):
+        with self._lock:
+            self.tables.update(tables)
+
+    def save(self):
+        with self._lock:
+            _write_json_atomically(self.path, self.tables)
+
+
+class StagedSchemaState(object):
+    """Changes to a `SchemaState`, or to another `StagedSchemaState`, kept apart until `commit` applies them.
+
+    Tables not changed here are read from `parent`.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.tables = {}
+
+    def get(self, table_name):
+        if table_name in self.tables:
+            return self.tables[table_name]
+        return self.parent.get(table_name)
+
+    def set(self, table_name, columns, location, partitions, partition_dirs=None):
+        self.tables[table_name] = _schema_entry(columns, location, partitions, partition_dirs)
+
+    def stage(self):
+        return StagedSchemaState(self)
+
+    def update(self, tables):
+        self.tables.update(tables)
+
+    def commit(self):
+        self.parent.update(self.tables)
+        self.tables = {}
+
+
+class Checkpoint(object):
+    """Records the datasets loaded so far and the statements emitted for them, so that a run can be resumed.
+
+    The checkpoint is a log of JSON records, one per line, appended to after every dataset, and `schema_state`
+    is saved along with it since the statements depend on it. Only the tables of the datasets recorded here are
+    saved, so the tables of a dataset are committed to `schema_state` by `complete`. Statements are re-emitted by
+    resumed runs until they have been delivered, i.e. returned by `load_prefix` or `load_batch`, so that those of a
+    run which was killed aren't lost. Once a run got through every dataset, `finish` removes the checkpoint so that
+    the next run starts over, which also retries the datasets that failed.
+    """
+
+    def __init__(self, path, resume=False, schema_state=None):
+        self.path = path
+        self.schema_state = schema_state
+        self.datasets = {}
+        self._log = None
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # the last record of a run killed while writing it
+                    if 'location' in record:
+                        self.datasets[record['location']] = {'bash_cmd': record['bash_cmd'],
+                                                             'delivered': record['delivered']}
+                    else:
+                        for location in record['delivered']:
+                            self.datasets[location]['delivered'] = True
+
+    def get(self, location):
+        with self._lock:
+            return self.datasets.get(location)
+
+    def complete(self, location, bash_cmd, staged_state=None):
+        """Record the statements of a dataset, and commit `staged_state`, the changes of its tables."""
+        with self._lock:
+            if staged_state is not None:
+                staged_state.commit()
+            if self.schema_state is not None and self.schema_state.path is not None:
+                self.schema_state.save()
+            self._append({'location': location, 'bash_cmd': bash_cmd, 'delivered': False})
+            self.datasets[location] = {'bash_cmd': bash_cmd, 'delivered': False}
+
+    def deliver(self, locations):
+        with self._lock:
+            locations = [location for location in locations if location in self.datasets]
+            self._append({'delivered': locations})
+            for location in locations:
+                self.datasets[location]['delivered'] = True
+
+    def finish(self):
+        """Remove the checkpoint of a run which got through every dataset."""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.datasets = {}
+
+    def _append(self, record):
+        if self._log is None:
+            # the log starts over from the datasets loaded when resuming, which also drops a partly written record
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as f:
+                for location, dataset in sorted(self.datasets.items()):
+                    f.write(json.dumps(dict(dataset, location=location), sort_keys=True) + '\n')
+            os.rename(tmp_path, self.path)
+            self._log = open(self.path, 'a')
+
+        self._log.write(json.dumps(record, sort_keys=True) + '\n')
+        self._log.flush()
+
+
+class RunStats(object):
+    """Records how long each dataset took to load, and the runtime of the whole run, for `--stats`.
+
+    Its `costs` can be given back to `shard_datasets` to balance the shards of later runs.
+    """
+
+    def __init__(self, shard=None):
+        self.shard = shard
+        self.start = time.time()
+        self.costs = {}
+        self.errors = []
+        self.remaining = []
+        self._lock = threading.Lock()
+
+    def record(self, location, seconds):
+        with self._lock:
+            self.costs[location] = round(seconds, 3)
+
+    def record_error(self, location):
+        with self._lock:
+            self.errors.append(location)
+
+    def record_remaining(self, locations):
+        """Record the datasets left for a resumed run."""
+        with self._lock:
+            self.remaining.extend(locations)
+
+    def to_dict(self):
+        with self._lock:
+            return {'shard': None if self.shard is None else '{}/{}'.format(*self.shard),
+                    'runtime': round(time.time() - self.start, 3),
+                    'datasets': len(self.costs),
+                    'errors': sorted(self.errors),
+                    'remaining': sorted(self.remaining),
+                    'costs': dict(self.costs),
+                    'rate_limiting': _rate_limiter.stats() if _rate_limiter is not None else None,
+                    'hedging': _hedger.stats() if _hedger is not None else None,
+                    'listing_cache': _listing_cache.stats() if _listing_cache is not None else None}
+
+    def save(self, path):
+        _write_json_atomically(path, self.to_dict())
+
+
+def _write_json_atomically(path, obj):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+class SchemaTree(object):
+    """The tree of the flat list of `SchemaElement`s of a footer, read in place.
+
+    `ends[i]` is the index following the last descendant of element `i`, so that the children of an element are
+    found by skipping from one sibling to the next, without copying or converting any element.
+    """
+    __slots__ = ('elements', 'ends')
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.ends = array.array('l', [len(elements)]) * len(elements)
+
+        open_groups = []  # [index, children left] of the groups whose children are still being read
+        for i, element in enumerate(elements):
+            if open_groups:
+                open_groups[-1][1] -= 1
+            if element.num_children:
+                open_groups.append([i, element.num_children])
+                continue
+
+            self.ends[i] = i + 1
+            while open_groups and open_groups[-1][1] == 0:
+                self.ends[open_groups.pop()[0]] = i + 1
+
+    def node(self, index):
+        return SchemaNode(self, index)
+
+    def fields(self):
+        """The top-level fields, i.e. the children of the root element."""
+        return self.node(0).children()
+
+
+class SchemaNode(object):
+    """An element of a `SchemaTree`; its type, repetition and converted type are those of `element`."""
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def element(self):
+        return self.tree.elements[self.index]
+
+    def children(self):
+        children, i, end = [], self.index + 1, self.tree.ends[self.index]
+        while i < end:
+            children.append(SchemaNode(self.tree, i))
+            i = self.tree.ends[i]
+        return children
+
+
+def _fields_to_elements(fields):
+    """Flatten fields as returned by `build_tree` back into `SchemaElement`s.
+
+    Type names unknown to `Type` are kept as they are, so that `sql_type` can report them.
+    """
+    elements = []
+    for field in fields:
+        children = field['children']
+        elements.append(SchemaElement(
+            name=field['name'],
+            type=None if field['type'] == 'group' else Type._NAMES_TO_VALUES.get(field['type'].upper(), field['type']),
+            repetition_type=FieldRepetitionType._NAMES_TO_VALUES[field['repetition_type'].upper()],
+            converted_type=None if field['converted_type'] is None else ConvertedType._NAMES_TO_VALUES[field['converted_type'].upper()],
+            num_children=None if children is None else len(children),
+            scale=field.get('scale'),
+            precision=field.get('precision')))
+        if children is not None:
+            elements.extend(_fields_to_elements(children))
+    return elements
 
 
 def build_tree(schema, children):
+    """Convert flat `SchemaElement`s into nested dicts; `SchemaTree` reads them in place instead."""
     retval = []
 
     for _ in range(children):
@@ -284,57 +1774,229 @@ def build_tree(schema, children):
     return retval
 
 
-def sql_type(elem):
+def sql_type(elem, required=False):
+    """Get the Hive type of a `SchemaNode`, or of a field as returned by `build_tree`.
+
+    A repeated element is an array of its values, unless `required` is set as it is for the elements of lists.
+    """
+    node = elem if isinstance(elem, SchemaNode) else SchemaTree(_fields_to_elements([elem])).node(0)
+    element = node.element
+
     # list type
-    if elem['type'] == 'group' and elem['converted_type'] == 'list':
-        child = elem['children'][0]
+    if element.type is None and element.converted_type == ConvertedType.LIST:
+        child = node.children()[0]
 
         # if the repeated field is not a group, then its type is the element type and elements are required
-        if child['type'] != 'group':
-            child['repetition_type'] = 'required'
-            return 'array<{}>'.format(sql_type(child))
+        if child.element.type is not None:
+            return 'array<{}>'.format(sql_type(child, required=True))
 
         # if the repeated field is a group with multiple fields, then its type is the element type and elements are required
-        if child['type'] == 'group' and len(child['children']) > 1:
-            child['repetition_type'] = 'required'
-            return 'array<{}>'.format(sql_type(child))
+        grandchildren = child.children()
+        if len(grandchildren) > 1:
+            return 'array<{}>'.format(sql_type(child, required=True))
 
         # if the repeated field is a group with one field and is named either array or uses the LIST-annotated group's
         # name with _tuple appended then the repeated type is the element type and elements are required
-        if child['type'] == 'group' and len(child['children']) == 1 and child['name'] in ('array', elem['name'] + '_tuple'):
-            child['repetition_type'] = 'required'
-            return 'array<{}>'.format(sql_type(child))
+        if len(grandchildren) == 1 and child.element.name in ('array', element.name + '_tuple'):
+            return 'array<{}>'.format(sql_type(child, required=True))
 
-        return 'array<{}>'.format(sql_type(child['children'][0]))
+        return 'array<{}>'.format(sql_type(grandchildren[0]))
 
     # map type
-    if elem['type'] == 'group' and elem['converted_type'] in ('map', 'map_key_value'):
-        key, val = elem['children'][0]['children']
+    if element.type is None and element.converted_type in (ConvertedType.MAP, ConvertedType.MAP_KEY_VALUE):
+        key, val = node.children()[0].children()
         return 'map<{},{}>'.format(sql_type(key), sql_type(val))
 
     # struct type
-    if elem['type'] == 'group' and elem['converted_type'] is None:
-        subs = ['`{}`: {}'.format(sub['name'], sql_type(sub)) for sub in elem['children']]
+    if element.type is None and element.converted_type is None:
+        subs = ['`{}`: {}'.format(sub.element.name, sql_type(sub)) for sub in node.children()]
         return 'struct<{}>'.format(', '.join(subs))
 
     # unannotated repeated type
-    if elem['repetition_type'] == 'repeated':
-        elem['repetition_type'] = 'required'
-        return 'array<{}>'.format(sql_type(elem))
+    if element.repetition_type == FieldRepetitionType.REPEATED and not required:
+        return 'array<{}>'.format(sql_type(node, required=True))
 
     # byte_array type + utf8 converted_type = string
-    if elem['type'] == 'byte_array' and elem['converted_type'] == 'utf8':
+    if element.type == Type.BYTE_ARRAY and element.converted_type == ConvertedType.UTF8:
         return 'string'
 
     # decimal type
-    if elem['type'] == 'fixed_len_byte_array' and elem['converted_type'] == 'decimal':
-        return 'decimal({},{})'.format(elem['precision'], elem['scale'])
+    if element.type == Type.FIXED_LEN_BYTE_ARRAY and element.converted_type == ConvertedType.DECIMAL:
+        return 'decimal({},{})'.format(element.precision, element.scale)
 
     # conversion map
-    if elem['type'] in CONVERSIONS:
-        return CONVERSIONS[elem['type']]
+    if element.type in _TYPE_CONVERSIONS:
+        return _TYPE_CONVERSIONS[element.type]
 
-    raise UnknownParquetTypeError('Unknown type ' + elem['type'])
+    raise UnknownParquetTypeError('Unknown type ' + _type_name(element.type))
+
+
+def _type_name(parquet_type):
+    if parquet_type is None:
+        return 'group'
+    return Type._VALUES_TO_NAMES.get(parquet_type, str(parquet_type)).lower()
+
+
+def set_rate_limiter(rate_limiter):
+    """Send every S3 request through `rate_limiter`, a `ratelimit.RateLimiter`, or directly if None.
+
+    Clients created while a rate limiter is set don't retry on their own, so that throttled requests are seen
+    and retried by the rate limiter.
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+    with _clients_lock:
+        _clients.clear()
+
+
+def set_hedger(hedger):
+    """Hedge the requests reading footers with `hedger`, a `hedge.Hedger`, or don't if None."""
+    global _hedger
+    _hedger = hedger
+
+
+def set_listing_cache(listing_cache):
+    """Read and write listings through `listing_cache`, a `listcache.ListingCache`, or always list if None."""
+    global _listing_cache
+    _listing_cache = listing_cache
+
+
+def set_columnar_listing(columnar_listing):
+    """Gather the listings of versions into NumPy columns if `columnar_listing` is set, see `columnar.ListingTable`.
+
+    Listings which sample files for statistics or gather a layout report are still processed object by object.
+    """
+    global _columnar_listing
+    if columnar_listing and not columnar.available():
+        raise ImportError('the columnar listing needs numpy')
+    _columnar_listing = columnar_listing
+
+
+def set_listing_fetch(fetch):
+    """List versions by fetching the raw XML of presigned ListObjectsV2 URLs with `fetch`, e.g. `listxml.fetch`, see
+    `listxml.list_objects`, or through botocore if None.
+
+    Listings gathered into columns, see `set_columnar_listing`, still go through botocore.
+    """
+    global _listing_fetch
+    _listing_fetch = fetch
+
+
+def set_max_workers(max_workers, max_io_workers=None):
+    """Set the number of datasets processed concurrently, and optionally of concurrent requests made for them."""
+    with _executors_lock:
+        _max_workers['datasets'] = max_workers
+        if max_io_workers is not None:
+            _max_workers['io'] = max_io_workers
+        for executor in _executors.values():
+            executor.shutdown(wait=False)
+        _executors.clear()
+
+
+def clear_caches():
+    """Forget the S3 clients, regions of buckets, footers and _SUCCESS objects seen so far."""
+    with _clients_lock:
+        _clients.clear()
+    with _bucket_regions_lock:
+        _bucket_regions.clear()
+        _bucket_region_locks.clear()
+    _read_cached_schema.cache_clear()
+    _read_cached_summary_schema.cache_clear()
+    check_success_exists.cache_clear()
+
+
+def _get_executor(name):
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=_max_workers[name])
+        return _executors[name]
+
+
+def _get_client(bucket=None):
+    """Get the client for the region of `bucket`, so that its requests aren't redirected, or of the default region."""
+    region = _get_bucket_region(bucket) if bucket is not None else None
+    with _clients_lock:
+        if None not in _clients:
+            _clients[None] = boto3.client('s3', config=_client_config())
+        if region == _clients[None].meta.region_name:
+            region = None
+        if region not in _clients:
+            _clients[region] = boto3.client('s3', region_name=region, config=_client_config())
+        return _clients[region]
+
+
+def _get_bucket_region(bucket):
+    """The region of `bucket`, from a HEAD bucket request or otherwise GetBucketLocation, or None if neither tells."""
+    with _bucket_regions_lock:
+        if bucket in _bucket_regions:
+            return _bucket_regions[bucket]
+        lock = _bucket_region_locks.setdefault(bucket, threading.Lock())
+
+    with lock:
+        with _bucket_regions_lock:
+            if bucket in _bucket_regions:
+                return _bucket_regions[bucket]
+
+        region = _look_up_bucket_region(_get_client(), bucket)
+        with _bucket_regions_lock:
+            _bucket_regions[bucket] = region
+        return region
+
+
+def _look_up_bucket_region(client, bucket):
+    try:
+        response = _s3_call(bucket, '', client.head_bucket, Bucket=bucket)
+    except botocore.exceptions.ClientError as e:
+        # the redirect of a bucket in another region still has its region
+        response = e.response
+    region = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+    if region is not None:
+        return region
+
+    try:
+        location = _s3_call(bucket, '', client.get_bucket_location, Bucket=bucket)['LocationConstraint']
+    except botocore.exceptions.ClientError:
+        return None
+    # buckets in us-east-1 have no location constraint, and the oldest ones in eu-west-1 have 'EU'
+    return {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+
+
+def _s3_call(bucket, key, fn, *args, **kwargs):
+    if _rate_limiter is None:
+        return fn(*args, **kwargs)
+    return _rate_limiter.call(bucket, key, fn, *args, **kwargs)
+
+
+def _client_config():
+    if _rate_limiter is None:
+        return None
+    return botocore.config.Config(retries={'max_attempts': 0})
+
+
+def _list_objects(client, bucket, prefix):
+    for response in _list_pages(client, bucket, prefix):
+        for summary in response.get('Contents', []):
+            yield summary
+
+
+def _list_common_prefixes(client, bucket, prefix):
+    for response in _list_pages(client, bucket, prefix, delimiter='/'):
+        for common_prefix in response.get('CommonPrefixes', []):
+            yield common_prefix['Prefix']
+
+
+def _list_pages(client, bucket, prefix, delimiter=None):
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+
+    while True:
+        response = _s3_call(bucket, prefix, client.list_objects_v2, **kwargs)
+        yield response
+
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
 
 
 def _remove_trailing_backslash(location):
@@ -353,9 +2015,13 @@ def _get_bucket_and_prefix(s3_loc):
 def _get_common_prefixes(bucket, prefix=''):
     if prefix:
         prefix = _remove_trailing_backslash(prefix) + '/'
-    client = boto3.client('s3')
-    result = client.list_objects(Bucket=bucket, Prefix=prefix, Delimiter='/')
-    return [prefix.get('Prefix') for prefix in result.get('CommonPrefixes', [])]
+    return _cached_listing('datasets', [bucket, prefix], lambda: list(_list_common_prefixes(_get_client(bucket), bucket, prefix)))
+
+
+def _cached_listing(level, key, fn):
+    if _listing_cache is None:
+        return fn()
+    return _listing_cache.cached(level, key, fn)
 
 
 def _normalize_table_name(table_name):
@@ -0,0 +1,97 @@
+"""An index of the partition directories of a version, built while listing it."""
+
+import re
+
+
+class PartitionNode(object):
+    """A directory: the number, total size and newest modification time of the files directly in it, and whether
+    it has a _SUCCESS file."""
+    __slots__ = ('children', 'files', 'size', 'last_modified', 'success')
+
+    def __init__(self):
+        self.children = None
+        self.files = 0
+        self.size = 0
+        self.last_modified = None
+        self.success = False
+
+
+class PartitionTrie(object):
+    """The directories of a version as a tree with a level per `name=value` directory.
+
+    Directories are given relative to the version, '' being the version itself. Each directory name is stored once
+    per trie however many directories share it, e.g. every `sample_id=1`, and files are only counted, so the index
+    takes memory in proportion to the number of directories rather than of files.
+    """
+    __slots__ = ('root', 'directories', '_names')
+
+    def __init__(self):
+        self.root = PartitionNode()
+        self.directories = 0
+        self._names = {}
+
+    def node(self, partition_dir, create=False):
+        """Get the node of a directory, creating it and its parents if `create` is set, otherwise None if there is none."""
+        node = self.root
+        if not partition_dir:
+            return node
+
+        for name in partition_dir.split('/'):
+            children = node.children
+            child = children.get(name) if children is not None else None
+            if child is None:
+                if not create:
+                    return None
+                if children is None:
+                    children = node.children = {}
+                child = children[self._names.setdefault(name, name)] = PartitionNode()
+            node = child
+        return node
+
+    def add(self, partition_dir, size, last_modified=None, files=1):
+        """Count a file of `size` bytes in a directory, or `files` files of `size` bytes in total."""
+        node = self.node(partition_dir, create=True)
+        if node.files == 0:
+            self.directories += 1
+        node.files += files
+        node.size += size
+        if last_modified is not None and (node.last_modified is None or last_modified > node.last_modified):
+            node.last_modified = last_modified
+        return node
+
+    def mark_success(self, partition_dir):
+        self.node(partition_dir, create=True).success = True
+
+    def success(self, partition_dir):
+        node = self.node(partition_dir)
+        return node is not None and node.success
+
+    def __len__(self):
+        """The number of directories with files in them."""
+        return self.directories
+
+    def items(self):
+        """Iterate over the `(directory, node)` of the directories with files in them, in order."""
+        for partition_dir, node, _ in self._walk():
+            if node.files:
+                yield partition_dir, node
+
+    def matching(self, partitions):
+        """Get the `[number of files, size]` of the directories below the version partitioned by exactly the
+        `partitions` columns, like `get_partitioning_fields` would find them."""
+        partitions = list(partitions)
+        return dict((partition_dir, [node.files, node.size]) for partition_dir, node, fields in self._walk(partitions)
+                    if partition_dir and node.files and fields == partitions)
+
+    def _walk(self, partitions=None):
+        # depth first, skipping the directories whose partitioning fields can't lead to `partitions`
+        stack = [('', self.root, [])]
+        while stack:
+            partition_dir, node, fields = stack.pop()
+            yield partition_dir, node, fields
+
+            for name, child in sorted((node.children or {}).items(), reverse=True):
+                child_fields = fields + re.findall("([^=/]+)=[^=/]+", name)
+                if partitions is not None and child_fields != partitions[:len(child_fields)]:
+                    continue
+                stack.append((partition_dir + '/' + name if partition_dir else name, child, child_fields))
@@ -0,0 +1,170 @@
+"""Adaptive client-side rate limiting of S3 requests."""
+
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+# error codes S3 uses to ask clients to slow down
+THROTTLE_CODES = frozenset(['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                            'TooManyRequests', 'ServiceUnavailable', '503'])
+
+# errors S3 or the network may not repeat on a retry, besides throttles
+TRANSIENT_CODES = frozenset(['InternalError', 'RequestTimeout'])
+TRANSIENT_ERRORS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+
+def is_throttle(error):
+    """Whether a botocore `ClientError` is S3 asking us to slow down."""
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return False
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_CODES or status == 503
+
+
+def is_transient(error):
+    """Whether an error is worth retrying: a throttle, a server error or a failed connection."""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return False
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return is_throttle(error) or code in TRANSIENT_CODES or status >= 500
+
+
+class TokenBucket(object):
+    """Bounds the rate of requests to `rate` per second, allowing bursts of `burst` requests."""
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before it can be used."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveWindow(object):
+    """Bounds the number of requests in flight, sized by additive increase, multiplicative decrease.
+
+    Each fast, successful request grows the window by `1 / window`, i.e. by one per window worth of requests.
+    A throttled request multiplies it by `decrease` and a request slower than `latency_target` by `slow_decrease`.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, decrease=0.5, slow_decrease=0.9, latency_target=1.0):
+        self.size = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.slow_decrease = slow_decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= max(self.minimum, int(self.size)):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.size = max(self.minimum, self.size * self.decrease)
+            elif latency > self.latency_target:
+                self.size = max(self.minimum, self.size * self.slow_decrease)
+            else:
+                self.size = min(self.maximum, self.size + 1.0 / self.size)
+            self._cond.notify_all()
+
+
+class RateLimiter(object):
+    """Shares S3 request capacity between threads, per bucket and key prefix.
+
+    S3 scales request rates per key prefix, so every bucket and the first `prefix_depth` components of the key
+    get their own `TokenBucket` and `AdaptiveWindow`. Throttled requests, server errors and failed connections are
+    retried up to `max_retries` times, sleeping for a random time of up to `base_delay * 2 ** attempt` seconds
+    ("full jitter" backoff). Only throttles narrow the window.
+    """
+
+    def __init__(self, rate=3500, burst=None, prefix_depth=1, initial_window=8, max_window=64, latency_target=1.0,
+                 max_retries=8, base_delay=0.05, max_delay=20.0, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.prefix_depth = prefix_depth
+        self.initial_window = initial_window
+        self.max_window = max_window
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _get_limits(self, bucket, key):
+        partition = (bucket, '/'.join((key or '').split('/')[:self.prefix_depth]))
+        with self._lock:
+            if partition not in self._limits:
+                self._limits[partition] = (TokenBucket(self.rate, self.burst, self.clock),
+                                           AdaptiveWindow(self.initial_window, maximum=self.max_window,
+                                                          latency_target=self.latency_target))
+            return self._limits[partition]
+
+    def call(self, bucket, key, fn, *args, **kwargs):
+        """Call `fn`, a request to `key` in `bucket`, within the limits of its prefix."""
+        tokens, window = self._get_limits(bucket, key)
+
+        attempt = 0
+        while True:
+            with self._lock:
+                delay = tokens.reserve()
+                self.requests += 1
+            if delay > 0:
+                self.sleep(delay)
+
+            window.acquire()
+            start = self.clock()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttle(e)
+                window.release(self.clock() - start, throttled=throttled)
+                if throttled:
+                    with self._lock:
+                        self.throttles += 1
+                if not is_transient(e) or attempt >= self.max_retries:
+                    raise
+
+                with self._lock:
+                    self.retries += 1
+                self.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                attempt += 1
+            else:
+                window.release(self.clock() - start)
+                return result
+
+    def stats(self):
+        with self._lock:
+            windows = dict(('/'.join(partition), round(window.size, 2))
+                           for partition, (_, window) in self._limits.items())
+            return {'requests': self.requests, 'throttles': self.throttles, 'retries': self.retries, 'windows': windows}
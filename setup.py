@@ -9,8 +9,9 @@ setup(
     url='https://github.com/mozilla/parquet2hive',
     scripts=['parquet2hive'],
     packages=['parquet2hive_modules', 'parquet2hive_modules.parquet_format'],
-    install_requires=['boto3', 'functools32',
+    install_requires=['boto3', 'functools32', 'futures',
                       'thrift==0.10.0', 'boto>=2.36.0'],
+    extras_require={'columnar': ['numpy']},
     setup_requires=['pytest-runner', 'setuptools_scm'],
     tests_require=['pytest', 'moto', 'wheel[signatures]']
 )
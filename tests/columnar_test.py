@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+from parquet2hive_modules.columnar import ListingTable
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+def _page(keys, start=0):
+    return [{'Key': key, 'Size': 10 * (i + 1), 'LastModified': datetime(2017, 1, 1) + timedelta(hours=i)}
+            for i, key in enumerate(keys, start)]
+
+
+def _table():
+    table = ListingTable('churn/v1/', ignore=lambda key: '/_' in key)
+    table.add_page(_page(['churn/v1/day=1/_SUCCESS', 'churn/v1/day=1/part-0', 'churn/v1/day=1/part-1']))
+    table.add_page(_page(['churn/v1/day=2/part-0', 'churn/v1/part-0'], start=3))
+    return table
+
+
+class TestListingTable(object):
+
+    def test_columns(self):
+        table = _table()
+        assert len(table) == 4
+        assert [table.key(i) for i in range(len(table))] == ['churn/v1/day=1/part-0', 'churn/v1/day=1/part-1',
+                                                             'churn/v1/day=2/part-0', 'churn/v1/part-0']
+        assert table.sizes.tolist() == [20, 30, 40, 50]
+        assert [table.partitions[i] for i in table.partition_ids] == ['day=1', 'day=1', 'day=2', '']
+        assert [table.partitions[i] for i in table.success] == ['day=1']
+
+    def test_latest(self):
+        table = _table()
+        assert table.summary(table.latest()) == {'Key': 'churn/v1/part-0', 'Size': 50,
+                                                 'LastModified': datetime(2017, 1, 1, 4)}
+        assert table.latest(np.array([True, True, False, False])) == 1
+        assert table.latest(np.zeros(4, dtype=bool)) is None
+
+    def test_latest_ties(self):
+        table = ListingTable('churn/v1/')
+        table.add_page([{'Key': 'churn/v1/part-{}'.format(i), 'Size': 1, 'LastModified': datetime(2017, 1, 1)}
+                        for i in range(3)])
+        assert table.latest() == 0
+
+    def test_success_mask(self):
+        table = _table()
+        checked = []
+
+        def has_success(partition_dir):
+            checked.append(partition_dir)
+            return partition_dir == ''
+
+        assert table.success_mask(has_success).tolist() == [True, True, False, True]
+        assert sorted(checked) == ['', 'day=2']
+
+    def test_aggregate(self):
+        table = _table()
+        files, sizes, newest = table.aggregate()
+        partitions = dict((table.partitions[i], (files[i], sizes[i], table.last_modified(newest[i])))
+                          for i in files.nonzero()[0])
+        assert partitions == {'day=1': (2, 50, datetime(2017, 1, 1, 2)),
+                              'day=2': (1, 40, datetime(2017, 1, 1, 3)),
+                              '': (1, 50, datetime(2017, 1, 1, 4))}
+
+        files, sizes, _ = table.aggregate(np.array([False, True, True, False]))
+        assert files.sum() == 2 and sizes.sum() == 70
+
+    def test_empty(self):
+        table = ListingTable('churn/v1/')
+        table.add_page([])
+        assert len(table) == 0
+        assert table.latest() is None
+        assert table.aggregate()[0].sum() == 0
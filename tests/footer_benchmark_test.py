@@ -0,0 +1,29 @@
+from benchmarks import footer_benchmark
+from parquet2hive_modules import parquet2hivelib as lib
+
+
+class TestFooterBenchmark(object):
+
+    def test_run(self):
+        results = footer_benchmark.run(widths=[6], depths=[0, 1], row_groups=[1, 2], min_time=0)
+
+        assert len(results) == 2 * 3 * 2 * 2 * len(footer_benchmark.stages(footer_benchmark.generate_footer(1)))
+        assert all(result['ops_per_sec'] > 0 for result in results)
+
+    def test_generated_footers(self):
+        for list_encoding in footer_benchmark.LIST_ENCODINGS:
+            for map_encoding in footer_benchmark.MAP_ENCODINGS:
+                footer = footer_benchmark.generate_footer(6, 1, list_encoding, map_encoding, row_groups=2)
+                metadata = footer_benchmark._thrift_decode(footer)
+
+                # a leaf for each column and its id, and one more for the map keys
+                assert len(metadata.row_groups[0].columns) == 6 * 2 + 1
+                assert lib.parquet2sql(lib.parse_schema(footer), 't', 's3://b/t', []) == lib.parquet2sql(metadata.schema, 't', 's3://b/t', [])
+
+    def test_list_and_map_encodings(self):
+        columns = dict(lib.get_columns(footer_benchmark.generate_schema(6, list_encoding='two_level', map_encoding='map_key_value')[0]))
+        assert columns['c3'] == 'array<string>'
+        assert columns['c4'] == 'map<string,bigint>'
+
+        columns = dict(lib.get_columns(footer_benchmark.generate_schema(6, list_encoding='unannotated')[0]))
+        assert columns['c3'] == 'array<string>'
@@ -0,0 +1,87 @@
+from concurrent import futures
+from parquet2hive_modules import hedge
+import pytest
+import threading
+
+
+class StandIn(object):
+    """Answers immediately, except for the calls listed in `slow` which wait until cancelled."""
+
+    def __init__(self, slow=()):
+        self.slow = set(slow)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, cancelled):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call in self.slow:
+            cancelled.wait(5)
+            return None if cancelled.is_set() else 'slow'
+        return call
+
+
+def _hedger(**kwargs):
+    return hedge.Hedger(min_samples=5, min_delay=0.01, max_ratio=0.5, **kwargs)
+
+
+class TestHedger(object):
+
+    def test_no_hedging_before_samples(self):
+        hedger = _hedger()
+        stand_in = StandIn()
+        for _ in range(5):
+            hedger.call(stand_in)
+
+        assert stand_in.calls == 5
+        assert hedger.stats()['hedges'] == 0
+
+    def test_hedge_wins(self):
+        hedger = _hedger()
+        stand_in = StandIn(slow=[6])
+        for _ in range(5):
+            hedger.call(stand_in)
+
+        assert hedger.call(stand_in) == 7, 'Should return the result of the duplicate'
+        stats = hedger.stats()
+        assert (stats['requests'], stats['hedges'], stats['hedge_wins']) == (6, 1, 1)
+        assert stats['hedged_seconds'] < 1
+
+    def test_max_ratio(self):
+        hedger = _hedger()
+        stand_in = StandIn()
+        for _ in range(5):
+            hedger.call(stand_in)
+        hedger.hedges = 3
+
+        assert hedger.delay() is None, 'Should not hedge more than max_ratio of the calls'
+
+    def test_errors(self):
+        hedger = _hedger()
+        for _ in range(5):
+            hedger.call(StandIn())
+
+        def fail(cancelled):
+            raise ValueError('no such key')
+
+        with pytest.raises(ValueError):
+            hedger.call(fail)
+
+    def test_failure_finishing_with_success(self, monkeypatch):
+        hedger = _hedger()
+        for _ in range(5):
+            hedger.call(StandIn())
+
+        calls = []
+
+        def fail_first(cancelled):
+            calls.append(None)
+            if len(calls) == 1:
+                cancelled.wait(0.1)
+                raise ValueError('connection reset')
+            return 'hedged'
+
+        # let both calls finish before either is looked at
+        monkeypatch.setattr(hedge, 'wait', lambda fs, timeout=None, return_when=None: futures.wait(fs, timeout))
+        assert hedger.call(fail_first) == 'hedged', 'Should prefer the call that succeeded'
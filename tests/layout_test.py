@@ -0,0 +1,62 @@
+from parquet2hive_modules import layout
+
+MB = 1024 * 1024
+
+
+class TestSizeHistogram(object):
+
+    def test_percentiles(self):
+        histogram = layout.SizeHistogram()
+        for _ in range(99):
+            histogram.add(MB)
+        histogram.add(300 * MB)
+
+        assert histogram.count == 100
+        assert histogram.small_files == 99
+        assert MB <= histogram.percentile(0.5) < 2 * MB
+        assert histogram.percentile(0.99) < 2 * MB
+        assert histogram.percentile(1.0) == 300 * MB, 'Should not exceed the largest size seen'
+
+    def test_empty_files(self):
+        histogram = layout.SizeHistogram()
+        histogram.add(0)
+        assert histogram.to_dict()['histogram'] == [[0, 1]]
+        assert histogram.percentile(0.5) == 0
+
+    def test_merge(self):
+        a, b = layout.SizeHistogram(), layout.SizeHistogram()
+        a.add(MB)
+        b.add(MB)
+        b.add(512 * MB)
+        a.merge(b)
+
+        assert (a.count, a.total_size, a.small_files, a.max_size) == (3, 514 * MB, 2, 512 * MB)
+
+    def test_excess_files(self):
+        histogram = layout.SizeHistogram()
+        for _ in range(10):
+            histogram.add(MB)
+        assert histogram.excess_files() == 9
+
+        histogram = layout.SizeHistogram()
+        for _ in range(3):
+            histogram.add(layout.TARGET_FILE_SIZE)
+        assert histogram.excess_files() == 0
+
+
+class TestLayoutReport(object):
+
+    def test_compaction_candidates(self):
+        histograms = {}
+        for partition_dir, count in [('day=1', 2), ('day=2', 50), ('day=3', 1)]:
+            histograms[partition_dir] = layout.SizeHistogram()
+            for _ in range(count):
+                histograms[partition_dir].add(MB)
+
+        report = layout.LayoutReport()
+        report.add('s3://bucket/churn', 'v1', histograms)
+
+        version = report.to_dict()['versions'][0]
+        assert version['files'] == 53
+        assert [p['partition'] for p in version['partitions']] == ['day=1', 'day=2', 'day=3']
+        assert version['compaction_candidates'] == ['day=2', 'day=1']
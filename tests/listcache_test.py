@@ -0,0 +1,93 @@
+from parquet2hive_modules import listcache
+import os
+import threading
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestListingCache(object):
+
+    def test_cached(self, tmpdir):
+        clock = Clock()
+        cache = listcache.ListingCache(str(tmpdir.join('cache')), clock=clock)
+        calls = []
+
+        def list_versions():
+            calls.append(None)
+            return ['churn/v1/', 'churn/v2/']
+
+        assert cache.cached('versions', ['bucket', 'churn/'], list_versions) == ['churn/v1/', 'churn/v2/']
+        assert cache.cached('versions', ['bucket', 'churn/'], list_versions) == ['churn/v1/', 'churn/v2/']
+        assert len(calls) == 1
+        assert cache.stats() == {'hits': 1, 'misses': 1}
+
+    def test_shared_between_instances(self, tmpdir):
+        path = str(tmpdir.join('cache'))
+        listcache.ListingCache(path).put('datasets', ['bucket', ''], ['churn/'])
+        assert listcache.ListingCache(path).get('datasets', ['bucket', '']) == ['churn/']
+
+    def test_keys(self, tmpdir):
+        cache = listcache.ListingCache(str(tmpdir))
+        cache.put('versions', ['bucket', 'churn/'], ['churn/v1/'])
+        assert cache.get('versions', ['bucket', 'main_summary/']) is None
+        assert cache.get('datasets', ['bucket', 'churn/']) is None
+        assert cache.get('versions', ['other-bucket', 'churn/']) is None
+
+    def test_ttls(self, tmpdir):
+        clock = Clock()
+        cache = listcache.ListingCache(str(tmpdir), ttls={'versions': 60, 'version': 10}, clock=clock)
+        cache.put('versions', ['bucket', 'churn/'], ['churn/v1/'])
+        cache.put('version', ['bucket', 'churn/v1/'], {'num_files': 1})
+
+        clock.now += 30
+        assert cache.get('versions', ['bucket', 'churn/']) == ['churn/v1/']
+        assert cache.get('version', ['bucket', 'churn/v1/']) is None
+
+        clock.now += 31
+        assert cache.get('versions', ['bucket', 'churn/']) is None
+
+    def test_max_staleness(self, tmpdir):
+        clock = Clock()
+        cache = listcache.ListingCache(str(tmpdir), max_staleness=5, clock=clock)
+        assert cache.ttl('datasets') == 5
+
+        cache.put('datasets', ['bucket', ''], ['churn/'])
+        clock.now += 6
+        assert cache.get('datasets', ['bucket', '']) is None
+
+    def test_unreadable_entry(self, tmpdir):
+        cache = listcache.ListingCache(str(tmpdir))
+        cache.put('datasets', ['bucket', ''], ['churn/'])
+        for name in os.listdir(str(tmpdir)):
+            with open(os.path.join(str(tmpdir), name), 'w') as f:
+                f.write('{"key": ')
+
+        assert cache.get('datasets', ['bucket', '']) is None
+        assert cache.cached('datasets', ['bucket', ''], lambda: ['main_summary/']) == ['main_summary/']
+        assert cache.get('datasets', ['bucket', '']) == ['main_summary/']
+
+    def test_concurrent_writes(self, tmpdir):
+        cache = listcache.ListingCache(str(tmpdir))
+        listings = [['churn/v{}/'.format(i)] * 100 for i in range(8)]
+        reads = []
+
+        def write(listing):
+            for _ in range(20):
+                cache.put('versions', ['bucket', 'churn/'], listing)
+                reads.append(cache.get('versions', ['bucket', 'churn/']))
+
+        threads = [threading.Thread(target=write, args=(listing,)) for listing in listings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert all(listing in listings for listing in reads), 'Should only read whole listings'
+        assert len(os.listdir(str(tmpdir))) == 1, 'Should not leave temporary files behind'
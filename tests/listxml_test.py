@@ -0,0 +1,166 @@
+from moto import mock_s3
+from parquet2hive_modules import listxml
+from six.moves.urllib.parse import parse_qs, urlparse
+import boto3
+import botocore.exceptions
+import botocore.utils
+import io
+import pytest
+import threading
+
+bucket_name = 'test-bucket'
+
+# query arguments of a presigned ListObjectsV2 URL and the parameters botocore takes for them
+QUERY_PARAMS = {'prefix': 'Prefix', 'continuation-token': 'ContinuationToken', 'encoding-type': 'EncodingType',
+                'max-keys': 'MaxKeys'}
+
+
+def botocore_fetch(client):
+    """Get a stand-in for `listxml.fetch` which serves the XML botocore receives for the same listing through `client`,
+    since not every version of moto intercepts HTTP requests made without botocore."""
+    lock = threading.Lock()
+
+    def fetch(url):
+        query = parse_qs(urlparse(url).query)
+        params = dict((QUERY_PARAMS[arg], values[0]) for arg, values in query.items() if arg in QUERY_PARAMS)
+        if 'MaxKeys' in params:
+            params['MaxKeys'] = int(params['MaxKeys'])
+
+        responses = []
+
+        def capture(http_response, **kwargs):
+            responses.append(http_response)
+
+        with lock:
+            client.meta.events.register('after-call.s3.ListObjectsV2', capture)
+            try:
+                client.list_objects_v2(Bucket=bucket_name, **params)
+            finally:
+                client.meta.events.unregister('after-call.s3.ListObjectsV2', capture)
+        return responses[0].status_code, io.BytesIO(responses[0].content)
+
+    return fetch
+
+
+def _setup_bucket(keys):
+    client = boto3.client('s3')
+    client.create_bucket(Bucket=bucket_name)
+    for key in keys:
+        client.put_object(Bucket=bucket_name, Key=key, Body=b'x' * len(key))
+    return client
+
+
+def _botocore_listing(client, prefix):
+    paginator = client.get_paginator('list_objects_v2')
+    return [(summary['Key'], summary['Size'], summary['LastModified'])
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 3})
+            for summary in page.get('Contents', [])]
+
+
+class TestListObjects(object):
+
+    @mock_s3
+    def test_same_as_botocore(self):
+        keys = ['churn/v1/_SUCCESS', 'churn/v1/submission_date=20170101/part-0', 'churn/v1/submission_date=20170102/part-0',
+                u'churn/v1/country=Dé/part 1+2', 'churn/v2/part-0', 'other/v1/part-0']
+        client = _setup_bucket(keys)
+
+        listed = list(listxml.list_objects(client, bucket_name, 'churn/v1/', botocore_fetch(client)))
+        expected = _botocore_listing(client, 'churn/v1/')
+        assert [(key, size) for key, size, _ in listed] == [(key, size) for key, size, _ in expected]
+        assert [botocore.utils.parse_timestamp(last_modified) for _, _, last_modified in listed] == [
+            last_modified for _, _, last_modified in expected]
+
+    @mock_s3
+    def test_continuation(self, monkeypatch):
+        client = _setup_bucket(['churn/v1/part-{}'.format(i) for i in range(5)])
+        monkeypatch.setattr(client, 'generate_presigned_url', _max_keys(client.generate_presigned_url, 2))
+        urls = []
+        served = botocore_fetch(client)
+
+        def fetch(url):
+            urls.append(url)
+            return served(url)
+
+        assert [key for key, _, _ in listxml.list_objects(client, bucket_name, 'churn/', fetch)] == [
+            'churn/v1/part-{}'.format(i) for i in range(5)]
+        assert len(urls) == 3
+
+    @mock_s3
+    def test_empty(self):
+        client = _setup_bucket([])
+        assert list(listxml.list_objects(client, bucket_name, 'churn/', botocore_fetch(client))) == []
+
+    def test_error(self):
+        def fetch(url):
+            return 503, io.BytesIO(b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>')
+
+        with pytest.raises(botocore.exceptions.ClientError) as e:
+            listxml.read_page(fetch, 'https://test-bucket.s3.amazonaws.com/')
+        assert e.value.response['Error']['Code'] == 'SlowDown'
+        assert e.value.response['ResponseMetadata']['HTTPStatusCode'] == 503
+
+    @mock_s3
+    def test_retries(self, monkeypatch):
+        client = _setup_bucket(['churn/v1/part-0'])
+        monkeypatch.setattr(listxml, 'BASE_DELAY', 0)
+        responses = [(503, io.BytesIO(b'<Error><Code>SlowDown</Code></Error>')),
+                     (500, io.BytesIO(b'<Error><Code>InternalError</Code></Error>'))]
+        served = botocore_fetch(client)
+
+        def fetch(url):
+            return responses.pop(0) if responses else served(url)
+
+        assert [key for key, _, _ in listxml.list_objects(client, bucket_name, 'churn/', fetch)] == ['churn/v1/part-0']
+
+    @mock_s3
+    def test_gives_up(self, monkeypatch):
+        client = _setup_bucket([])
+        monkeypatch.setattr(listxml, 'BASE_DELAY', 0)
+        urls = []
+
+        def fetch(url):
+            urls.append(url)
+            return 500, io.BytesIO(b'<Error><Code>InternalError</Code></Error>')
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            list(listxml.list_objects(client, bucket_name, 'churn/', fetch))
+        assert len(urls) == listxml.MAX_ATTEMPTS
+
+    def test_other_errors_are_not_retried(self):
+        urls = []
+
+        def fetch(url):
+            urls.append(url)
+            return 403, io.BytesIO(b'<Error><Code>AccessDenied</Code></Error>')
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            listxml.retry(listxml.read_page, fetch, 'https://test-bucket.s3.amazonaws.com/')
+        assert len(urls) == 1
+
+
+class TestFetch(object):
+
+    def test_shared_session(self, monkeypatch):
+        sent = []
+
+        class Response(object):
+            status_code = 200
+            content = b'<ListBucketResult/>'
+
+        class Session(object):
+            def send(self, request):
+                sent.append((request.method, request.url))
+                return Response()
+
+        monkeypatch.setattr(listxml, '_session', Session())
+        status, body = listxml.fetch('https://test-bucket.s3.amazonaws.com/?list-type=2')
+        assert (status, body.read()) == (200, b'<ListBucketResult/>')
+        assert listxml._get_session() is listxml._session
+        assert sent == [('GET', 'https://test-bucket.s3.amazonaws.com/?list-type=2')]
+
+
+def _max_keys(generate_presigned_url, max_keys):
+    def generate(operation, Params):
+        return generate_presigned_url(operation, Params=dict(Params, MaxKeys=max_keys))
+    return generate
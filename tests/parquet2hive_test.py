@@ -1,8 +1,21 @@
+from listxml_test import botocore_fetch
 from moto import mock_s3
 from parquet2hive_modules import parquet2hivelib as lib
+from parquet2hive_modules.hedge import Hedger
+from parquet2hive_modules.layout import LayoutReport
+from parquet2hive_modules.listcache import ListingCache
+from parquet2hive_modules.ratelimit import RateLimiter
+from parquet2hive_modules.parquet_format.ttypes import (ColumnChunk, ColumnMetaData, ConvertedType, FieldRepetitionType, FileMetaData,
+                                                        KeyValue, RowGroup, SchemaElement, SortingColumn, Statistics, Type)
+from thrift.protocol import TCompactProtocol
+from thrift.transport import TTransport
 from time import sleep
 import boto3
 import pytest
+import random
+import re
+import struct
+import threading
 import unittest
 
 
@@ -24,6 +37,14 @@ def _setup_module():
     new_dataset_file = 'tests/dataset-new.parquet'
     complex_file = 'tests/complex.parquet'
     lib.check_success_exists.cache_clear()
+    lib.clear_caches()
+
+
+def _head_bucket_region(client, bucket):
+    """Stands in for `_look_up_bucket_region` with a single HEAD bucket request, since not every version of moto
+    sends the region header which spares the GetBucketLocation request."""
+    lib._s3_call(bucket, '', client.head_bucket, Bucket=bucket)
+    return 'us-east-1'
 
 
 class TestLoadBucket(object):
@@ -89,6 +110,36 @@ class TestLoadBucket(object):
         assert 'create external table `frank`' in bash_cmd
 
 
+    @mock_s3
+    def test_load_prefix_nested(self):
+        _setup_module()
+
+        objects = ['temp/churn/v1/parquet', 'prod/frank/v1/parquet', 'prod/nested/main/v2/parquet', 'prod/nested/main/deeper/v1/parquet']
+        for o in objects:
+            s3_client.put_object(Bucket=bucket_name, Key=o, Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, max_depth=3)
+        assert 'create external table `churn_v1`' in bash_cmd
+        assert 'create external table `frank_v1`' in bash_cmd
+        assert 'create external table `main_v2`' in bash_cmd
+        assert 'create external table `deeper_v1`' not in bash_cmd, 'Should not go deeper than max depth'
+
+    @mock_s3
+    def test_find_datasets(self):
+        _setup_module()
+
+        objects = ['temp/churn/v1/parquet', 'temp/churn/v1/nested/v2/parquet', 'temp/churn/other/v3/parquet', 'temp/file']
+        for o in objects:
+            s3_client.put_object(Bucket=bucket_name, Key=o, Body=b'teststring')
+
+        assert lib.find_datasets(bucket_name, 'temp', max_depth=1) == ['temp/churn/']
+        assert lib.find_datasets(bucket_name, 'temp', max_depth=5) == ['temp/churn/', 'temp/churn/other/'], 'Should not descend into versions'
+
+        listings = {}
+        lib.find_datasets(bucket_name, 'temp', max_depth=1, listings=listings)
+        assert listings == {'temp/': ['temp/churn/'], 'temp/churn/': ['temp/churn/other/', 'temp/churn/v1/']}
+
+
 class TestGetBashCmd(object):
 
     @mock_s3
@@ -121,6 +172,15 @@ class TestGetBashCmd(object):
         assert bash_cmd.startswith('hive -e \''), 'Should be a valid hive command'
         assert 'location \'"\'"\'{}\'"\'"\''.format(location) in bash_cmd, 'Should have correct location'
 
+    def test_long_hive_output(self):
+        sql = ' '.join(["alter table `churn` partition (`submission_date`='{}') set location "
+                        "'s3://test-bucket/churn/v2/submission_date={}';".format(i, i) for i in range(1000)])
+        bash_cmd = lib._format_sql(sql)
+
+        assert bash_cmd.startswith("hive -f /dev/stdin --hiveconf hive.msck.path.validation=skip <<'PARQUET2HIVE_SQL'\n"), \
+            'Should not pass long SQL as a single argument'
+        assert bash_cmd.endswith('\n' + sql + '\nPARQUET2HIVE_SQL\n')
+
     @mock_s3
     def test_with_sql_output(self):
         _setup_module()
@@ -347,6 +407,583 @@ class TestGetBashCmd(object):
 
         assert not bash_cmd
 
+    @mock_s3
+    def test_versions_in_order(self):
+        _setup_module()
+
+        for v in ('v1', 'v2', 'v3', 'v4'):
+            s3_client.put_object(Bucket=bucket_name, Key='churn/{}/parquet'.format(v), Body=open(dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v5/DEV_parquet', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', recent_versions=3, exclude_regex=['.*DEV.*'])
+        tables = re.findall('create external table `([^`]*)`', bash_cmd)
+
+        assert tables == ['churn_v4', 'churn', 'churn_v3', 'churn_v2']
+
+    @mock_s3
+    def test_cancelled_scan(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+        cancelled = threading.Event()
+
+        assert lib._scan_version(s3_client, bucket_name, 'churn/v1/', cancelled=cancelled).latest['Key'] == 'churn/v1/parquet'
+        cancelled.set()
+        assert lib._scan_version(s3_client, bucket_name, 'churn/v1/', cancelled=cancelled) is None
+
+
+class TestLoadBatch(object):
+
+    def test_parse_batch(self):
+        lines = [
+            '# datasets to load',
+            's3://test-bucket/churn',
+            '',
+            's3://other-bucket/frank alias=burn version=v2 exclude=.*DEV.* "exclude=.*my test.*"',
+        ]
+
+        assert lib.parse_batch(lines) == [
+            {'location': 's3://test-bucket/churn', 'alias': None, 'version': None, 'exclude_regex': None},
+            {'location': 's3://other-bucket/frank', 'alias': 'burn', 'version': 'v2', 'exclude_regex': ['.*DEV.*', '.*my test.*']},
+        ]
+
+    def test_parse_batch_unknown_setting(self):
+        with pytest.raises(ValueError) as exc:
+            lib.parse_batch(['s3://test-bucket/churn colour=blue'])
+        assert 'Line 1' in str(exc.value)
+
+    @mock_s3
+    def test_load_batch(self):
+        _setup_module()
+
+        objects = ['churn/v1/parquet', 'churn/v2/DEV_parquet', 'frank/v1/parquet', 'frank/v2/parquet']
+        for o in objects:
+            s3_client.put_object(Bucket=bucket_name, Key=o, Body=open(dataset_file, 'rb'))
+
+        entries = lib.parse_batch([
+            's3://{}/churn exclude=.*DEV.*'.format(bucket_name),
+            's3://{}/frank alias=burn version=v1'.format(bucket_name),
+            's3://missing-bucket/frank',
+        ])
+        bash_cmd, errors = lib.load_batch(entries)
+
+        assert 'create external table `churn_v1`' in bash_cmd
+        assert 'churn_v2' not in bash_cmd
+        assert 'create external table `burn_v1`' in bash_cmd
+        assert 'burn_v2' not in bash_cmd
+        assert bash_cmd.find('`churn_v1`') < bash_cmd.find('`burn_v1`'), 'Should keep the order of the entries'
+        assert [location for location, _ in errors] == ['s3://missing-bucket/frank']
+
+
+class TestSharding(object):
+
+    locations = ['s3://test-bucket/dataset-{}'.format(i) for i in range(100)]
+
+    def test_parse_shard(self):
+        assert lib.parse_shard('2/8') == (2, 8)
+        for spec in ('8/8', '1', 'a/b'):
+            with pytest.raises(ValueError):
+                lib.parse_shard(spec)
+
+    def test_hash(self):
+        shards = [lib.shard_datasets(self.locations, i, 4) for i in range(4)]
+
+        assert sorted(sum(shards, [])) == sorted(self.locations), 'Every dataset should be in exactly one shard'
+        assert all(shards), 'Every shard should get some datasets'
+        assert lib.shard_datasets(self.locations[:50], 1, 4) == [l for l in shards[1] if l in self.locations[:50]], \
+            'The shard of a dataset should not depend on the others'
+
+    def test_costs(self):
+        costs = {self.locations[0]: 100.0, self.locations[1]: 60.0, self.locations[2]: 40.0}
+        shards = [lib.shard_datasets(self.locations[:3], i, 2, costs) for i in range(2)]
+        assert shards == [[self.locations[0]], self.locations[1:3]]
+
+        shards = [lib.shard_datasets(self.locations, i, 2, costs) for i in range(2)]
+        assert sorted(sum(shards, [])) == sorted(self.locations)
+
+    @mock_s3
+    def test_load_prefix(self):
+        _setup_module()
+
+        for name in ('churn', 'frank', 'burn', 'turn'):
+            s3_client.put_object(Bucket=bucket_name, Key=name + '/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        run_stats = [lib.RunStats((i, 2)) for i in range(2)]
+        bash_cmds = [lib.load_prefix('s3://' + bucket_name, shard=(i, 2), run_stats=run_stats[i]) for i in range(2)]
+
+        for name in ('churn', 'frank', 'burn', 'turn'):
+            assert sum(['create external table `{}_v1`'.format(name) in bash_cmd for bash_cmd in bash_cmds]) == 1
+
+        stats = [r.to_dict() for r in run_stats]
+        assert stats[0]['shard'] == '0/2'
+        assert stats[0]['datasets'] + stats[1]['datasets'] == 4
+        assert stats[0]['runtime'] >= 0
+        assert set(stats[0]['costs']) | set(stats[1]['costs']) == set(['s3://{}/{}'.format(bucket_name, name) for name in ('churn', 'frank', 'burn', 'turn')])
+
+
+class TestCheckpoint(object):
+
+    def _put_datasets(self):
+        for name in ('churn', 'frank'):
+            s3_client.put_object(Bucket=bucket_name, Key=name + '/v1/parquet', Body=open(dataset_file, 'rb'))
+
+    @mock_s3
+    def test_resume(self, tmpdir):
+        _setup_module()
+        self._put_datasets()
+        path = str(tmpdir.join('checkpoint.json'))
+
+        checkpoint = lib.Checkpoint(path)
+        checkpoint.complete('s3://{}/churn'.format(bucket_name), 'echo churn\n')
+        checkpoint.deliver(['s3://{}/churn'.format(bucket_name)])
+
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path, resume=True))
+        assert 'churn' not in bash_cmd, 'Should skip the datasets which were loaded and delivered'
+        assert 'create external table `frank`' in bash_cmd
+        assert not tmpdir.join('checkpoint.json').exists(), 'Should remove the checkpoint of a complete run'
+
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path, resume=True))
+        assert 'create external table `churn`' in bash_cmd, 'Should start over after a complete run'
+
+    def test_log(self, tmpdir):
+        path = tmpdir.join('checkpoint.json')
+        checkpoint = lib.Checkpoint(str(path))
+        checkpoint.complete('s3://bucket/churn', 'echo churn\n')
+        checkpoint.complete('s3://bucket/frank', 'echo frank\n')
+        checkpoint.deliver(['s3://bucket/churn'])
+        assert len(path.readlines()) == 3, 'Should append a record per change'
+
+        path.write('{"location": "s3://bucket/main", "bash', mode='a')
+        resumed = lib.Checkpoint(str(path), resume=True)
+        assert resumed.datasets == {'s3://bucket/churn': {'bash_cmd': 'echo churn\n', 'delivered': True},
+                                    's3://bucket/frank': {'bash_cmd': 'echo frank\n', 'delivered': False}}
+
+        resumed.deliver(['s3://bucket/frank'])
+        assert lib.Checkpoint(str(path), resume=True).get('s3://bucket/frank')['delivered']
+
+    def test_schema_state(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        state = lib.SchemaState(path)
+        checkpoint = lib.Checkpoint(str(tmpdir.join('checkpoint.json')), schema_state=state)
+
+        running, completed = state.stage(), state.stage()
+        running.set('churn', [('clientId', 'string')], 's3://bucket/churn/v1', [])
+        completed.set('frank', [('clientId', 'string')], 's3://bucket/frank/v1', [])
+        checkpoint.complete('s3://bucket/frank', 'echo frank\n', completed)
+        assert sorted(lib.SchemaState(path).tables) == ['frank'], 'Should only save the tables of completed datasets'
+
+    @mock_s3
+    def test_failed_dataset(self, tmpdir):
+        _setup_module()
+        self._put_datasets()
+        s3_client.put_object(Bucket=bucket_name, Key='frank/v1/parquet', Body=b'not parquet')
+        path = str(tmpdir.join('checkpoint.json'))
+
+        state = lib.SchemaState()
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path, schema_state=state),
+                                   schema_state=state)
+        assert 'create external table `churn`' in bash_cmd
+        assert sorted(state.tables) == ['churn', 'churn_v1']
+        assert not tmpdir.join('checkpoint.json').exists(), 'Should remove the checkpoint once every dataset was tried'
+
+    @mock_s3
+    def test_undelivered(self, tmpdir):
+        _setup_module()
+        self._put_datasets()
+        path = str(tmpdir.join('checkpoint.json'))
+
+        checkpoint = lib.Checkpoint(path)
+        checkpoint.complete('s3://{}/churn'.format(bucket_name), 'echo churn\n')
+
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path, resume=True))
+        assert 'echo churn' in bash_cmd, 'Should emit the statements of a killed run'
+        assert 'create external table `churn`' not in bash_cmd
+        assert 'create external table `frank`' in bash_cmd
+
+    @mock_s3
+    def test_deadline(self, tmpdir):
+        _setup_module()
+        self._put_datasets()
+        path = str(tmpdir.join('checkpoint.json'))
+
+        run_stats = lib.RunStats()
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path), deadline=0, run_stats=run_stats)
+        assert bash_cmd == ''
+        assert run_stats.remaining == ['s3://{}/churn'.format(bucket_name), 's3://{}/frank'.format(bucket_name)]
+
+        bash_cmd = lib.load_prefix('s3://' + bucket_name, checkpoint=lib.Checkpoint(path, resume=True))
+        assert 'create external table `churn`' in bash_cmd
+        assert 'create external table `frank`' in bash_cmd
+
+
+class TestEstimate(object):
+
+    def _put_dataset(self, partitions):
+        for i in range(partitions):
+            for j in range(4):
+                s3_client.put_object(Bucket=bucket_name, Key='churn/v1/day={}/part-{}'.format(i, j), Body=b'data')
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/day=0/_SUCCESS', Body=b'')
+
+    @mock_s3
+    def test_estimate_dataset(self):
+        _setup_module()
+        self._put_dataset(2)
+
+        estimate = lib.estimate_dataset('s3://' + bucket_name + '/churn')
+        assert estimate['keys'] == 8
+        assert estimate['requests'] == {'list': 2, 'head': 0, 'get': 2}
+        assert estimate['cost'] > 0 and estimate['seconds'] > 0
+
+        estimate = lib.estimate_dataset('s3://' + bucket_name + '/churn', success_only=True, table_stats='exact')
+        assert estimate['requests'] == {'list': 2, 'head': 1, 'get': 18}, 'Should only check partitions without a listed _SUCCESS'
+
+    @mock_s3
+    def test_exclude_and_shard(self):
+        _setup_module()
+        self._put_dataset(2)
+        s3_client.put_object(Bucket=bucket_name, Key='frank/v1/part-0', Body=b'data')
+
+        estimate = lib.estimate_datasets([{'location': 's3://' + bucket_name + '/churn'}], exclude_regex=['.*day=1.*'])
+        assert estimate['total']['keys'] == 4
+
+        estimate = lib.estimate_prefix('s3://' + bucket_name, shard=(0, 2))
+        assert [d['location'] for d in estimate['datasets']] == lib.shard_datasets(
+            ['s3://{}/churn'.format(bucket_name), 's3://{}/frank'.format(bucket_name)], 0, 2)
+
+    @mock_s3
+    def test_extrapolate(self):
+        _setup_module()
+        self._put_dataset(10)
+
+        estimate = lib.estimate_dataset('s3://' + bucket_name + '/churn', sample_partitions=2)
+        assert estimate['keys'] == 40, 'Should extrapolate the keys of the sampled partitions'
+        assert estimate['sampling_requests'] == 4
+
+    @mock_s3
+    def test_estimate_prefix(self):
+        _setup_module()
+        self._put_dataset(2)
+        s3_client.put_object(Bucket=bucket_name, Key='frank/v1/part-0', Body=b'data')
+
+        estimate = lib.estimate_prefix('s3://' + bucket_name)
+        assert [d['location'] for d in estimate['datasets']] == ['s3://{}/churn'.format(bucket_name), 's3://{}/frank'.format(bucket_name)]
+        assert estimate['total']['keys'] == 9
+        assert estimate['total']['requests']['get'] == 4
+        # the bucket, the versions of each dataset and the version of each dataset
+        assert estimate['total']['requests']['list'] == 1 + 2 + 2
+        assert estimate['total']['requests']['head'] == 1, 'Should look up the region of the bucket'
+
+
+class TestSummaryFiles(object):
+
+    @mock_s3
+    def test_common_metadata(self, monkeypatch):
+        _setup_module()
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+
+        # the summary file has column 'id', the data file does not
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/_common_metadata', Body=open(new_dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/sample_id=1/parquet', Body=open(dataset_file, 'rb'))
+
+        dataset = 's3://' + '/'.join((bucket_name, 'churn'))
+        limiter = RateLimiter()
+        lib.set_rate_limiter(limiter)
+        try:
+            bash_cmd = lib.get_bash_cmd(dataset, use_summary_files=True, just_sql=True)
+        finally:
+            lib.set_rate_limiter(None)
+
+        assert '`id` bigint' in bash_cmd, 'Should read the schema from the summary file'
+        assert 'partitioned by (`sample_id` string)' in bash_cmd, 'Should find the partitioning from a data file'
+        # bucket region lookup, versions listing, one page of the version and two footer range reads
+        assert limiter.stats()['requests'] == 5
+
+    @mock_s3
+    def test_metadata(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/_metadata', Body=open(new_dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + '/'.join((bucket_name, 'churn')), use_summary_files=True)
+        assert '`id`' in bash_cmd
+
+    @mock_s3
+    def test_metadata_row_groups_not_read(self, monkeypatch):
+        _setup_module()
+
+        data = open(new_dataset_file, 'rb').read()
+        metadata = FileMetaData()
+        metadata.read(TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(data[-8 - struct.unpack('<i', data[-8:-4])[0]:-8])))
+        metadata.row_groups = [RowGroup(columns=[ColumnChunk(file_path='part-{}.parquet'.format(i), file_offset=4)],
+                                        num_rows=10, total_byte_size=100) for i in range(1000)]
+        transport = TTransport.TMemoryBuffer()
+        metadata.write(TCompactProtocol.TCompactProtocol(transport))
+        footer = transport.getvalue()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/_metadata', Body=b'PAR1' + footer + struct.pack('<i', len(footer)) + b'PAR1')
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        ranges = []
+        get_range = lib._get_range
+
+        def recording_get_range(client, bucket, key, start, end=None):
+            ranges.append((key, start, end))
+            return get_range(client, bucket, key, start, end)
+
+        monkeypatch.setattr(lib, 'SUMMARY_SCHEMA_READ_SIZE', 16)
+        monkeypatch.setattr(lib, '_get_range', recording_get_range)
+        bash_cmd = lib.get_bash_cmd('s3://' + '/'.join((bucket_name, 'churn')), use_summary_files=True)
+
+        assert '`id`' in bash_cmd
+        footer_reads = [end - start + 1 for key, start, end in ranges if key == 'churn/v1/_metadata' and end is not None]
+        assert footer_reads[0] == 16 and len(footer_reads) > 1, 'Should read more of the footer until the schema is complete'
+        assert footer_reads[-1] < len(footer) // 100, 'Should not read the row groups'
+
+    @mock_s3
+    def test_no_summary_file(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + '/'.join((bucket_name, 'churn')), use_summary_files=True)
+        assert '`clientId`' in bash_cmd, 'Should fall back to listing the version'
+
+    @mock_s3
+    def test_success_only(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/_common_metadata', Body=open(new_dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + '/'.join((bucket_name, 'churn')), use_summary_files=True, success_only=True)
+        assert not bash_cmd, 'Should ignore versions without _SUCCESS file'
+
+
+class TestTableStats(object):
+
+    def _put_files(self, n):
+        for i in range(n):
+            s3_client.put_object(Bucket=bucket_name, Key='churn/v1/part-{}.parquet'.format(i), Body=open(dataset_file, 'rb'))
+
+        head = s3_client.head_object(Bucket=bucket_name, Key='churn/v1/part-0.parquet')
+        rows = lib.read_metadata(s3_client, bucket_name, 'churn/v1/part-0.parquet').num_rows
+        return head['ContentLength'], rows
+
+    @mock_s3
+    def test_exact(self):
+        _setup_module()
+        size, rows = self._put_files(3)
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, table_stats='exact')
+
+        properties = "set tblproperties ('numFiles'='3', 'numRows'='{}', 'totalSize'='{}');".format(3 * rows, 3 * size)
+        assert "alter table `churn_v1` " + properties in bash_cmd
+        assert "alter table `churn` " + properties in bash_cmd
+
+    @mock_s3
+    def test_sampled(self):
+        _setup_module()
+        size, rows = self._put_files(4)
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, table_stats='sampled', stats_sample_size=2)
+
+        properties = "set tblproperties ('numFiles'='4', 'numRows'='{}', 'totalSize'='{}');".format(4 * rows, 4 * size)
+        assert "alter table `churn_v1` " + properties in bash_cmd, 'Should extrapolate the number of rows'
+
+    @mock_s3
+    def test_view_has_no_stats(self):
+        _setup_module()
+        self._put_files(1)
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, table_stats='exact', default_table='view')
+        assert "alter table `churn_v1` set tblproperties" in bash_cmd
+        assert "alter table `churn` set tblproperties" not in bash_cmd
+
+    def test_sample(self):
+        scan = lib.VersionScan(sample_size=10, seed='churn/v1/')
+        for i in range(1000):
+            scan.add({'Key': 'churn/v1/part-{}'.format(i), 'Size': i})
+
+        assert scan.num_files == 1000
+        assert scan.total_size == sum(range(1000))
+        assert len(scan.footer_files) == 10
+        assert len(set(scan.footer_files)) == 10
+
+
+class TestSortHints(object):
+
+    def _footer(self, *sorting_columns):
+        columns = [ColumnChunk(meta_data=ColumnMetaData(path_in_schema=path)) for path in (['client_id'], ['payload', 'ts'])]
+        row_group = RowGroup(columns=columns, sorting_columns=[SortingColumn(column_idx=i, descending=d, nulls_first=False)
+                                                               for i, d in sorting_columns])
+        return lib._summarize_footer(FileMetaData(num_rows=1, schema=[SchemaElement(name='root', num_children=0)],
+                                                  row_groups=[row_group, row_group]))
+
+    def test_consistent(self):
+        footers = [self._footer((0, False), (1, True)), self._footer((0, False), (1, True))]
+        assert lib.read_sort_order(None, 'test-bucket', None, footers) == 'client_id asc, payload.ts desc'
+
+    def test_inconsistent(self):
+        assert lib.read_sort_order(None, 'test-bucket', None, [self._footer((0, False)), self._footer((1, False))]) is None
+        assert lib.read_sort_order(None, 'test-bucket', None, [self._footer((0, False)), self._footer()]) is None
+        assert lib.read_sort_order(None, 'test-bucket', None, [self._footer()]) is None
+
+    @mock_s3
+    def test_unsorted_dataset(self):
+        _setup_module()
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/part-0.parquet', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, sort_hints=True)
+        assert lib.SORTED_BY_PROPERTY not in bash_cmd
+
+
+class TestColumnStats(object):
+
+    schema = [SchemaElement(name='root', num_children=3),
+              SchemaElement(name='id', type=Type.INT64, repetition_type=FieldRepetitionType.REQUIRED),
+              SchemaElement(name='name', type=Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8, repetition_type=FieldRepetitionType.OPTIONAL),
+              SchemaElement(name='count', type=Type.INT32, converted_type=ConvertedType.UINT_32, repetition_type=FieldRepetitionType.OPTIONAL)]
+
+    def _footer(self, *row_groups):
+        def chunk(name, statistics):
+            return ColumnChunk(meta_data=ColumnMetaData(path_in_schema=[name], statistics=statistics))
+
+        return lib._summarize_footer(FileMetaData(num_rows=10, schema=self.schema, row_groups=[
+            RowGroup(columns=[chunk('id', Statistics(min=struct.pack('<q', low), max=struct.pack('<q', high), null_count=0)),
+                              chunk('name', Statistics(min='a', max='z', null_count=nulls)),
+                              chunk('count', Statistics(min=struct.pack('<i', -1), max=struct.pack('<i', 1), null_count=0))])
+            for low, high, nulls in row_groups]))
+
+    def _scan(self, num_files, sampled):
+        scan = lib.VersionScan(sample_size=sampled, seed='churn/v1/')
+        for i in range(num_files):
+            scan.add({'Key': 'churn/v1/part-{}'.format(i), 'Size': 10})
+        return scan
+
+    def test_merge(self):
+        footers = [self._footer((1, 5, 1), (3, 9, 2)), self._footer((-4, 2, 0))]
+        properties = lib.read_column_stats(None, 'test-bucket', self._scan(2, 0), footers)
+
+        assert properties['id'] == {'lowValue': -4, 'highValue': 9, 'numNulls': 0}
+        assert properties['name'] == {'numNulls': 3}
+        assert properties['count'] == {'numNulls': 0}, 'Should not trust the signed order of unsigned statistics'
+
+        assert lib._column_stats_sql('churn', {'id': properties['id']}) == \
+            "alter table `churn` update statistics for column `id` set ('highValue'='9', 'lowValue'='-4', 'numNulls'='0');"
+
+    def test_sampled(self):
+        properties = lib.read_column_stats(None, 'test-bucket', self._scan(4, 2), [self._footer((1, 5, 1)), self._footer((1, 5, 2))])
+        assert properties['name'] == {'numNulls': 6}
+
+    def test_missing_statistics(self):
+        footer = self._footer((1, 5, 1))
+        footer['columns']['id'] = None
+        properties = lib.read_column_stats(None, 'test-bucket', self._scan(2, 0), [self._footer((1, 5, 1)), footer])
+        assert 'id' not in properties
+
+    def test_missing_bounds(self):
+        schema = [SchemaElement(name='root', num_children=4),
+                  SchemaElement(name='nulls', type=Type.INT64, repetition_type=FieldRepetitionType.OPTIONAL),
+                  SchemaElement(name='no_min', type=Type.INT64, repetition_type=FieldRepetitionType.OPTIONAL),
+                  SchemaElement(name='no_max', type=Type.INT64, repetition_type=FieldRepetitionType.OPTIONAL),
+                  SchemaElement(name='ratio', type=Type.DOUBLE, repetition_type=FieldRepetitionType.OPTIONAL)]
+
+        def chunk(name, num_values, null_count, low=None, high=None, fmt='<q'):
+            statistics = Statistics(min=struct.pack(fmt, low) if low is not None else None,
+                                    max=struct.pack(fmt, high) if high is not None else None, null_count=null_count)
+            return ColumnChunk(meta_data=ColumnMetaData(path_in_schema=[name], num_values=num_values, statistics=statistics))
+
+        footer = lib._summarize_footer(FileMetaData(num_rows=10, schema=schema, row_groups=[
+            RowGroup(columns=[chunk('nulls', 5, 5), chunk('no_min', 5, 2), chunk('no_max', 5, 0, low=1),
+                              chunk('ratio', 5, 0, 0.5, float('inf'), '<d')]),
+            RowGroup(columns=[chunk('nulls', 5, 0, 1, 3), chunk('no_min', 5, 0, 1, 3), chunk('no_max', 5, 0, 1, 3),
+                              chunk('ratio', 5, 0, 0.5, 1.5, '<d')])]))
+        properties = lib.read_column_stats(None, 'test-bucket', self._scan(1, 0), [footer])
+
+        assert properties['nulls'] == {'lowValue': 1, 'highValue': 3, 'numNulls': 5}, 'Should keep bounds over chunks of nulls'
+        assert properties['no_min'] == {'numNulls': 2}, 'Should drop bounds when a chunk with values has none'
+        assert properties['no_max'] == {'numNulls': 0}
+        assert properties['ratio'] == {'numNulls': 0}, 'Should drop infinite bounds, which Hive rejects'
+
+    @mock_s3
+    def test_partitioned(self):
+        _setup_module()
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170101/part-0', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, column_stats=True)
+        assert "update statistics" not in bash_cmd
+
+
+class TestLayoutReport(object):
+
+    @mock_s3
+    def test_layout_report(self):
+        _setup_module()
+
+        keys = ['churn/v1/submission_date=20170101/part-0', 'churn/v1/submission_date=20170101/part-1', 'churn/v1/submission_date=20170102/part-0',
+                'churn/v1/submission_date=20170102/_temporary/part-1']
+        for k in keys:
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+
+        report = LayoutReport()
+        lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, layout_report=report)
+
+        version = report.to_dict()['versions'][0]
+        assert (version['location'], version['version'], version['files']) == ('s3://' + bucket_name + '/churn', 'v1', 3)
+        assert [(p['partition'], p['files']) for p in version['partitions']] == [('submission_date=20170101', 2), ('submission_date=20170102', 1)]
+        assert version['compaction_candidates'] == ['submission_date=20170101']
+
+
+class TestPartitionStats(object):
+
+    @mock_s3
+    def test_partition_stats(self):
+        _setup_module()
+
+        keys = ['churn/v1/submission_date=20170101/part-0', 'churn/v1/submission_date=20170101/part-1', 'churn/v1/submission_date=20170102/part-0']
+        for k in keys:
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+        size = s3_client.head_object(Bucket=bucket_name, Key=keys[0])['ContentLength']
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True)
+
+        for table in ('churn_v1', 'churn'):
+            assert "msck repair table `{0}`; alter table `{0}` partition (`submission_date`='20170101') set tblproperties ('numFiles'='2', 'totalSize'='{1}');".format(table, 2 * size) in bash_cmd
+            assert "alter table `{0}` partition (`submission_date`='20170102') set tblproperties ('numFiles'='1', 'totalSize'='{1}');".format(table, size) in bash_cmd
+
+    def test_many_partitions(self):
+        partition_totals = {'submission_date=2017{:04}'.format(i): (1, 1024) for i in range(1000)}
+        bash_cmd = lib._format_sql(lib._partition_properties_sql('churn', partition_totals))
+
+        assert bash_cmd.startswith('hive -f /dev/stdin'), 'Should not exceed the limit on the size of an argument'
+        assert bash_cmd.count('set tblproperties') == 1000
+
+    @mock_s3
+    def test_location_swap(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170101/part-0', Body=open(dataset_file, 'rb'))
+
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True, default_table='location')
+        assert "alter table `churn` partition (`submission_date`='20170101') set tblproperties ('numFiles'='1'" in bash_cmd
+
+    @mock_s3
+    def test_unchanged_schema(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170101/part-0', Body=open(dataset_file, 'rb'))
+
+        state = lib.SchemaState()
+        lib.get_bash_cmd('s3://' + bucket_name + '/churn', schema_state=state)
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170102/part-0', Body=open(dataset_file, 'rb'))
+        bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True, schema_state=state)
+
+        assert 'drop table' not in bash_cmd
+        for table in ('churn_v1', 'churn'):
+            assert "msck repair table `{0}`; alter table `{0}` partition (`submission_date`='20170101')".format(table) in bash_cmd
+            assert "alter table `{}` partition (`submission_date`='20170102') set tblproperties".format(table) in bash_cmd
+
 
 class TestGetVersions(object):
 
@@ -449,6 +1086,20 @@ class TestSuccessExists(object):
 
         assert not lib.check_success_exists(s3, bucket_name, '/'.join([prefix, version])), '_SUCCESS found when actually missing from directory'
 
+    @mock_s3
+    def test_found_by_listing(self):
+        _setup_module()
+
+        keys = ['longitudinal/v1/sample_id=1/_SUCCESS', 'longitudinal/v1/sample_id=1/p1', 'longitudinal/v1/sample_id=2/p1']
+        for k in keys:
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=b'teststring')
+
+        scan = lib._scan_version(s3_client, bucket_name, 'longitudinal/v1/', success_only=True, collect_partitions=True)
+        assert scan.partitions.success('sample_id=1')
+        assert scan.matching_partitions(['sample_id']) == {'sample_id=1': [1, 10]}
+        # only sample_id=2 needed its _SUCCESS file looked up
+        assert lib.check_success_exists.cache_info().misses == 1
+
 
 class TestIgnoreKey(object):
 
@@ -691,6 +1342,301 @@ class TestParquet2Sql(object):
         assert lib.parquet2sql(schema, 'complex_table', 's3://test-bucket/complex.parquet', []) == COMPLEX_SQL
 
 
+class TestSchemaDiff(object):
+
+    columns = [('clientId', 'string'), ('sampleId', 'int')]
+    location = 's3://test-bucket/churn/v1'
+
+    def _previous(self, columns=None, location=None, partitions=()):
+        state = lib.SchemaState()
+        state.set('churn', columns or self.columns, location or self.location, partitions)
+        return state.get('churn')
+
+    def test_new_table(self):
+        sql = lib.schema_diff_sql(self.columns, 'churn', self.location, [])
+        assert sql.startswith('drop table if exists `churn`; create external table `churn`')
+
+    def test_unchanged(self):
+        assert lib.schema_diff_sql(self.columns, 'churn', self.location, [], self._previous()) == ''
+
+    def test_added_column(self):
+        columns = self.columns + [('country', 'string')]
+        sql = lib.schema_diff_sql(columns, 'churn', self.location, [], self._previous())
+        assert sql == 'alter table `churn` add columns (`country` string);'
+
+    def test_added_column_partitioned(self):
+        columns = self.columns + [('country', 'string')]
+        previous = self._previous(partitions=['submission_date'])
+        sql = lib.schema_diff_sql(columns, 'churn', self.location, ['submission_date'], previous)
+        assert sql == 'alter table `churn` add columns (`country` string) cascade; msck repair table `churn`;'
+
+    def test_unchanged_partitioned(self):
+        previous = self._previous(partitions=['submission_date'])
+        sql = lib.schema_diff_sql(self.columns, 'churn', self.location, ['submission_date'], previous)
+        assert sql == 'msck repair table `churn`;', 'Should register the partitions written since the last run'
+
+    def test_removed_column(self):
+        sql = lib.schema_diff_sql(self.columns[1:], 'churn', self.location, [], self._previous())
+        assert sql == 'alter table `churn` replace columns (`sampleId` int);'
+
+    def test_changed_type(self):
+        columns = [('clientId', 'string'), ('sampleId', 'bigint')]
+        sql = lib.schema_diff_sql(columns, 'churn', self.location, [], self._previous())
+        assert sql.startswith('drop table if exists `churn`;'), 'Should recreate table when a column changes type'
+
+    def test_changed_location(self):
+        sql = lib.schema_diff_sql(self.columns, 'churn', 's3://test-bucket/churn/v2', [], self._previous())
+        assert sql.startswith('drop table if exists `churn`;'), 'Should recreate table when the location changes'
+
+    def test_changed_partitions(self):
+        previous = self._previous(partitions=['submission_date'])
+        sql = lib.schema_diff_sql(self.columns, 'churn', self.location, [], previous)
+        assert sql.startswith('drop table if exists `churn`;'), 'Should recreate table when the partitioning changes'
+
+    def test_save_and_load(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        state = lib.SchemaState(path)
+        state.set('churn', self.columns, self.location, ['submission_date'])
+        state.save()
+
+        loaded = lib.SchemaState(path)
+        assert lib.schema_diff_sql(self.columns, 'churn', self.location, ['submission_date'], loaded.get('churn')) == \
+            'msck repair table `churn`;'
+
+    @mock_s3
+    def test_get_bash_cmd_unchanged(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        dataset = 's3://' + '/'.join((bucket_name, 'churn'))
+        state = lib.SchemaState()
+        bash_cmd = lib.get_bash_cmd(dataset, schema_state=state)
+        assert 'create external table `churn_v1`' in bash_cmd
+        assert 'create external table `churn`' in bash_cmd
+
+        assert lib.get_bash_cmd(dataset, schema_state=state) == '', 'Should not emit anything for unchanged tables'
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(new_dataset_file, 'rb'))
+        bash_cmd = lib.get_bash_cmd(dataset, schema_state=state)
+        assert 'drop table' not in bash_cmd
+        assert 'alter table `churn_v1` replace columns (`id` bigint);' in bash_cmd
+
+    @mock_s3
+    def test_get_bash_cmd_failed(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v2/parquet', Body=b'not parquet')
+
+        state = lib.SchemaState()
+        with pytest.raises(lib.ParquetFormatError):
+            lib.get_bash_cmd('s3://' + '/'.join((bucket_name, 'churn')), schema_state=state)
+        assert state.tables == {}, 'Should not record the tables of a dataset that failed'
+
+    def test_staged(self):
+        state = lib.SchemaState()
+        staged = state.stage()
+        staged.set('churn', self.columns, self.location, [])
+        assert state.get('churn') is None
+        assert staged.get('churn')['location'] == self.location
+
+        staged.commit()
+        assert state.get('churn')['location'] == self.location
+
+
+class TestDefaultTable(object):
+
+    columns = [('clientId', 'string'), ('sampleId', 'int')]
+
+    def test_view(self):
+        sql = lib.view_sql('churn', 'churn_v2')
+        assert sql == ('drop table if exists `churn`; create view if not exists `churn` as select * from `churn_v2`; '
+                       'alter view `churn` as select * from `churn_v2`;')
+
+    def test_swap_location(self):
+        state = lib.SchemaState()
+        state.set('churn', self.columns, 's3://test-bucket/churn/v1', ['submission_date'],
+                  ['submission_date=20161231', 'submission_date=20170101'])
+        sql = lib.swap_location_sql(self.columns, 'churn', 's3://test-bucket/churn/v2', ['submission_date'],
+                                    ['submission_date=20170101', 'submission_date=20170102'], state.get('churn'))
+
+        assert 'drop table' not in sql
+        assert 'msck repair table' not in sql
+        assert 'create external table if not exists `churn`' in sql
+        assert "alter table `churn` set location 's3://test-bucket/churn/v2';" in sql
+        assert "partition (`submission_date`='20170101') location 's3://test-bucket/churn/v2/submission_date=20170101'" in sql
+        assert "alter table `churn` partition (`submission_date`='20170101') set location 's3://test-bucket/churn/v2/submission_date=20170101';" in sql
+        assert "partition (`submission_date`='20170102') set location" not in sql, 'Should add new partitions at their location'
+        assert sql.endswith("alter table `churn` drop if exists partition (`submission_date`='20161231');"), \
+            'Should drop the partitions missing from the new location'
+
+    def test_swap_location_unknown_partitions(self):
+        sql = lib.swap_location_sql(self.columns, 'churn', 's3://test-bucket/churn/v2', ['submission_date'],
+                                    ['submission_date=20170101'])
+
+        assert sql.startswith('drop table if exists `churn`;'), 'Should recreate table without its previous partitions'
+        assert 'msck repair table `churn`;' in sql
+
+    def test_swap_location_unchanged_columns(self):
+        state = lib.SchemaState()
+        state.set('churn', self.columns, 's3://test-bucket/churn/v1', [])
+        sql = lib.swap_location_sql(self.columns, 'churn', 's3://test-bucket/churn/v2', [], previous=state.get('churn'))
+
+        assert 'columns' not in sql
+        assert "alter table `churn` set location 's3://test-bucket/churn/v2';" in sql
+
+    def test_swap_location_changed_partitions(self):
+        state = lib.SchemaState()
+        state.set('churn', self.columns, 's3://test-bucket/churn/v1', [])
+        sql = lib.swap_location_sql(self.columns, 'churn', 's3://test-bucket/churn/v2', ['submission_date'], previous=state.get('churn'))
+
+        assert sql.startswith('drop table if exists `churn`;'), 'Should recreate table when the partitioning changes'
+
+    @mock_s3
+    def test_get_bash_cmd_view(self):
+        _setup_module()
+
+        for k in ('churn/v1/parquet', 'churn/v2/parquet'):
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+
+        dataset = 's3://' + '/'.join((bucket_name, 'churn'))
+        bash_cmd = lib.get_bash_cmd(dataset, just_sql=True, default_table='view')
+
+        assert 'create external table `churn_v2`' in bash_cmd
+        assert 'create external table `churn_v1`' in bash_cmd
+        assert 'drop table if exists `churn`; create view if not exists `churn`' in bash_cmd, \
+            'Should replace a base table of the same name'
+        assert 'alter view `churn` as select * from `churn_v2`;' in bash_cmd
+        assert bash_cmd.count('msck repair table') == 2
+
+    @mock_s3
+    def test_get_bash_cmd_location(self):
+        _setup_module()
+
+        for k in ('churn/v1/submission_date=20170101/parquet', 'churn/v1/submission_date=20170102/parquet'):
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+
+        dataset = 's3://' + '/'.join((bucket_name, 'churn'))
+        state = lib.SchemaState()
+        bash_cmd = lib.get_bash_cmd(dataset, just_sql=True, default_table='location', schema_state=state)
+        assert 'drop table if exists `churn`;' in bash_cmd, 'Should recreate table the first time'
+        assert state.get('churn')['partition_dirs'] == ['submission_date=20170101', 'submission_date=20170102']
+
+        for k in ('churn/v2/submission_date=20170102/parquet', 'churn/v2/submission_date=20170103/parquet'):
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+        lib.clear_caches()
+        bash_cmd = lib.get_bash_cmd(dataset, just_sql=True, default_table='location', schema_state=state)
+
+        assert 'drop table if exists `churn`;' not in bash_cmd
+        assert 'msck repair table `churn`;' not in bash_cmd
+        assert 'msck repair table `churn_v2`;' in bash_cmd
+        assert "alter table `churn` partition (`submission_date`='20170102') set location" in bash_cmd
+        assert "partition (`submission_date`='20170103') location 's3://test-bucket/churn/v2/submission_date=20170103'" in bash_cmd
+        assert "alter table `churn` partition (`submission_date`='20170103') set location" not in bash_cmd
+        assert "alter table `churn` drop if exists partition (`submission_date`='20170101');" in bash_cmd
+
+
+class TestSchemaTree(object):
+
+    schema = [SchemaElement(name='root', num_children=3),
+              SchemaElement(name='id', type=Type.INT64, repetition_type=FieldRepetitionType.REQUIRED),
+              SchemaElement(name='tags', repetition_type=FieldRepetitionType.OPTIONAL, converted_type=ConvertedType.LIST, num_children=1),
+              SchemaElement(name='list', repetition_type=FieldRepetitionType.REPEATED, num_children=1),
+              SchemaElement(name='element', type=Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8, repetition_type=FieldRepetitionType.OPTIONAL),
+              SchemaElement(name='payload', repetition_type=FieldRepetitionType.OPTIONAL, num_children=2),
+              SchemaElement(name='nums', type=Type.INT32, repetition_type=FieldRepetitionType.REPEATED),
+              SchemaElement(name='empty', repetition_type=FieldRepetitionType.OPTIONAL, num_children=0)]
+
+    def test_children(self):
+        tree = lib.SchemaTree(self.schema)
+        assert [field.element.name for field in tree.fields()] == ['id', 'tags', 'payload']
+        assert [child.element.name for child in tree.fields()[2].children()] == ['nums', 'empty']
+        assert list(tree.ends) == [8, 2, 5, 5, 5, 8, 7, 8]
+
+    def test_sql_type(self):
+        columns = [(field.element.name, lib.sql_type(field)) for field in lib.SchemaTree(self.schema).fields()]
+        assert columns == [('id', 'bigint'), ('tags', 'array<string>'), ('payload', 'struct<`nums`: array<int>, `empty`: struct<>>')]
+        assert self.schema[6].repetition_type == FieldRepetitionType.REPEATED, 'Should not change the schema'
+
+    def test_fields_are_not_changed(self):
+        field = {'repetition_type': 'repeated', 'type': 'int32', 'name': 'num', 'converted_type': None, 'children': None}
+        assert lib.sql_type(field) == 'array<int>'
+        assert field['repetition_type'] == 'repeated'
+
+
+class TestParseSchema(object):
+
+    def _footer(self, path):
+        data = open(path, 'rb').read()
+        footer_size = struct.unpack('<i', data[-8:-4])[0]
+        return data[-8 - footer_size:-8]
+
+    def _serialize(self, metadata):
+        transport = TTransport.TMemoryBuffer()
+        metadata.write(TCompactProtocol.TCompactProtocol(transport))
+        return transport.getvalue()
+
+    def _deserialize(self, footer):
+        metadata = FileMetaData()
+        metadata.read(TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(footer)))
+        return metadata
+
+    def _random_fields(self, rng, count, depth=0):
+        elements = []
+        for i in range(count):
+            name = u'f{}'.format(i)
+            repetition_type = rng.choice([FieldRepetitionType.REQUIRED, FieldRepetitionType.OPTIONAL, FieldRepetitionType.REPEATED])
+            kind = rng.choice(['primitive', 'primitive', 'string', 'decimal'] + (['struct', 'list', 'map'] if depth < 4 else []))
+            if kind == 'primitive':
+                elements.append(SchemaElement(name=name, repetition_type=repetition_type, field_id=i,
+                                              type=rng.choice([Type.BOOLEAN, Type.INT32, Type.INT64, Type.INT96, Type.FLOAT, Type.DOUBLE, Type.BYTE_ARRAY])))
+            elif kind == 'string':
+                elements.append(SchemaElement(name=name, repetition_type=repetition_type, type=Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8))
+            elif kind == 'decimal':
+                elements.append(SchemaElement(name=name, repetition_type=repetition_type, type=Type.FIXED_LEN_BYTE_ARRAY, type_length=16,
+                                              converted_type=ConvertedType.DECIMAL, precision=rng.randint(1, 38), scale=rng.randint(0, 10)))
+            elif kind == 'struct':
+                num_children = rng.randint(0, 4)
+                elements.append(SchemaElement(name=name, repetition_type=repetition_type, num_children=num_children))
+                elements.extend(self._random_fields(rng, num_children, depth + 1))
+            elif kind == 'list':
+                elements.append(SchemaElement(name=name, repetition_type=FieldRepetitionType.OPTIONAL, converted_type=ConvertedType.LIST, num_children=1))
+                elements.append(SchemaElement(name='list', repetition_type=FieldRepetitionType.REPEATED, num_children=1))
+                elements.extend(self._random_fields(rng, 1, depth + 1))
+            else:
+                elements.append(SchemaElement(name=name, repetition_type=FieldRepetitionType.OPTIONAL, converted_type=ConvertedType.MAP, num_children=1))
+                elements.append(SchemaElement(name='key_value', repetition_type=FieldRepetitionType.REPEATED, num_children=2))
+                elements.append(SchemaElement(name='key', repetition_type=FieldRepetitionType.REQUIRED, type=Type.BYTE_ARRAY, converted_type=ConvertedType.UTF8))
+                elements.extend(self._random_fields(rng, 1, depth + 1))
+        return elements
+
+    def test_fixtures(self):
+        for path in ('tests/dataset.parquet', 'tests/dataset-new.parquet', 'tests/complex.parquet'):
+            footer = self._footer(path)
+            expected = lib.parquet2sql(self._deserialize(footer).schema, 'test', 's3://bucket/test', [])
+            assert lib.parquet2sql(lib.parse_schema(footer), 'test', 's3://bucket/test', []) == expected
+
+    def test_generated_schemas(self):
+        rng = random.Random(42)
+        for _ in range(50):
+            num_fields = rng.randint(1, 20)
+            schema = [SchemaElement(name='schema', num_children=num_fields)] + self._random_fields(rng, num_fields)
+            metadata = FileMetaData(version=1, schema=schema, num_rows=10, created_by='test',
+                                    key_value_metadata=[KeyValue(key='writer', value='test')],
+                                    row_groups=[RowGroup(columns=[], total_byte_size=100, num_rows=10)])
+            footer = self._serialize(metadata)
+
+            elements = lib.parse_schema(footer)
+            assert [tuple(getattr(element, field) for field in lib.FooterElement._fields) for element in schema] == [tuple(e) for e in elements]
+            assert lib.parquet2sql(elements, 'test', 's3://bucket/test', []) == lib.parquet2sql(schema, 'test', 's3://bucket/test', [])
+
+    def test_truncated(self):
+        footer = self._footer('tests/complex.parquet')
+        with pytest.raises(lib.ParquetFormatError):
+            lib.parse_schema(footer[:len(footer) // 4])
+
+
 class TestSqlType(unittest.TestCase):
 
     def test_unknown(self):
@@ -877,3 +1823,254 @@ class TestReadSchema(object):
         with pytest.raises(lib.ParquetFormatError) as exc:
             lib.read_schema(obj)
         assert 'file is too small' in str(exc.value)
+
+
+class TestRateLimiting(object):
+
+    @mock_s3
+    def test_get_bash_cmd(self, monkeypatch):
+        _setup_module()
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/_SUCCESS', Body=b'SUCCESS')
+
+        limiter = RateLimiter()
+        lib.set_rate_limiter(limiter)
+        try:
+            bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', success_only=True)
+        finally:
+            lib.set_rate_limiter(None)
+
+        assert 'create external table `churn_v1`' in bash_cmd
+        # bucket region lookup, versions listing, version listing, which finds the _SUCCESS file, and two footer range reads
+        assert limiter.stats()['requests'] == 5
+
+    @mock_s3
+    def test_recent_versions(self, monkeypatch):
+        _setup_module()
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+
+        for v in ('v1', 'v2', 'v3'):
+            s3_client.put_object(Bucket=bucket_name, Key='churn/{}/parquet'.format(v), Body=open(dataset_file, 'rb'))
+
+        limiter = RateLimiter()
+        lib.set_rate_limiter(limiter)
+        try:
+            bash_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', recent_versions=2)
+        finally:
+            lib.set_rate_limiter(None)
+
+        assert 'table `churn_v1`' not in bash_cmd
+        # bucket region lookup, versions listing, then a listing and two footer range reads for each of v3 and v2, but
+        # nothing for v1
+        assert limiter.stats()['requests'] == 8
+
+
+class TestListingCache(object):
+
+    @mock_s3
+    def test_get_bash_cmd(self, tmpdir, monkeypatch):
+        _setup_module()
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+
+        for v in ('v1', 'v2'):
+            s3_client.put_object(Bucket=bucket_name, Key='churn/{}/parquet'.format(v), Body=open(dataset_file, 'rb'))
+
+        limiter = RateLimiter()
+        lib.set_rate_limiter(limiter)
+        lib.set_listing_cache(ListingCache(str(tmpdir)))
+        try:
+            expected = lib.get_bash_cmd('s3://' + bucket_name + '/churn')
+            # bucket region lookup, versions listing, then a listing and two footer range reads for each version
+            assert limiter.stats()['requests'] == 8
+
+            lib.clear_caches()
+            assert lib.get_bash_cmd('s3://' + bucket_name + '/churn') == expected
+            # only the bucket region lookup and the footer range reads
+            assert limiter.stats()['requests'] == 13
+        finally:
+            lib.set_rate_limiter(None)
+            lib.set_listing_cache(None)
+
+    @mock_s3
+    def test_load_prefix(self, tmpdir):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+        now = [0]
+        lib.set_listing_cache(ListingCache(str(tmpdir), clock=lambda: now[0]))
+        try:
+            lib.load_prefix('s3://' + bucket_name)
+            s3_client.put_object(Bucket=bucket_name, Key='churn/v2/parquet', Body=open(dataset_file, 'rb'))
+
+            now[0] = 1000
+            lib.clear_caches()
+            bash_cmd = lib.load_prefix('s3://' + bucket_name)
+            assert 'create external table `churn_v2`' in bash_cmd, 'Should list versions as often as their TTL says'
+        finally:
+            lib.set_listing_cache(None)
+
+    @mock_s3
+    def test_listings_needing_every_file(self, tmpdir):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170101/parquet', Body=open(dataset_file, 'rb'))
+        lib.set_listing_cache(ListingCache(str(tmpdir)))
+        try:
+            lib._scan_version(s3_client, bucket_name, 'churn/v1/')
+            s3_client.put_object(Bucket=bucket_name, Key='churn/v1/submission_date=20170102/parquet', Body=open(dataset_file, 'rb'))
+
+            assert lib._scan_version(s3_client, bucket_name, 'churn/v1/').num_files == 1
+            assert len(lib._scan_version(s3_client, bucket_name, 'churn/v1/', collect_partitions=True).partitions) == 2
+        finally:
+            lib.set_listing_cache(None)
+
+
+class TestColumnarListing(object):
+
+    @mock_s3
+    def test_same_as_listing(self):
+        pytest.importorskip('numpy')
+        _setup_module()
+
+        keys = ['churn/v1/submission_date=20170101/_SUCCESS', 'churn/v1/submission_date=20170101/part-0',
+                'churn/v1/submission_date=20170101/part-1', 'churn/v1/submission_date=20170102/part-0',
+                'churn/v1/_temporary/part-0']
+        for k in keys:
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+
+        options = {'success_only': True, 'collect_partitions': True}
+        expected = lib._scan_version(s3_client, bucket_name, 'churn/v1/', **options)
+        expected_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True)
+
+        lib.clear_caches()
+        lib.set_columnar_listing(True)
+        try:
+            scan = lib._scan_version(s3_client, bucket_name, 'churn/v1/', **options)
+            assert lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True) == expected_cmd
+        finally:
+            lib.set_columnar_listing(False)
+
+        assert scan.latest == dict((k, expected.latest[k]) for k in ('Key', 'Size', 'LastModified'))
+        assert (scan.num_files, scan.total_size, scan.success_exists) == (expected.num_files, expected.total_size, True)
+        assert scan.matching_partitions(['submission_date']) == expected.matching_partitions(['submission_date'])
+        assert scan.partitions.success('submission_date=20170101')
+
+
+class TestXmlListing(object):
+
+    @mock_s3
+    def test_same_as_listing(self):
+        _setup_module()
+
+        keys = ['churn/v1/submission_date=20170101/_SUCCESS', 'churn/v1/submission_date=20170101/part-0',
+                'churn/v1/submission_date=20170102/part-0', 'churn/v1/_temporary/part-0']
+        for k in keys:
+            s3_client.put_object(Bucket=bucket_name, Key=k, Body=open(dataset_file, 'rb'))
+
+        options = {'success_only': True, 'collect_partitions': True}
+        expected = lib._scan_version(s3_client, bucket_name, 'churn/v1/', **options)
+        expected_cmd = lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True)
+
+        lib.clear_caches()
+        lib.set_listing_fetch(botocore_fetch(s3_client))
+        try:
+            scan = lib._scan_version(s3_client, bucket_name, 'churn/v1/', **options)
+            assert lib.get_bash_cmd('s3://' + bucket_name + '/churn', just_sql=True, partition_stats=True) == expected_cmd
+        finally:
+            lib.set_listing_fetch(None)
+
+        assert scan.latest == expected.latest
+        assert (scan.num_files, scan.total_size, scan.success_exists) == (expected.num_files, expected.total_size, True)
+        assert [(d, node.files, node.size, node.last_modified) for d, node in scan.partitions.items()] == [
+            (d, node.files, node.size, node.last_modified) for d, node in expected.partitions.items()]
+
+
+class TestBucketRegions(object):
+
+    @mock_s3
+    def test_client_for_region(self):
+        _setup_module()
+
+        s3_client.create_bucket(Bucket='eu-bucket', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        s3_client.put_object(Bucket='eu-bucket', Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+
+        client = lib._get_client('eu-bucket')
+        assert client.meta.region_name == 'eu-west-1'
+        assert lib._get_client('eu-bucket') is client
+        assert lib._get_client(bucket_name) is lib._get_client()
+        assert 'create external table `churn_v1`' in lib.get_bash_cmd('s3://eu-bucket/churn')
+
+    @mock_s3
+    def test_region_looked_up_once(self, monkeypatch):
+        _setup_module()
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+
+        limiter = RateLimiter()
+        lib.set_rate_limiter(limiter)
+        try:
+            for _ in range(3):
+                lib._get_client(bucket_name)
+        finally:
+            lib.set_rate_limiter(None)
+
+        assert limiter.stats()['requests'] == 1
+
+    def test_concurrent_lookups(self, monkeypatch):
+        looked_up, other_started = [], threading.Event()
+
+        def look_up(client, bucket):
+            looked_up.append(bucket)
+            if bucket == 'eu-bucket':
+                other_started.set()
+            else:
+                assert other_started.wait(5), 'Should look up other buckets meanwhile'
+            return bucket[:2]
+
+        monkeypatch.setattr(lib, '_get_client', lambda bucket=None: None)
+        monkeypatch.setattr(lib, '_look_up_bucket_region', look_up)
+        lib.clear_caches()
+
+        threads = [threading.Thread(target=lib._get_bucket_region, args=(bucket,))
+                   for bucket in ('us-bucket', 'us-bucket', 'eu-bucket')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(looked_up) == ['eu-bucket', 'us-bucket'], 'Should look up each bucket once'
+        assert lib._get_bucket_region('us-bucket') == 'us'
+        lib.clear_caches()
+
+    def test_bucket_location(self):
+        class Client(object):
+            def head_bucket(self, Bucket):
+                return {'ResponseMetadata': {'HTTPHeaders': {}}}
+
+            def get_bucket_location(self, Bucket):
+                return {'LocationConstraint': {'us-bucket': None, 'eu-bucket': 'EU', 'sa-bucket': 'sa-east-1'}[Bucket]}
+
+        assert lib._look_up_bucket_region(Client(), 'us-bucket') == 'us-east-1'
+        assert lib._look_up_bucket_region(Client(), 'eu-bucket') == 'eu-west-1'
+        assert lib._look_up_bucket_region(Client(), 'sa-bucket') == 'sa-east-1'
+
+
+class TestHedging(object):
+
+    @mock_s3
+    def test_read_metadata(self):
+        _setup_module()
+
+        s3_client.put_object(Bucket=bucket_name, Key='churn/v1/parquet', Body=open(dataset_file, 'rb'))
+        expected = lib.read_metadata(s3_client, bucket_name, 'churn/v1/parquet')
+
+        hedger = Hedger(min_samples=0, min_delay=0, max_ratio=1.0)
+        lib.set_hedger(hedger)
+        try:
+            for _ in range(3):
+                assert lib.read_metadata(s3_client, bucket_name, 'churn/v1/parquet') == expected
+        finally:
+            lib.set_hedger(None)
+
+        assert hedger.stats()['requests'] == 6
@@ -0,0 +1,60 @@
+from datetime import datetime
+from parquet2hive_modules.partitions import PartitionTrie
+
+
+def _trie():
+    trie = PartitionTrie()
+    trie.add('submission_date=20170101/sample_id=1', 10, datetime(2017, 1, 2))
+    trie.add('submission_date=20170101/sample_id=1', 20, datetime(2017, 1, 3))
+    trie.add('submission_date=20170101/sample_id=2', 30, datetime(2017, 1, 2))
+    trie.add('submission_date=20170102/sample_id=1', 40, datetime(2017, 1, 4))
+    trie.add('', 5)
+    return trie
+
+
+class TestPartitionTrie(object):
+
+    def test_add(self):
+        trie = _trie()
+        node = trie.node('submission_date=20170101/sample_id=1')
+        assert (node.files, node.size, node.last_modified) == (2, 30, datetime(2017, 1, 3))
+        assert trie.node('submission_date=20170101').files == 0
+        assert trie.node('submission_date=20170103') is None
+        assert len(trie) == 4
+
+    def test_items(self):
+        assert [(d, node.files) for d, node in _trie().items()] == [
+            ('', 1),
+            ('submission_date=20170101/sample_id=1', 2),
+            ('submission_date=20170101/sample_id=2', 1),
+            ('submission_date=20170102/sample_id=1', 1)]
+
+    def test_matching(self):
+        trie = _trie()
+        trie.add('submission_date=20170101', 50)
+        trie.add('other/submission_date=20170101', 60)
+
+        assert trie.matching(['submission_date', 'sample_id']) == {
+            'submission_date=20170101/sample_id=1': [2, 30],
+            'submission_date=20170101/sample_id=2': [1, 30],
+            'submission_date=20170102/sample_id=1': [1, 40]}
+        assert trie.matching(['submission_date']) == {'submission_date=20170101': [1, 50],
+                                                      'other/submission_date=20170101': [1, 60]}
+        assert trie.matching(['sample_id']) == {}
+
+    def test_success(self):
+        trie = _trie()
+        trie.mark_success('submission_date=20170101/sample_id=1')
+        trie.mark_success('submission_date=20170103')
+
+        assert trie.success('submission_date=20170101/sample_id=1')
+        assert not trie.success('submission_date=20170101/sample_id=2')
+        assert trie.success('submission_date=20170103')
+        assert not trie.success('submission_date=20170104')
+        assert len(trie) == 4
+
+    def test_shared_names(self):
+        trie = _trie()
+        first = trie.node('submission_date=20170101').children
+        second = trie.node('submission_date=20170102').children
+        assert [name for name in first if name in second][0] is [name for name in second if name in first][0]
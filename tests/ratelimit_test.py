@@ -0,0 +1,159 @@
+from botocore.exceptions import ClientError, EndpointConnectionError
+from parquet2hive_modules import ratelimit
+import pytest
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ThrottlingStandIn(object):
+    """Answers like S3 would when allowed at most `rate` requests per second."""
+
+    def __init__(self, clock, rate):
+        self.clock = clock
+        self.rate = rate
+        self.calls = []
+        self.throttled = 0
+
+    def __call__(self, *args, **kwargs):
+        now = self.clock()
+        recent = [t for t in self.calls if now - t < 1.0]
+        if len(recent) >= self.rate:
+            self.throttled += 1
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+                               'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+        self.calls.append(now)
+        return {'ok': True}
+
+
+def _limiter(clock, **kwargs):
+    return ratelimit.RateLimiter(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+class TestTokenBucket(object):
+
+    def test_rate(self):
+        clock = FakeClock()
+        tokens = ratelimit.TokenBucket(10, 1, clock)
+
+        assert tokens.reserve() == 0
+        assert tokens.reserve() == pytest.approx(0.1)
+        assert tokens.reserve() == pytest.approx(0.2)
+
+        clock.now += 1
+        assert tokens.reserve() == 0, 'Tokens should refill over time'
+
+
+class TestRateLimiter(object):
+
+    def test_retries_throttled_requests(self):
+        clock = FakeClock()
+        s3 = ThrottlingStandIn(clock, rate=5)
+        limiter = _limiter(clock, rate=1000, max_retries=20)
+
+        for _ in range(20):
+            assert limiter.call('bucket', 'dataset/v1/file', s3) == {'ok': True}
+
+        assert len(s3.calls) == 20
+        assert s3.throttled > 0
+        assert limiter.stats()['throttles'] == s3.throttled
+        assert limiter.stats()['retries'] == s3.throttled
+
+    def test_token_bucket_avoids_throttling(self):
+        clock = FakeClock()
+        s3 = ThrottlingStandIn(clock, rate=5)
+        limiter = _limiter(clock, rate=4, burst=1)
+
+        for _ in range(20):
+            limiter.call('bucket', 'dataset/v1/file', s3)
+
+        assert s3.throttled == 0, 'Requests within the rate should not be throttled'
+
+    def test_window_narrows_and_widens(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, initial_window=8)
+        s3 = ThrottlingStandIn(clock, rate=0)
+        limiter.max_retries = 0
+
+        with pytest.raises(ClientError):
+            limiter.call('bucket', 'dataset/v1/file', s3)
+        assert limiter.stats()['windows']['bucket/dataset'] == 4
+
+        for _ in range(10):
+            limiter.call('bucket', 'dataset/v1/file', lambda: None)
+        assert limiter.stats()['windows']['bucket/dataset'] > 5
+
+    def test_slow_requests_narrow_window(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, initial_window=8, latency_target=1.0)
+
+        def slow():
+            clock.now += 2
+
+        limiter.call('bucket', 'dataset/v1/file', slow)
+        assert limiter.stats()['windows']['bucket/dataset'] < 8
+
+    def test_separate_prefixes(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, initial_window=8, max_retries=0)
+
+        with pytest.raises(ClientError):
+            limiter.call('bucket', 'churn/v1/file', ThrottlingStandIn(clock, rate=0))
+        limiter.call('bucket', 'frank/v1/file', lambda: None)
+
+        windows = limiter.stats()['windows']
+        assert windows['bucket/churn'] == 4
+        assert windows['bucket/frank'] > 8
+
+    def test_gives_up(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, max_retries=3)
+        s3 = ThrottlingStandIn(clock, rate=0)
+
+        with pytest.raises(ClientError):
+            limiter.call('bucket', 'dataset/v1/file', s3)
+        assert s3.throttled == 4
+
+        delays = [d for d in clock.slept]
+        assert all(0 <= d <= 0.05 * 2 ** i for i, d in enumerate(delays)), 'Backoff should be bounded by the exponential delay'
+
+    def test_other_errors_are_not_retried(self):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+        calls = []
+
+        def missing():
+            calls.append(1)
+            raise ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+
+        with pytest.raises(ClientError):
+            limiter.call('bucket', 'dataset/v1/_SUCCESS', missing)
+        assert len(calls) == 1
+
+    def test_transient_errors_are_retried(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, initial_window=8)
+        errors = [ClientError({'Error': {'Code': 'InternalError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}}, 'GetObject'),
+                  EndpointConnectionError(endpoint_url='https://bucket.s3.amazonaws.com/')]
+
+        def flaky():
+            if errors:
+                raise errors.pop(0)
+            return {'ok': True}
+
+        assert limiter.call('bucket', 'dataset/v1/file', flaky) == {'ok': True}
+        stats = limiter.stats()
+        assert stats['retries'] == 2
+        assert stats['throttles'] == 0
+        assert stats['windows']['bucket/dataset'] >= 8, 'Only throttles should narrow the window'
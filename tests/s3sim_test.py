@@ -0,0 +1,172 @@
+from benchmarks.s3sim import S3Simulator, constant
+from moto import mock_s3
+from parquet2hive_modules import parquet2hivelib as lib
+from parquet2hive_modules.ratelimit import RateLimiter
+import boto3
+import botocore.config
+import botocore.exceptions
+import pytest
+import threading
+
+bucket_name = 'test-bucket'
+dataset_file = 'tests/dataset.parquet'
+
+
+class FakeTime(object):
+    """A clock which only moves when slept on, shared by the simulator and the code under test."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+        self.lock = threading.Lock()
+
+    def time(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.slept.append(seconds)
+            self.now += seconds
+
+
+def _client():
+    return boto3.client('s3', config=botocore.config.Config(retries={'max_attempts': 0}))
+
+
+def _setup_bucket(keys):
+    s3_client = boto3.client('s3')
+    s3_client.create_bucket(Bucket=bucket_name)
+    for key in keys:
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=open(dataset_file, 'rb'))
+    lib.clear_caches()
+
+
+def _head_bucket_region(client, bucket):
+    """Stands in for `_look_up_bucket_region` with a single HEAD bucket request, since not every version of moto
+    sends the region header which spares the GetBucketLocation request."""
+    lib._s3_call(bucket, '', client.head_bucket, Bucket=bucket)
+    return 'us-east-1'
+
+
+class TestS3Simulator(object):
+
+    @mock_s3
+    def test_latency(self):
+        _setup_bucket(['churn/v1/parquet'])
+        fake_time = FakeTime()
+
+        with S3Simulator(latencies={'GetObject': constant(0.5), 'ListObjectsV2': constant(0.1)},
+                         clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+            client = _client()
+            client.list_objects_v2(Bucket=bucket_name, Prefix='churn/')
+            client.get_object(Bucket=bucket_name, Key='churn/v1/parquet')['Body'].read()
+
+        assert fake_time.slept == [0.1, 0.5]
+        assert simulator.stats()['requests'] == {'ListObjectsV2': 1, 'GetObject': 1}
+
+    @mock_s3
+    def test_outliers(self):
+        _setup_bucket(['churn/v1/parquet'])
+        fake_time = FakeTime()
+
+        with S3Simulator(latencies={'HeadObject': constant(0.01)}, outlier_probability=1.0, outlier_latency=2.0,
+                         clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+            _client().head_object(Bucket=bucket_name, Key='churn/v1/parquet')
+
+        assert fake_time.slept == [2.01]
+        assert simulator.stats()['outliers'] == 1
+
+    @mock_s3
+    def test_slow_down(self):
+        _setup_bucket(['churn/v1/parquet'])
+        fake_time = FakeTime()
+
+        with S3Simulator(latencies={}, max_request_rate=1, burst=2, clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+            client = _client()
+            for _ in range(2):
+                client.list_objects_v2(Bucket=bucket_name, Prefix='churn/')
+            with pytest.raises(botocore.exceptions.ClientError) as e:
+                client.list_objects_v2(Bucket=bucket_name, Prefix='churn/')
+            assert e.value.response['Error']['Code'] == 'SlowDown'
+
+            fake_time.sleep(1)
+            client.list_objects_v2(Bucket=bucket_name, Prefix='churn/')
+
+        assert simulator.stats()['throttles'] == 1
+
+    @mock_s3
+    def test_bandwidth(self):
+        _setup_bucket(['churn/v1/parquet'])
+        size = len(open(dataset_file, 'rb').read())
+        fake_time = FakeTime()
+
+        with S3Simulator(latencies={}, bandwidth=size, clock=fake_time.time, sleep=fake_time.sleep):
+            client = _client()
+            body = client.get_object(Bucket=bucket_name, Key='churn/v1/parquet')['Body']
+            assert len(body.read()) == size
+
+        assert fake_time.slept == [1.0]
+
+    @mock_s3
+    def test_stop(self):
+        _setup_bucket(['churn/v1/parquet'])
+        fake_time = FakeTime()
+
+        with S3Simulator(latencies={'ListObjectsV2': constant(0.1)}, clock=fake_time.time, sleep=fake_time.sleep):
+            pass
+        _client().list_objects_v2(Bucket=bucket_name, Prefix='churn/')
+
+        assert fake_time.slept == []
+
+    @mock_s3
+    def test_load_prefix(self, monkeypatch):
+        _setup_bucket(['{}/v1/parquet'.format(name) for name in ('churn', 'main_summary', 'crash_summary')])
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+        expected = lib.load_prefix('s3://' + bucket_name)
+        fake_time = FakeTime()
+
+        lib.clear_caches()
+        with S3Simulator(clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+            assert lib.load_prefix('s3://' + bucket_name) == expected
+
+        lib.clear_caches()
+        # looking up the region of the bucket and listing it, then for each dataset a listing of its versions by
+        # find_datasets, a version listing and two footer range reads
+        assert sum(simulator.stats()['requests'].values()) == 2 + 3 * 4
+
+    @mock_s3
+    def test_estimate_prefix(self, monkeypatch):
+        _setup_bucket(['churn/v1/day=0/_SUCCESS', 'churn/v1/day=0/parquet', 'churn/v1/day=1/parquet',
+                       'frank/v1/_SUCCESS', 'frank/v1/parquet'])
+        monkeypatch.setattr(lib, '_look_up_bucket_region', _head_bucket_region)
+        fake_time = FakeTime()
+
+        with S3Simulator(clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+            lib.load_prefix('s3://' + bucket_name, success_only=True)
+        lib.clear_caches()
+        estimate = lib.estimate_prefix('s3://' + bucket_name, success_only=True)
+
+        requests = simulator.stats()['requests']
+        assert estimate['total']['requests'] == {'list': requests['ListObjectsV2'],
+                                                 'head': requests['HeadBucket'] + requests['HeadObject'],
+                                                 'get': requests['GetObject']}, 'Should count the requests of a run'
+
+    @mock_s3
+    def test_rate_limiter(self):
+        _setup_bucket(['churn/v{}/parquet'.format(i) for i in range(1, 4)])
+        expected = lib.get_bash_cmd('s3://' + bucket_name + '/churn')
+        fake_time = FakeTime()
+
+        lib.clear_caches()
+        limiter = RateLimiter(rate=1000, clock=fake_time.time, sleep=fake_time.sleep)
+        lib.set_rate_limiter(limiter)
+        try:
+            with S3Simulator(max_request_rate=10, burst=2, clock=fake_time.time, sleep=fake_time.sleep) as simulator:
+                assert lib.get_bash_cmd('s3://' + bucket_name + '/churn') == expected
+        finally:
+            lib.set_rate_limiter(None)
+            lib.clear_caches()
+
+        assert simulator.stats()['throttles'] > 0
+        assert limiter.stats()['retries'] == simulator.stats()['throttles']